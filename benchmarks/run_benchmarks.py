@@ -0,0 +1,399 @@
+"""
+Offline benchmark suite for evaluation, few-shot retrieval, fine-tuned model loading, dataset preprocessing throughput and import time.
+
+Everything runs without network access: the LLM is a tiny random-weight causal LM with a locally trained tokenizer
+(see ``tests/conftest.py``), and the datasets are synthetic DBpedia and OSHA shaped datasets.
+Results are written to a JSON file, which can be compared against the results of a previous run to find regressions.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output benchmark_results.json
+    python benchmarks/run_benchmarks.py --quick --compare benchmark_results.json
+    python benchmarks/run_benchmarks.py --only imports --max-import-time 3
+"""
+import argparse, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+from datetime import datetime, timezone
+from functools import lru_cache
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[0:0] = [os.path.join(ROOT_DIR, "src"), os.path.join(ROOT_DIR, "tests")]
+
+import numpy as np
+import pandas as pd
+from datasets import Dataset, ClassLabel, Features, Value
+import datasets, transformers, torch
+import finetune as ft
+import evaluate as ev
+import model_prompts
+from few_shot import FewShotIndex
+from conftest import build_tiny_llm, save_tiny_finetuned_llm, LABEL_NAMES, WORDS
+
+DBPEDIA_LABEL_NAMES = [
+    "Company", "EducationalInstitution", "Artist", "Athlete", "OfficeHolder", "MeanOfTransportation", "Building",
+    "NaturalPlace", "Village", "Animal", "Plant", "Album", "Film", "WrittenWork"
+]
+
+OSHA_LABEL_NAMES = [
+    "Fractures", "Amputations", "Burns", "Heat (thermal) burns, unspecified", "Chemical burns and corrosions",
+    "Internal injuries to organs and blood vessels of the trunk", "Intracranial injuries, unspecified", "Concussions",
+    "Crushing injuries", "Electrical burns", "Heat exhaustion", "Heat stroke", "Puncture wounds, except gunshot wounds",
+    "Cuts, lacerations", "Injuries to internal organs", "Dislocations", "Soreness, pain, hurt-nonspecified injury",
+    "Multiple traumatic injuries and disorders", "Traumatic injuries and disorders, unspecified", "Sprains, strains, tears",
+    "Avulsions, enucleations", "Bruises, contusions", "Fractures and other injuries", "Hernia", "Poisonings, toxic effects",
+    "Asphyxiations", "Drownings", "Electrocutions, electric shocks", "Frostbite", "Gunshot wounds"
+]
+
+# Optional dependencies which a headless worker should never import just by importing the core modules.
+HEAVY_MODULES = ["matplotlib", "sklearn", "trl", "peft", "tqdm.notebook", "ipywidgets", "few_shot"]
+
+# The dependencies the core modules always import. Some of them import optional dependencies themselves
+# (e.g. transformers imports sklearn if it is installed), which the core modules cannot avoid.
+CORE_IMPORTS = "import torch, datasets, pandas\nfrom transformers import AutoModelForCausalLM, AutoTokenizer"
+
+# The longest ``import evaluate`` may take in a fresh interpreter, in seconds.
+IMPORT_TIME_TARGET = 3.0
+
+def make_texts(n : int, rng : np.random.Generator, min_words : int = 8, max_words : int = 80) -> list[str]:
+    """
+    Generate ``n`` random texts made of words the tiny LLM's tokenizer was trained on.
+    """
+    lengths = rng.integers(min_words, max_words + 1, n)
+    words = np.array(WORDS, dtype=object)[rng.integers(0, len(WORDS), lengths.sum())]
+    ends = np.cumsum(lengths)
+    return [" ".join(words[end - length:end]) for end, length in zip(ends, lengths)]
+
+def make_dbpedia_dataset(n : int, label_names : list = DBPEDIA_LABEL_NAMES, seed : int = 0) -> Dataset:
+    """
+    Generate a balanced dataset with the same columns as ``fancyzhx/dbpedia_14``.
+    """
+    rng = np.random.default_rng(seed)
+    features = Features({"label" : ClassLabel(names=label_names), "title" : Value("string"), "content" : Value("string")})
+    return Dataset.from_dict({
+        "label" : rng.permutation(np.arange(n) % len(label_names)),
+        "title" : make_texts(n, rng, 1, 4),
+        "content" : make_texts(n, rng)
+    }, features=features)
+
+def make_osha_dataframe(n : int, seed : int = 0) -> pd.DataFrame:
+    """
+    Generate a DataFrame with the same text and label columns as the OSHA severe injury reports.
+    Like the real data, the classes are very imbalanced and a few values are missing.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Zipf-like class frequencies
+    weights = 1 / np.arange(1, len(OSHA_LABEL_NAMES) + 1) ** 1.2
+    labels = np.array(OSHA_LABEL_NAMES, dtype=object)[rng.choice(len(OSHA_LABEL_NAMES), n, p=weights / weights.sum())]
+    narratives = np.array(make_texts(n, rng, 10, 120), dtype=object)
+
+    narratives[rng.random(n) < 0.01] = None
+    labels[rng.random(n) < 0.01] = None
+
+    return pd.DataFrame({"Final Narrative" : narratives, "NatureTitle" : labels})
+
+def make_responses(n : int, label_names : list, seed : int = 0) -> list[str]:
+    """
+    Generate LLM responses covering every path of ``_get_class_id_from_model_response()``:
+    exact labels, truncated labels, class IDs, chain-of-thought answers, and responses without any label.
+    """
+    rng = np.random.default_rng(seed)
+    responses = []
+    for kind, label in zip(rng.integers(0, 5, n), rng.integers(0, len(label_names), n)):
+        label = label_names[label]
+        if kind == 0: responses.append(label)
+        elif kind == 1: responses.append(label[0:rng.integers(1, len(label) + 1)].lower())
+        elif kind == 2: responses.append(str(rng.integers(0, len(label_names) + 2)))
+        elif kind == 3: responses.append(f"The text describes {' '.join(WORDS[0:8])}, so the answer is {label}.")
+        else: responses.append(" ".join(WORDS[0:5]))
+    return responses
+
+def run_benchmark(name : str, func, params : dict, repeats : int, rows : int | None = None) -> dict:
+    """
+    Time ``func`` ``repeats`` times with a monotonic clock.
+
+    Args:
+        name (str): The name of the benchmark.
+        func (Callable): The code to time.
+        params (dict): The parameters of the benchmark, used to match results between runs.
+        repeats (int): How many times to time ``func``.
+        rows (int, optional): How many rows ``func`` processes, used to compute throughput. Defaults to None.
+
+    Returns:
+        result (dict): The timings of the benchmark.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    result = {
+        "name" : name,
+        "params" : params,
+        "times" : times,
+        "min" : min(times),
+        "median" : statistics.median(times)
+    }
+    if rows is not None:
+        result["rows"] = rows
+        result["rows_per_second"] = rows / result["median"] if result["median"] > 0 else None
+
+    print(f"{name:<28} {json.dumps(params):<60} median {result['median']:.4f}s", flush=True)
+    return result
+
+def benchmark_label_matching(num_responses : int, repeats : int) -> list[dict]:
+    label_names = DBPEDIA_LABEL_NAMES + ["Unknown"]
+    responses = make_responses(num_responses, label_names)
+    run = lambda : [ev._get_class_id_from_model_response(response, label_names) for response in responses]
+    return [run_benchmark("get_class_id_from_response", run, {"responses" : num_responses}, repeats, rows=num_responses)]
+
+def benchmark_preprocessing(sizes : list[int], repeats : int, num_proc : int | None = None) -> list[dict]:
+    results = []
+    for size in sizes:
+        dbpedia = make_dbpedia_dataset(size)
+        results.append(run_benchmark("undersample_dataset", lambda : ft.undersample_dataset(dbpedia, ratio=0.5),
+                                     {"dataset" : "dbpedia", "rows" : size, "ratio" : 0.5}, repeats, rows=size))
+        params = {"dataset" : "dbpedia", "rows" : size} if num_proc is None else {"dataset" : "dbpedia", "rows" : size, "num_proc" : num_proc}
+        results.append(run_benchmark("preprocess_dataset", lambda : ft.preprocess_dataset(dbpedia, text_column="content", labels_column="label", num_proc=num_proc),
+                                     params, repeats, rows=size))
+
+        osha_df = make_osha_dataframe(size)
+        results.append(run_benchmark("create_dataset_from_dataframe", lambda : ft.create_dataset_from_dataframe(osha_df, "Final Narrative", "NatureTitle", test_size=None),
+                                     {"dataset" : "osha", "rows" : size}, repeats, rows=size))
+
+        osha = ft.create_dataset_from_dataframe(osha_df, "Final Narrative", "NatureTitle", test_size=None)
+        results.append(run_benchmark("select_top_n_classes", lambda : ft.select_top_n_classes(osha, n=10),
+                                     {"dataset" : "osha", "rows" : size, "n" : 10}, repeats, rows=size))
+        results.append(run_benchmark("undersample_dataset", lambda : ft.undersample_dataset(osha, ratio=1),
+                                     {"dataset" : "osha", "rows" : size, "ratio" : 1}, repeats, rows=size))
+    return results
+
+def benchmark_retrieval(sizes : list[int], num_queries : int, repeats : int) -> list[dict]:
+    results = []
+    queries = make_texts(num_queries, np.random.default_rng(1))
+    for size in sizes:
+        train_data, label_names = ft.preprocess_dataset(make_dbpedia_dataset(size), text_column="content", labels_column="label")
+        results.append(run_benchmark("FewShotIndex.build", lambda : FewShotIndex.from_dataset(train_data, label_names),
+                                     {"dataset" : "dbpedia", "rows" : size}, repeats, rows=size))
+
+        index = FewShotIndex.from_dataset(train_data, label_names)
+        results.append(run_benchmark("FewShotIndex.query", lambda : index.query(queries, k=1),
+                                     {"dataset" : "dbpedia", "rows" : size, "queries" : num_queries, "k" : 1}, repeats, rows=num_queries))
+    return results
+
+def benchmark_evaluation(num_samples : int, repeats : int) -> list[dict]:
+    model, tokenizer = build_tiny_llm()
+    eval_data, label_names = ft.preprocess_dataset(make_dbpedia_dataset(num_samples, label_names=LABEL_NAMES), text_column="content", labels_column="label")
+
+    configurations = [
+        ("generate", 1),
+        ("generate", 8),
+        ("score", 8),
+        ("constrained", 8)
+    ]
+
+    results = []
+    for method, batch_size in configurations:
+        eval_config = ev.EvaluationConfig(name="Benchmark", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=3, method=method)
+        run = lambda : ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=batch_size)
+        results.append(run_benchmark("evaluate", run, {"samples" : num_samples, "method" : method, "batch_size" : batch_size}, repeats, rows=num_samples))
+    return results
+
+def benchmark_adapters(num_samples : int, repeats : int, max_new_tokens : int = 16) -> list[dict]:
+    """
+    Compare running a LoRA adapter on top of its base model against the adapter merged into the base model (see ``finetune.export_merged_llm()``):
+    how long each takes to load, and the latency of each generated token.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        adapter_directory = save_tiny_finetuned_llm(temp_dir)
+
+        def export():
+            shutil.rmtree(os.path.join(adapter_directory, "merged"), ignore_errors=True)
+            ft.export_merged_llm(adapter_directory)
+        results.append(run_benchmark("export_merged_llm", export, {"model" : "tiny"}, repeats))
+
+        for merged in [False, True]:
+            load = lambda : ft.load_finetuned_llm(adapter_directory, device_map="cpu", quantized=False, merged=merged)
+            results.append(run_benchmark("load_finetuned_llm", load, {"model" : "tiny", "merged" : merged}, repeats))
+
+            model, tokenizer = load()
+            tokenizer.padding_side = "left"
+            input_ids = tokenizer(make_texts(num_samples, np.random.default_rng(0), 8, 32), add_special_tokens=False, padding=True, return_tensors="pt")
+            generate = lambda : model.generate(**input_ids, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False,
+                                               pad_token_id=tokenizer.pad_token_id)
+            with torch.no_grad():
+                results.append(run_benchmark("generate_tokens", generate, {"model" : "tiny", "merged" : merged, "samples" : num_samples,
+                                             "max_new_tokens" : max_new_tokens}, repeats, rows=num_samples * max_new_tokens))
+    return results
+
+def _run_import(statement : str) -> tuple[float, list[str]]:
+    """
+    Run an import statement in a fresh interpreter, and return how long it took and which of ``HEAVY_MODULES`` it loaded.
+    """
+    code = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "import_time = time.perf_counter() - start\n"
+        f"print(json.dumps([import_time, [name for name in {HEAVY_MODULES!r} if name in sys.modules]]))"
+    )
+    env = {**os.environ, "PYTHONPATH" : os.path.join(ROOT_DIR, "src"), "MPLBACKEND" : "Agg"}
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT_DIR, env=env, capture_output=True, text=True, check=True).stdout
+    import_time, heavy_modules = json.loads(output.strip().splitlines()[-1])
+    return import_time, heavy_modules
+
+@lru_cache(maxsize=None)
+def _get_core_heavy_modules() -> frozenset[str]:
+    """
+    Return which of ``HEAVY_MODULES`` the core dependencies (``CORE_IMPORTS``) load on their own in this environment.
+    """
+    return frozenset(_run_import(CORE_IMPORTS)[1])
+
+def measure_import(module : str) -> tuple[float, list[str]]:
+    """
+    Import ``module`` in a fresh interpreter, like a headless worker would.
+
+    Returns:
+        import_time (float): How long the import took in seconds, excluding interpreter startup.
+        heavy_modules (list[str]): Which of ``HEAVY_MODULES`` were imported along with it, other than the ones
+                                   the core dependencies already import (see ``CORE_IMPORTS``).
+    """
+    import_time, heavy_modules = _run_import(f"import {module}")
+    core_heavy_modules = _get_core_heavy_modules()
+    return import_time, [name for name in heavy_modules if name not in core_heavy_modules]
+
+def benchmark_imports(repeats : int) -> list[dict]:
+    results = []
+    for module in ["inference_cache", "finetune", "evaluate"]:
+        measurements = [measure_import(module) for _ in range(repeats)]
+        times = [import_time for import_time, _ in measurements]
+        result = {
+            "name" : "import",
+            "params" : {"module" : module},
+            "times" : times,
+            "min" : min(times),
+            "median" : statistics.median(times),
+            "heavy_modules" : measurements[-1][1]
+        }
+        print(f"{'import':<28} {json.dumps(result['params']):<60} median {result['median']:.4f}s", flush=True)
+        results.append(result)
+    return results
+
+def check_import_targets(results : list[dict], max_import_time : float) -> list[str]:
+    """
+    Check that ``import evaluate`` is fast enough, and that no core module imports any of ``HEAVY_MODULES``.
+
+    Returns:
+        failures (list[str]): A description of every target which was missed.
+    """
+    failures = []
+    for result in results:
+        if result["name"] != "import":
+            continue
+        module = result["params"]["module"]
+        if len(result["heavy_modules"]) > 0:
+            failures.append(f"import {module} loaded {', '.join(result['heavy_modules'])}")
+        if module == "evaluate" and result["median"] > max_import_time:
+            failures.append(f"import {module} took {result['median']:.2f}s, more than the target of {max_import_time:.2f}s")
+    return failures
+
+def get_metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        "timestamp" : datetime.now(timezone.utc).isoformat(),
+        "commit" : commit,
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "cpu_count" : os.cpu_count(),
+        "torch_threads" : torch.get_num_threads(),
+        "versions" : {
+            "numpy" : np.__version__,
+            "pandas" : pd.__version__,
+            "datasets" : datasets.__version__,
+            "transformers" : transformers.__version__,
+            "torch" : torch.__version__
+        }
+    }
+
+def compare_results(results : list[dict], baseline : list[dict], tolerance : float) -> list[dict]:
+    """
+    Compare the median time of each benchmark against the result with the same name and parameters in ``baseline``.
+
+    Returns:
+        regressions (list[dict]): Every benchmark which is more than ``tolerance`` times slower than its baseline.
+    """
+    key = lambda result : (result["name"], json.dumps(result["params"], sort_keys=True))
+    baseline = {key(result) : result for result in baseline}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(key(result))
+        if previous is None:
+            continue
+        ratio = result["median"] / previous["median"] if previous["median"] > 0 else float("inf")
+        print(f"{result['name']:<28} {json.dumps(result['params']):<60} {ratio:.2f}x baseline")
+        if ratio > 1 + tolerance:
+            regressions.append({**result, "baseline_median" : previous["median"], "ratio" : ratio})
+    return regressions
+
+def main(args : list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to.")
+    parser.add_argument("--sizes", type=int, nargs="+", help="Dataset sizes for the preprocessing and retrieval benchmarks. Defaults to 10k, 100k and 560k rows.")
+    parser.add_argument("--eval-samples", type=int, help="How many samples to evaluate in the evaluation benchmarks, to query in the retrieval benchmarks, and to generate for in the adapter benchmarks. Defaults to 256.")
+    parser.add_argument("--responses", type=int, help="How many responses to match in the label matching benchmark. Defaults to 100k.")
+    parser.add_argument("--num-proc", type=int, help="How many processes preprocess_dataset() uses in the preprocessing benchmarks. Defaults to one.")
+    parser.add_argument("--repeats", type=int, help="How many times to time each benchmark. Defaults to 3.")
+    parser.add_argument("--quick", action="store_true", help="Use small defaults, e.g., for CI smoke tests.")
+    parser.add_argument("--only", nargs="+", choices=["labels", "preprocessing", "retrieval", "evaluation", "adapters", "imports"], help="Only run these groups of benchmarks.")
+    parser.add_argument("--max-import-time", type=float, default=IMPORT_TIME_TARGET, help=f"The longest import evaluate may take in seconds. Exits with status 1 if it takes longer. Defaults to {IMPORT_TIME_TARGET}.")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare against. Exits with status 1 if any benchmark regressed.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much slower than the baseline a benchmark may be. Defaults to 0.2 (20%%).")
+    args = parser.parse_args(args)
+
+    # Fill in every size which was not given explicitly.
+    defaults = {"sizes" : [1_000, 10_000], "eval_samples" : 32, "responses" : 10_000, "repeats" : 1} if args.quick else \
+               {"sizes" : [10_000, 100_000, 560_000], "eval_samples" : 256, "responses" : 100_000, "repeats" : 3}
+    for name, value in defaults.items():
+        if getattr(args, name) is None: setattr(args, name, value)
+
+    groups = args.only or ["labels", "preprocessing", "retrieval", "evaluation", "adapters", "imports"]
+
+    results = []
+    if "labels" in groups: results += benchmark_label_matching(args.responses, args.repeats)
+    if "preprocessing" in groups: results += benchmark_preprocessing(args.sizes, args.repeats, args.num_proc)
+    if "retrieval" in groups: results += benchmark_retrieval(args.sizes, args.eval_samples, args.repeats)
+    if "evaluation" in groups: results += benchmark_evaluation(args.eval_samples, args.repeats)
+    if "adapters" in groups: results += benchmark_adapters(args.eval_samples, args.repeats)
+    if "imports" in groups: results += benchmark_imports(args.repeats)
+
+    # Read the baseline before writing the results, in case they are the same file.
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"metadata" : get_metadata(), "results" : results}, f, indent=2)
+
+    status = 0
+    failures = check_import_targets(results, args.max_import_time)
+    for failure in failures:
+        print(failure)
+    if len(failures) > 0:
+        status = 1
+
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}.")
+            status = 1
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
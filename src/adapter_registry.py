@@ -0,0 +1,342 @@
+from dataclasses import dataclass
+from collections import OrderedDict
+from contextlib import contextmanager
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from peft import PeftModel
+import finetune as ft
+import evaluate as ev
+from inference_cache import forget_model_fingerprint, _get_adapter_name
+import torch
+import os, threading, time
+
+@dataclass
+class AdapterInfo:
+    """
+    The state of a single LoRA adapter in an ``AdapterRegistry``.
+
+    Args:
+        name (str): The name the adapter was registered under.
+        path (str): Where the adapter was saved by ``finetune.finetune()``.
+        loaded (bool): Whether the adapter is currently attached to the base model.
+        memory (int): How many bytes the adapter's weights take up while it is loaded. Estimated from its file size until it is first loaded.
+        num_loads (int): How many times the adapter has been loaded from disk.
+        num_activations (int): How many times the adapter has been activated.
+        last_used (float): When the adapter was last activated, from ``time.monotonic()``. 0 if it was never activated.
+    """
+    name : str
+    path : str
+    loaded : bool = False
+    memory : int = 0
+    num_loads : int = 0
+    num_activations : int = 0
+    last_used : float = 0.0
+
+@dataclass
+class RegistryStats:
+    """
+    A snapshot of the counters of an ``AdapterRegistry``.
+
+    Args:
+        active_adapter (str | None): The name of the active adapter, or None if no adapter was activated yet.
+        loaded_adapters (list[str]): The loaded adapters, from least to most recently used.
+        memory_used (int): How many bytes the loaded adapters take up.
+        max_memory (int | None): The memory budget for the loaded adapters in bytes.
+        num_loads (int): How many times an adapter was loaded from disk.
+        num_evictions (int): How many times an adapter was evicted to stay within the budget.
+        num_switches (int): How many times the active adapter was changed.
+        load_time (float): The total time spent loading adapters in seconds.
+        switch_time (float): The total time spent switching between loaded adapters in seconds.
+    """
+    active_adapter : str | None
+    loaded_adapters : list[str]
+    memory_used : int
+    max_memory : int | None
+    num_loads : int
+    num_evictions : int
+    num_switches : int
+    load_time : float
+    switch_time : float
+
+class AdapterRegistry:
+    """
+    Serves several fine-tuned LoRA adapters of the same base model, keeping a single copy of the base model in memory.
+
+    Adapters are registered by name and only loaded from disk the first time they are activated. Loaded adapters stay
+    attached to the base model, so switching back to one only changes which adapter is active, without reloading anything.
+    When the loaded adapters would take up more than ``max_memory`` bytes (or there would be more than ``max_adapters``),
+    the least recently used adapters are evicted. The active adapter is only evicted after the adapter replacing it was loaded.
+
+    Usage:
+        registry = AdapterRegistry.from_pretrained("Qwen/Qwen2.5-7B-Instruct", max_memory=2**30)
+        registry.register("dbpedia", "models/dbpedia")
+        registry.register("osha", "models/osha")
+        responses = registry.generate("osha", prompts)
+        result = registry.evaluate("dbpedia", label_names, eval_dataset, eval_config)
+
+    Caches can be shared between adapters: ``inference_cache.InferenceCache`` and ``finetune.PrefixCache`` both keep the
+    results of each adapter apart.
+
+    Args:
+        base_model (AutoModelForCausalLM): The base model every adapter was fine-tuned from.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the base model.
+        max_memory (int, optional): The most bytes the weights of the loaded adapters may take up. Defaults to None (no limit).
+        max_adapters (int, optional): The most adapters which may be loaded at once. Defaults to None (no limit).
+    """
+    def __init__(self, base_model : AutoModelForCausalLM, tokenizer : AutoTokenizer, max_memory : int | None = None, max_adapters : int | None = None):
+        if max_adapters is not None and max_adapters < 1:
+            raise ValueError("max_adapters must be at least 1.")
+
+        self.base_model = base_model
+        self.tokenizer = tokenizer
+        self.max_memory = max_memory
+        self.max_adapters = max_adapters
+
+        self._model = base_model
+        self._adapters = {}
+        self._loaded = OrderedDict() # Loaded adapter names, from least to most recently used
+        self._active = None
+        self._lock = threading.RLock()
+
+        self._num_loads = 0
+        self._num_evictions = 0
+        self._num_switches = 0
+        self._load_time = 0.0
+        self._switch_time = 0.0
+
+    @staticmethod
+    def from_pretrained(model_name : str, device_map : str = "cuda:0", quantized : bool = True, **kwargs) -> "AdapterRegistry":
+        """
+        Load a base model and its tokenizer, and create a registry for its adapters.
+
+        Args:
+            model_name (str): The name or path of the base model.
+            device_map (str, optional): Which device to load the base model onto. Defaults to "cuda:0".
+            quantized (bool, optional): Whether to load the base model with 4-bit quantization. See ``finetune.load_finetuned_llm()``. Defaults to True.
+            **kwargs: Passed to ``AdapterRegistry``.
+
+        Returns:
+            AdapterRegistry: The registry, with no adapters registered.
+        """
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=False,
+            bnb_4bit_compute_dtype=torch.float16
+        ) if quantized else None
+
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForCausalLM.from_pretrained(model_name, device_map=device_map, quantization_config=bnb_config)
+        return AdapterRegistry(model, tokenizer, **kwargs)
+
+    @property
+    def model(self) -> AutoModelForCausalLM:
+        """
+        The base model with every loaded adapter attached. Use ``activate()`` or ``use()`` to choose which adapter it runs.
+        """
+        return self._model
+
+    @property
+    def active_adapter(self) -> str | None:
+        return self._active
+
+    def __contains__(self, name : str) -> bool:
+        return name in self._adapters
+
+    def register(self, name : str, path : str) -> None:
+        """
+        Register a fine-tuned LoRA adapter under ``name``. It is not loaded until it is first activated.
+        Registering a different adapter under the name of a loaded one evicts the old adapter.
+
+        Args:
+            name (str): The name to route requests to the adapter with.
+            path (str): Where the adapter was saved by ``finetune.finetune()``.
+        """
+        if "." in name:
+            raise ValueError(f"Adapter names cannot contain '.': {name}")
+
+        with self._lock:
+            if name in self._adapters:
+                if self._adapters[name].path == path:
+                    return
+                self.unregister(name)
+            self._adapters[name] = AdapterInfo(name=name, path=path, memory=self._estimate_memory(path))
+
+    def unregister(self, name : str) -> None:
+        """
+        Evict the adapter registered under ``name`` if it is loaded, and forget it.
+        """
+        with self._lock:
+            self._get_info(name)
+            if self._adapters[name].loaded:
+                self._evict(name, force=True)
+            del self._adapters[name]
+
+    def get_adapters(self) -> list[AdapterInfo]:
+        """
+        Return the state of every registered adapter.
+        """
+        return list(self._adapters.values())
+
+    def _get_info(self, name : str) -> AdapterInfo:
+        if name not in self._adapters:
+            raise ValueError(f"No adapter is registered under the name: {name}")
+        return self._adapters[name]
+
+    def _estimate_memory(self, path : str) -> int:
+        """
+        Estimate how much memory an adapter will take up from the size of its weight files.
+        """
+        if not os.path.isdir(path):
+            return 0
+        return sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path) if file_name.startswith("adapter_model"))
+
+    def _measure_memory(self, name : str) -> int:
+        """
+        Return how many bytes the weights of a loaded adapter take up.
+        """
+        return sum(tensor.numel() * tensor.element_size() for tensor_name, tensor in self._model.named_parameters() if _get_adapter_name(tensor_name) == name)
+
+    def _get_memory_used(self) -> int:
+        return sum(self._adapters[name].memory for name in self._loaded)
+
+    def _is_over_budget(self, extra_memory : int = 0, extra_adapters : int = 0) -> bool:
+        if self.max_memory is not None and self._get_memory_used() + extra_memory > self.max_memory:
+            return True
+        return self.max_adapters is not None and len(self._loaded) + extra_adapters > self.max_adapters
+
+    def _evict_until_within_budget(self, extra_memory : int = 0, extra_adapters : int = 0) -> None:
+        """
+        Evict the least recently used adapters, except the active one, until ``extra_memory`` more bytes
+        and ``extra_adapters`` more adapters fit within the budget.
+        """
+        for name in list(self._loaded):
+            if not self._is_over_budget(extra_memory, extra_adapters):
+                return
+            if name != self._active:
+                self._evict(name)
+
+    def _evict(self, name : str, force : bool = False) -> None:
+        """
+        Detach a loaded adapter from the base model, freeing its memory.
+        """
+        if len(self._loaded) == 1:
+            # PEFT models always need at least one adapter, so go back to the bare base model instead.
+            self._model = self._model.unload()
+        else: self._model.delete_adapter(name)
+
+        if name == self._active:
+            self._active = None
+
+        del self._loaded[name]
+        self._adapters[name].loaded = False
+        if not force: self._num_evictions += 1
+        forget_model_fingerprint(self._model)
+
+    def load(self, name : str) -> None:
+        """
+        Load a registered adapter from disk and attach it to the base model without activating it,
+        evicting the least recently used adapters if it does not fit within the budget.
+        If no adapter is active yet, the loaded adapter becomes the active one, since PEFT models always run an adapter.
+        """
+        with self._lock:
+            info = self._get_info(name)
+            if info.loaded:
+                return
+
+            self._evict_until_within_budget(info.memory, 1)
+
+            start_time = time.perf_counter()
+            if isinstance(self._model, PeftModel):
+                self._model.load_adapter(info.path, adapter_name=name, is_trainable=False)
+            else:
+                self._model = PeftModel.from_pretrained(self._model, info.path, adapter_name=name, is_trainable=False)
+                self._model.eval()
+            self._load_time += time.perf_counter() - start_time
+
+            # Keep the adapter which was active before active. If there is none (for example because it was just
+            # evicted), PEFT may have switched to any other loaded adapter, so switch to the new one explicitly.
+            if self._active is None:
+                self._active = name
+            self._model.set_adapter(self._active)
+
+            info.loaded = True
+            info.memory = self._measure_memory(name)
+            info.num_loads += 1
+            self._num_loads += 1
+            self._loaded[name] = None
+            self._loaded.move_to_end(name, last=False)
+            forget_model_fingerprint(self._model)
+
+    def activate(self, name : str) -> AutoModelForCausalLM:
+        """
+        Make ``name`` the active adapter, loading it first if necessary. Switching between loaded adapters does not reload any weights.
+
+        NOTE: Use ``use()`` instead if other threads may activate a different adapter while the model is running.
+
+        Args:
+            name (str): The name of the adapter.
+
+        Returns:
+            model (AutoModelForCausalLM): The base model running the adapter.
+        """
+        with self._lock:
+            info = self._get_info(name)
+            self.load(name)
+
+            if self._active != name:
+                start_time = time.perf_counter()
+                self._model.set_adapter(name)
+                self._switch_time += time.perf_counter() - start_time
+                self._num_switches += 1
+                self._active = name
+
+            info.num_activations += 1
+            info.last_used = time.monotonic()
+            self._loaded.move_to_end(name)
+
+            # The adapter which was active before may have had to stay loaded until now.
+            self._evict_until_within_budget()
+            return self._model
+
+    @contextmanager
+    def use(self, name : str):
+        """
+        Activate an adapter and keep it active until the end of the ``with`` block, even if other threads request a different one.
+
+        Usage:
+            with registry.use("osha") as model:
+                responses = finetune.generate_batch(prompts, model, registry.tokenizer)
+        """
+        with self._lock:
+            yield self.activate(name)
+
+    def generate(self, name : str, prompts : list, **kwargs) -> list[str]:
+        """
+        Generate a response to each prompt with the adapter registered under ``name``. See ``finetune.generate_batch()``.
+        """
+        with self.use(name) as model:
+            return ft.generate_batch(prompts, model, self.tokenizer, **kwargs)
+
+    def evaluate(self, name : str, label_names : list, eval_dataset, eval_config : ev.EvaluationConfig, **kwargs) -> ev.EvaluationResult:
+        """
+        Evaluate the adapter registered under ``name`` on a classification dataset. See ``evaluate.evaluate()``.
+        """
+        with self.use(name) as model:
+            return ev.evaluate(model, self.tokenizer, label_names, eval_dataset, eval_config, **kwargs)
+
+    def get_stats(self) -> RegistryStats:
+        """
+        Return a snapshot of the registry's counters.
+        """
+        with self._lock:
+            return RegistryStats(
+                active_adapter=self._active,
+                loaded_adapters=list(self._loaded),
+                memory_used=self._get_memory_used(),
+                max_memory=self.max_memory,
+                num_loads=self._num_loads,
+                num_evictions=self._num_evictions,
+                num_switches=self._num_switches,
+                load_time=self._load_time,
+                switch_time=self._switch_time
+            )
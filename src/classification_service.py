@@ -0,0 +1,303 @@
+from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from transformers import AutoModelForCausalLM, AutoTokenizer
+import finetune as ft
+from evaluate import EvaluationConfig, LabelMatcher, _build_prompts
+from inference_cache import InferenceCache
+from inference_profiler import InferenceProfiler
+import numpy as np
+import asyncio, time
+
+@dataclass
+class Classification:
+    """
+    The result of classifying a single text sample with a ``ClassificationService``.
+
+    Args:
+        label_id (int): The predicted class ID. The ID after the last class label means "Unknown".
+        label_name (str): The name of the predicted class label.
+        response (str): The raw LLM output. For ``EvaluationConfig.method`` "score", this is the name of the most likely class label.
+        latency (float): How long the request took in seconds, from being queued to being classified.
+    """
+    label_id : int
+    label_name : str
+    response : str
+    latency : float
+
+@dataclass
+class ServiceStats:
+    """
+    A snapshot of the counters of a ``ClassificationService``.
+
+    Args:
+        queue_depth (int): How many texts are waiting to be put into a batch.
+        num_requests (int): How many texts have been classified, including failed requests.
+        num_batches (int): How many batches have been run through the LLM.
+        num_errors (int): How many texts could not be classified because their batch raised an exception.
+        last_batch_size (int): The size of the most recent batch.
+        mean_batch_size (float): The mean size of the recent batches.
+        p50_latency (float): The median latency of the recent requests in seconds.
+        p99_latency (float): The 99th percentile latency of the recent requests in seconds.
+    """
+    queue_depth : int
+    num_requests : int
+    num_batches : int
+    num_errors : int
+    last_batch_size : int
+    mean_batch_size : float
+    p50_latency : float
+    p99_latency : float
+
+class ClassificationService:
+    """
+    Classifies text samples for many concurrent callers by grouping them into dynamic micro-batches.
+
+    Each call to ``classify()`` puts its text into a queue. A background task takes texts from the queue until it has
+    ``max_batch_size`` of them, or until ``max_wait`` seconds have passed since the first one arrived, and classifies the
+    whole batch at once in a dedicated inference thread, so the event loop is never blocked. While a batch is running,
+    new texts keep queueing up for the next one, so batches grow with the load.
+
+    Texts are classified exactly like ``evaluate.evaluate()`` classifies the samples of a dataset.
+
+    Usage:
+        async with ClassificationService(model, tokenizer, label_names, eval_config) as service:
+            result = await service.classify("Some text to classify")
+
+    Args:
+        model (AutoModelForCausalLM): The LLM to use. It can be pre-trained or fine-tuned.
+        tokenizer (AutoTokenizer): The tokenizer to use. This should come with the LLM.
+        label_names (list): The name of each class label. An "Unknown" label is added to the end.
+        eval_config (EvaluationConfig): Controls what instructions to give to the LLM to classify each text.
+        max_batch_size (int, optional): The largest number of texts to classify at once. Defaults to 8.
+        max_wait (float, optional): How long to wait for a batch to fill up in seconds. Defaults to 0.01.
+        prefix_cache (finetune.PrefixCache, optional): See ``evaluate.evaluate()``. Defaults to None.
+        cache (InferenceCache, optional): See ``evaluate.evaluate()``. Defaults to None.
+        profiler (InferenceProfiler, optional): If given, every batch is profiled. See ``InferenceProfiler``. Defaults to None.
+        stats_window (int, optional): How many of the most recent requests and batches the latency and batch size statistics are computed over. Defaults to 1000.
+    """
+    def __init__(
+        self,
+        model : AutoModelForCausalLM,
+        tokenizer : AutoTokenizer,
+        label_names : list,
+        eval_config : EvaluationConfig,
+        max_batch_size : int = 8,
+        max_wait : float = 0.01,
+        prefix_cache : ft.PrefixCache | None = None,
+        cache : InferenceCache | None = None,
+        profiler : InferenceProfiler | None = None,
+        stats_window : int = 1000
+        ):
+        if eval_config.method not in ["generate", "score", "constrained"]:
+            raise ValueError(f"Unknown evaluation method: {eval_config.method}")
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.label_names = list(label_names) + ["Unknown"]
+        self.eval_config = eval_config
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.prefix_cache = prefix_cache
+        self.cache = cache
+        self.profiler = profiler
+
+        self._label_matcher = LabelMatcher(self.label_names)
+        self._queue = None
+        self._task = None
+        self._executor = None
+        self._stopping = False
+
+        self._num_requests = 0
+        self._num_batches = 0
+        self._num_errors = 0
+        self._latencies = deque(maxlen=stats_window)
+        self._batch_sizes = deque(maxlen=stats_window)
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """
+        Start the background batching task. Must be called from inside the event loop which will call ``classify()``.
+        """
+        if self.is_running:
+            return
+        self._queue = asyncio.Queue()
+        self._stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classification")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Classify every text which is still queued, then stop the background batching task and the inference thread.
+        New calls to ``classify()`` are rejected as soon as the service starts stopping.
+        """
+        if not self.is_running:
+            return
+        if not self._stopping:
+            self._stopping = True
+            await self._queue.put(None) # Tells the batching task to stop once it reaches this point in the queue
+        await self._task
+        self._executor.shutdown(wait=True)
+        self._task = None
+
+    async def __aenter__(self) -> "ClassificationService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def classify(self, text : str) -> Classification:
+        """
+        Classify a single text sample.
+
+        Args:
+            text (str): The text to classify.
+
+        Returns:
+            Classification: The predicted class label and the raw LLM output.
+        """
+        if not self.is_running:
+            raise RuntimeError("The classification service is not running. Call start() first.")
+        # Requests queued behind the stop sentinel would never be classified.
+        if self._stopping:
+            raise RuntimeError("The classification service is stopping.")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def classify_many(self, texts : list[str]) -> list[Classification]:
+        """
+        Classify several text samples concurrently. See ``classify()``.
+        """
+        return await asyncio.gather(*[self.classify(text) for text in texts])
+
+    def get_stats(self) -> ServiceStats:
+        """
+        Return a snapshot of the service's counters.
+        """
+        latencies = np.array(self._latencies) if len(self._latencies) > 0 else np.zeros(1)
+        return ServiceStats(
+            queue_depth=self._queue.qsize() if self._queue is not None else 0,
+            num_requests=self._num_requests,
+            num_batches=self._num_batches,
+            num_errors=self._num_errors,
+            last_batch_size=self._batch_sizes[-1] if len(self._batch_sizes) > 0 else 0,
+            mean_batch_size=float(np.mean(self._batch_sizes)) if len(self._batch_sizes) > 0 else 0.0,
+            p50_latency=float(np.percentile(latencies, 50)),
+            p99_latency=float(np.percentile(latencies, 99))
+        )
+
+    async def _next_batch(self) -> tuple[list, bool]:
+        """
+        Wait for the next batch of requests from the queue.
+
+        Returns:
+            batch (list): The queued (text, future, enqueue time) of each request in the batch.
+            stop (bool): Whether ``stop()`` was called.
+        """
+        loop = asyncio.get_running_loop()
+
+        request = await self._queue.get()
+        if request is None:
+            return [], True
+
+        batch = [request]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Take every request which is already queued without waiting.
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else: request = self._queue.get_nowait()
+
+            if request is None:
+                return batch, True
+            batch.append(request)
+
+        return batch, False
+
+    async def _run(self) -> None:
+        """
+        Background task which forms micro-batches and classifies them until ``stop()`` is called.
+        """
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            batch, stop = await self._next_batch()
+            if len(batch) == 0:
+                continue
+
+            # Callers which were cancelled while queued no longer need a result.
+            batch = [request for request in batch if not request[1].cancelled()]
+            if len(batch) == 0:
+                continue
+
+            texts = [text for text, _, _ in batch]
+            try:
+                predictions = await loop.run_in_executor(self._executor, self._classify_batch, texts)
+            except Exception as e:
+                predictions = None
+                self._num_errors += len(batch)
+                for _, future, _ in batch:
+                    if not future.done(): future.set_exception(e)
+
+            self._num_requests += len(batch)
+            self._num_batches += 1
+            self._batch_sizes.append(len(batch))
+
+            if predictions is None:
+                continue
+
+            end_time = time.perf_counter()
+            for (_, future, enqueue_time), (label_id, response) in zip(batch, predictions):
+                latency = end_time - enqueue_time
+                self._latencies.append(latency)
+                if not future.done():
+                    future.set_result(Classification(label_id=label_id, label_name=self.label_names[label_id], response=response, latency=latency))
+
+        # Fail any request which was still queued after the stop sentinel, so its caller does not wait forever.
+        while not self._queue.empty():
+            request = self._queue.get_nowait()
+            if request is not None and not request[1].done():
+                request[1].set_exception(RuntimeError("The classification service was stopped."))
+
+    def _classify_batch(self, texts : list[str]) -> list[tuple[int, str]]:
+        """
+        Classify a batch of texts in the inference thread.
+
+        Returns:
+            predictions (list[tuple[int, str]]): The predicted class ID and the raw LLM output of each text.
+        """
+        prompts = _build_prompts(texts, self.eval_config, self.tokenizer)
+        batch_profile = self.profiler.batch(range(len(texts)), self.model.device) if self.profiler is not None else nullcontext()
+
+        with batch_profile:
+            if self.eval_config.method == "score":
+                # Score every class label (excluding "Unknown") as a response to each text
+                scores = ft.score_labels(prompts, self.label_names[:-1], self.model, self.tokenizer,
+                                         batch_size=len(prompts), cache=self.cache, profiler=self.profiler)
+                class_ids = [int(class_id) for class_id in np.argmax(scores, axis=1)]
+                return [(class_id, self.label_names[class_id]) for class_id in class_ids]
+
+            # Constrained answers are always the full name of a class label (excluding "Unknown").
+            responses = ft.generate_batch(prompts, self.model, self.tokenizer,
+                                          max_new_tokens=self.eval_config.max_tokens,
+                                          batch_size=len(prompts),
+                                          prefix_cache=self.prefix_cache,
+                                          label_names=self.label_names[:-1] if self.eval_config.method == "constrained" else None,
+                                          cache=self.cache,
+                                          profiler=self.profiler)
+            return [(self._label_matcher.match(response), response) for response in responses]
@@ -0,0 +1,430 @@
+from dataclasses import asdict
+from datasets import Dataset
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import KNeighborsClassifier
+import finetune as ft
+from evaluate import EvaluationConfig, EvaluationResult, LabelMatcher, _build_prompts, _iter_sample_chunks, _progress_bar
+from inference_cache import fingerprint_model, fingerprint_tokenizer
+from inference_profiler import InferenceProfiler, profile_stage
+from contextlib import nullcontext
+import numpy as np
+import torch
+import os, json, hashlib, pickle, time
+
+# How the hidden states of a prompt are pooled into a single embedding.
+POOLING_METHODS = ("last", "mean")
+
+def embed_prompts(
+    prompts : list,
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    pooling : str = "last",
+    layer : int = -1,
+    batch_size : int = 8,
+    profiler : InferenceProfiler | None = None
+    ) -> np.ndarray:
+    """
+    Embed each prompt with a single forward pass of an LLM by pooling its hidden states. No text is generated.
+
+    Args:
+        prompts (list): The prompts to embed. See ``finetune.generate_batch()``.
+        model (AutoModelForCausalLM): The LLM to use. It can be pre-trained or fine-tuned (e.g., from ``finetune.load_finetuned_llm()``).
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+        pooling (str, optional): How to pool the hidden states of each prompt into one embedding. Defaults to "last".
+                                 - "last": The hidden state of the last token, i.e., the state the LLM would start its answer from.
+                                 - "mean": The mean hidden state of every token in the prompt.
+        layer (int, optional): Which hidden layer to pool. Defaults to -1 (the last layer).
+        batch_size (int, optional): How many prompts to run through the LLM at once. Defaults to 8.
+        profiler (InferenceProfiler, optional): If given, records how long tokenizing and the forward pass take. Defaults to None.
+
+    Returns:
+        embeddings (np.ndarray): The float32 embedding of each prompt, with shape ``(len(prompts), hidden_size)``.
+    """
+    if pooling not in POOLING_METHODS:
+        raise ValueError(f"Unknown pooling method: {pooling}")
+
+    input_ids = ft._tokenize_prompts(prompts, tokenizer, profiler)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    model.eval()
+    embeddings = []
+
+    # Group prompts of similar length together to reduce padding.
+    batches = ft._bucket_by_length([len(ids) for ids in input_ids], batch_size)
+    order = [i for batch in batches for i in batch]
+
+    for batch in batches:
+        tokenized_input = ft._pad_left([input_ids[i] for i in batch], pad_token_id, model.device)
+        attention_mask = tokenized_input['attention_mask']
+        # Left padding would otherwise shift the position of every token in the shorter prompts.
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        with profile_stage(profiler, "prefill", model.device), torch.no_grad():
+            output = model(**tokenized_input, position_ids=position_ids, output_hidden_states=True)
+            hidden_states = output.hidden_states[layer].float()
+
+            if pooling == "last":
+                pooled = hidden_states[:, -1]
+            else:
+                mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+                pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+        embeddings.append(pooled.cpu().numpy())
+
+    # Put the embeddings back into the original order of the prompts.
+    embeddings = np.concatenate(embeddings, axis=0) if len(embeddings) > 0 else np.zeros((0, model.config.hidden_size), dtype=np.float32)
+    result = np.empty_like(embeddings)
+    result[order] = embeddings
+    return result
+
+def _get_embedding_fingerprint(model : AutoModelForCausalLM, tokenizer : AutoTokenizer, eval_config : EvaluationConfig, pooling : str, layer : int, texts : list[str]) -> str:
+    """
+    Return a fingerprint of everything which affects the embedding of each row of a dataset, including the text samples themselves.
+    """
+    # Datasets of the same length (e.g. a train and an eval split) must not share a store.
+    texts_fingerprint = hashlib.sha256()
+    for text in texts:
+        texts_fingerprint.update(text.encode("utf-8"))
+        texts_fingerprint.update(b"\0")
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps({
+        "texts" : texts_fingerprint.hexdigest(),
+        "model" : fingerprint_model(model),
+        "tokenizer" : fingerprint_tokenizer(tokenizer),
+        "prompt" : eval_config.prompt,
+        "few_shot" : [eval_config.few_shot_index.fingerprint, eval_config.shots] if eval_config.few_shot_index is not None else None,
+        "truncation" : asdict(eval_config.truncation) if eval_config.truncation is not None else None,
+        "pooling" : pooling,
+        "layer" : layer
+    }, sort_keys=True).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+class EmbeddingStore:
+    """
+    Memory-mapped store on disk of one embedding per row of a dataset.
+
+    The store is a folder containing ``embeddings.npy`` (a float32 array with shape ``(num_rows, dim)``), ``filled.npy``
+    (whether each row has been embedded yet) and ``metadata.json``. Both arrays are memory-mapped, so stores which are
+    much larger than memory can be filled and read a few rows at a time, and an interrupted run can carry on from where it stopped.
+
+    Args:
+        path (str): The folder of the store. It is created if it does not exist.
+        num_rows (int): The number of rows in the dataset.
+        dim (int): The size of each embedding.
+        fingerprint (str, optional): Identifies which texts were embedded and how (see ``embed_dataset()``). Opening an existing
+                                     store with a different fingerprint or shape raises a ValueError. Defaults to "".
+    """
+    def __init__(self, path : str, num_rows : int, dim : int, fingerprint : str = ""):
+        self.path = path
+        metadata = {"num_rows" : int(num_rows), "dim" : int(dim), "fingerprint" : fingerprint}
+        metadata_path = os.path.join(path, "metadata.json")
+
+        if os.path.exists(metadata_path):
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                existing_metadata = json.load(f)
+            if existing_metadata != metadata:
+                raise ValueError(f"The embedding store at {path} was made for a different dataset, model or configuration.")
+            self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r+")
+            self.filled = np.load(os.path.join(path, "filled.npy"), mmap_mode="r+")
+            return
+
+        os.makedirs(path, exist_ok=True)
+        self.embeddings = np.lib.format.open_memmap(os.path.join(path, "embeddings.npy"), mode="w+", dtype=np.float32, shape=(num_rows, dim))
+        self.filled = np.lib.format.open_memmap(os.path.join(path, "filled.npy"), mode="w+", dtype=np.bool_, shape=(num_rows,))
+        # Write the metadata last, so that a partially created store is never opened.
+        with open(metadata_path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+
+    def __len__(self) -> int:
+        return len(self.filled)
+
+    def write(self, rows : np.ndarray, embeddings : np.ndarray) -> None:
+        """
+        Store the embeddings of some rows and flush them to disk.
+        """
+        self.embeddings[rows] = embeddings
+        self.embeddings.flush()
+        self.filled[rows] = True
+        self.filled.flush()
+
+    def get_missing_rows(self, rows : np.ndarray | None = None) -> np.ndarray:
+        """
+        Return every row (out of ``rows``, or all rows) which has not been embedded yet.
+        """
+        if rows is None:
+            return np.flatnonzero(~self.filled)
+        rows = np.asarray(rows)
+        return rows[~self.filled[rows]]
+
+def _read_samples(dataset, label_names : list) -> tuple[list[str], np.ndarray]:
+    """
+    Read the text and true class ID of every sample in a preprocessed dataset (see ``evaluate.evaluate()``).
+    Samples without a label, or with an unknown label, get the "Unknown" class ID ``len(label_names)``.
+    """
+    label_matcher = LabelMatcher(list(label_names) + ["Unknown"])
+    texts, labels = [], []
+    for chunk in _iter_sample_chunks(dataset, 1024):
+        for text, label, _ in chunk:
+            texts.append(text)
+            labels.append(label_matcher.match(label) if label is not None else len(label_names))
+    return texts, np.array(labels, dtype=np.int64)
+
+def embed_dataset(
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    dataset : Dataset,
+    eval_config : EvaluationConfig,
+    path : str | None = None,
+    pooling : str = "last",
+    layer : int = -1,
+    batch_size : int = 8,
+    chunk_size : int = 1024,
+    texts : list[str] | None = None,
+    profiler : InferenceProfiler | None = None
+    ) -> np.ndarray:
+    """
+    Embed every sample of a preprocessed dataset (see ``finetune.preprocess_dataset()``) with ``embed_prompts()``.
+    Each sample is wrapped in the same prompt ``evaluate.evaluate()`` would give the LLM.
+
+    Args:
+        model (AutoModelForCausalLM): The LLM to use.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+        dataset (Dataset): The preprocessed dataset.
+        eval_config (EvaluationConfig): Controls what instructions are given to the LLM before each sample.
+        path (str, optional): If given, the embeddings are kept in an ``EmbeddingStore`` in this folder, and rows which are
+                              already in the store are not embedded again. Defaults to None.
+        pooling (str, optional): See ``embed_prompts()``. Defaults to "last".
+        layer (int, optional): See ``embed_prompts()``. Defaults to -1.
+        batch_size (int, optional): How many samples to run through the LLM at once. Defaults to 8.
+        chunk_size (int, optional): How many samples to embed before writing them to the store. Defaults to 1024.
+        texts (list[str], optional): The text samples of the dataset, if they were already read. Defaults to None.
+        profiler (InferenceProfiler, optional): See ``embed_prompts()``. Defaults to None.
+
+    Returns:
+        embeddings (np.ndarray): The embedding of each row, with shape ``(len(dataset), hidden_size)``.
+                                 If ``path`` is given, this is a memory-mapped array.
+    """
+    if texts is None:
+        texts = [text for chunk in _iter_sample_chunks(dataset, chunk_size) for text, _, _ in chunk]
+
+    if path is None:
+        return embed_prompts(_build_prompts(texts, eval_config, tokenizer), model, tokenizer, pooling, layer, batch_size, profiler)
+
+    fingerprint = _get_embedding_fingerprint(model, tokenizer, eval_config, pooling, layer, texts)
+    store = EmbeddingStore(path, len(texts), model.config.hidden_size, fingerprint)
+
+    missing = store.get_missing_rows()
+    for start in _progress_bar(range(0, len(missing), chunk_size), desc="Embedding dataset", disable=len(missing) == 0):
+        rows = missing[start:start + chunk_size]
+        prompts = _build_prompts([texts[i] for i in rows], eval_config, tokenizer)
+        store.write(rows, embed_prompts(prompts, model, tokenizer, pooling, layer, batch_size, profiler))
+
+    return store.embeddings
+
+class EmbeddingClassifier:
+    """
+    Classifies text samples from the embeddings of an LLM (see ``embed_prompts()``) instead of generating an answer,
+    which only needs a single forward pass per sample.
+
+    Args:
+        label_names (list): The name of each class label.
+        method (str, optional): The classifier to train on the embeddings. Defaults to "linear".
+                                - "linear": A linear probe (multinomial logistic regression).
+                                - "knn": The ``k`` nearest training samples by cosine similarity vote on the class.
+        k (int, optional): How many neighbours to use for "knn". Defaults to 10.
+        pooling (str, optional): See ``embed_prompts()``. Defaults to "last".
+        layer (int, optional): See ``embed_prompts()``. Defaults to -1.
+        max_iter (int, optional): The maximum number of iterations to train the linear probe for. Defaults to 1000.
+    """
+    def __init__(self, label_names : list, method : str = "linear", k : int = 10, pooling : str = "last", layer : int = -1, max_iter : int = 1000):
+        if method not in ["linear", "knn"]:
+            raise ValueError(f"Unknown classifier method: {method}")
+        if pooling not in POOLING_METHODS:
+            raise ValueError(f"Unknown pooling method: {pooling}")
+
+        self.label_names = list(label_names)
+        self.method = method
+        self.k = k
+        self.pooling = pooling
+        self.layer = layer
+        self.max_iter = max_iter
+        self._classifier = None
+
+    def fit(self, embeddings : np.ndarray, labels : np.ndarray) -> "EmbeddingClassifier":
+        """
+        Train the classifier.
+
+        Args:
+            embeddings (np.ndarray): The embedding of each training sample.
+            labels (np.ndarray): The class ID of each training sample. Samples with an "Unknown" class ID
+                                 (``len(label_names)``) are ignored.
+
+        Returns:
+            EmbeddingClassifier: The classifier itself.
+        """
+        labels = np.asarray(labels)
+        known = labels < len(self.label_names)
+        embeddings, labels = np.asarray(embeddings)[known], labels[known]
+
+        if self.method == "linear":
+            self._classifier = LogisticRegression(max_iter=self.max_iter)
+        else:
+            self._classifier = KNeighborsClassifier(n_neighbors=min(self.k, len(labels)), metric="cosine", weights="distance")
+
+        self._classifier.fit(embeddings, labels)
+        return self
+
+    def predict_proba(self, embeddings : np.ndarray) -> np.ndarray:
+        """
+        Return the probability of each class label for each embedding, with shape ``(len(embeddings), len(label_names))``.
+        """
+        if self._classifier is None:
+            raise RuntimeError("The classifier has not been trained. Call fit() first.")
+
+        # Classes which had no training samples always have a probability of 0.
+        probabilities = np.zeros((len(embeddings), len(self.label_names)), dtype=np.float64)
+        if len(embeddings) > 0:
+            probabilities[:, self._classifier.classes_] = self._classifier.predict_proba(np.asarray(embeddings))
+        return probabilities
+
+    def predict(self, embeddings : np.ndarray) -> np.ndarray:
+        """
+        Return the predicted class ID for each embedding.
+        """
+        return np.argmax(self.predict_proba(embeddings), axis=1)
+
+    def save(self, path : str) -> None:
+        """
+        Save the trained classifier to a file.
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path : str) -> "EmbeddingClassifier":
+        """
+        Load a classifier saved with ``save()``.
+        """
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+def train_embedding_classifier(
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    label_names : list,
+    train_dataset : Dataset,
+    eval_config : EvaluationConfig,
+    method : str = "linear",
+    k : int = 10,
+    pooling : str = "last",
+    layer : int = -1,
+    batch_size : int = 8,
+    store_path : str | None = None
+    ) -> EmbeddingClassifier:
+    """
+    Embed a preprocessed training dataset and train an ``EmbeddingClassifier`` on it.
+
+    Args:
+        model (AutoModelForCausalLM): The LLM to use. It can be pre-trained or fine-tuned.
+        tokenizer (AutoTokenizer): The tokenizer to use. This should come with the LLM.
+        label_names (list): The name of each class label in the dataset.
+        train_dataset (Dataset): The training dataset. Must be preprocessed (see ``finetune.preprocess_dataset()``).
+        eval_config (EvaluationConfig): Controls what instructions are given to the LLM before each sample.
+                                        Use the same configuration with ``evaluate_embeddings()``.
+        method (str, optional): See ``EmbeddingClassifier``. Defaults to "linear".
+        k (int, optional): See ``EmbeddingClassifier``. Defaults to 10.
+        pooling (str, optional): See ``embed_prompts()``. Defaults to "last".
+        layer (int, optional): See ``embed_prompts()``. Defaults to -1.
+        batch_size (int, optional): How many samples to run through the LLM at once. Defaults to 8.
+        store_path (str, optional): If given, the training embeddings are kept in an ``EmbeddingStore`` in this folder. Defaults to None.
+
+    Returns:
+        EmbeddingClassifier: The trained classifier.
+    """
+    texts, labels = _read_samples(train_dataset, label_names)
+    embeddings = embed_dataset(model, tokenizer, train_dataset, eval_config, store_path, pooling, layer, batch_size, texts=texts)
+    return EmbeddingClassifier(label_names, method=method, k=k, pooling=pooling, layer=layer).fit(embeddings, labels)
+
+def evaluate_embeddings(
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    classifier : EmbeddingClassifier,
+    eval_dataset : Dataset,
+    eval_config : EvaluationConfig,
+    batch_size : int = 8,
+    store_path : str | None = None,
+    profiler : InferenceProfiler | None = None
+    ) -> EvaluationResult:
+    """
+    Evaluate an ``EmbeddingClassifier`` on a supervised dataset, producing the same kind of result as ``evaluate.evaluate()``,
+    so that its accuracy and speed can be compared against generating answers with ``EvaluationResult.save()``.
+
+    Each sample is classified from a single forward pass of the LLM, so ``eval_config.max_tokens`` is ignored.
+    The "response" of each sample is the name of the predicted class label, and ``label_probabilities`` holds the classifier's
+    probability of every class.
+
+    Args:
+        model (AutoModelForCausalLM): The LLM the classifier was trained on.
+        tokenizer (AutoTokenizer): The tokenizer to use. This should come with the LLM.
+        classifier (EmbeddingClassifier): The trained classifier. See ``train_embedding_classifier()``.
+        eval_dataset (Dataset): The evaluation dataset. Must be preprocessed (see ``finetune.preprocess_dataset()``).
+        eval_config (EvaluationConfig): Controls what instructions are given to the LLM before each sample.
+                                        Should be the same configuration the classifier was trained with.
+        batch_size (int, optional): How many samples to classify at once. The prediction time of each batch is split evenly
+                                    between its samples. Defaults to 8.
+        store_path (str, optional): If given, the embeddings are kept in an ``EmbeddingStore`` in this folder, so that evaluating
+                                    the same dataset again does not run the LLM. Defaults to None.
+        profiler (InferenceProfiler, optional): If given, records the time taken by each stage of every batch. Defaults to None.
+
+    Returns:
+        EvaluationResult: Raw evaluation data, including all samples, predicted/actual labels, and class probabilities.
+    """
+    start_time = time.perf_counter()
+
+    label_names = classifier.label_names + ["Unknown"]
+    texts, labels_true = _read_samples(eval_dataset, classifier.label_names)
+
+    store = None
+    if store_path is not None:
+        fingerprint = _get_embedding_fingerprint(model, tokenizer, eval_config, classifier.pooling, classifier.layer, texts)
+        store = EmbeddingStore(store_path, len(texts), model.config.hidden_size, fingerprint)
+
+    labels_pred = np.zeros(len(texts), dtype=np.int64)
+    label_probabilities = np.zeros((len(texts), len(label_names)), dtype=np.float64)
+    prediction_times = np.zeros(len(texts), dtype=np.float64)
+
+    for start in _progress_bar(range(0, len(texts), batch_size), desc="Evaluating model"):
+        rows = np.arange(start, min(start + batch_size, len(texts)))
+        batch_profile = profiler.batch(rows, model.device) if profiler is not None else nullcontext()
+
+        with batch_profile:
+            batch_start_time = time.perf_counter()
+
+            missing = store.get_missing_rows(rows) if store is not None else rows
+            if len(missing) > 0:
+                prompts = _build_prompts([texts[i] for i in missing], eval_config, tokenizer)
+                embeddings = embed_prompts(prompts, model, tokenizer, classifier.pooling, classifier.layer, batch_size, profiler)
+                if store is not None: store.write(missing, embeddings)
+
+            if store is not None: embeddings = store.embeddings[rows]
+
+            with profile_stage(profiler, "score"):
+                probabilities = classifier.predict_proba(embeddings)
+
+            labels_pred[rows] = np.argmax(probabilities, axis=1)
+            label_probabilities[rows, :-1] = probabilities
+            prediction_times[rows] = (time.perf_counter() - batch_start_time) / len(rows)
+
+    return EvaluationResult(
+        config=eval_config,
+        texts=texts,
+        labels_pred=labels_pred,
+        labels_true=labels_true,
+        label_names=label_names,
+        llm_responses=[label_names[i] for i in labels_pred],
+        prediction_times=prediction_times,
+        total_time_elapsed=time.perf_counter() - start_time,
+        label_probabilities=label_probabilities,
+        profile=profiler)
@@ -1,15 +1,34 @@
-from dataclasses import dataclass, asdict
-from datasets import Dataset
+from __future__ import annotations
+from dataclasses import dataclass, field, asdict, replace
+from datasets import Dataset, IterableDataset, load_from_disk
 from transformers import AutoModelForCausalLM, AutoTokenizer
-import os, shutil, re
-from tqdm.notebook import tqdm
-from sklearn.metrics import classification_report, ConfusionMatrixDisplay, confusion_matrix
-from matplotlib import pyplot as plt
+import os, shutil, re, itertools
 import finetune as ft
+from inference_cache import InferenceCache, fingerprint_model, fingerprint_tokenizer
+from inference_profiler import InferenceProfiler, profile_stage
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import numpy as np
-import time, json
+import time, json, hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from functools import lru_cache
+from contextlib import nullcontext
 from datetime import timedelta
+from typing import Iterator, TYPE_CHECKING
+
+# Plotting, metrics, retrieval and notebook progress bars are slow to import, so they are only imported when they are first used.
+if TYPE_CHECKING:
+    from few_shot import FewShotIndex
+
+def _progress_bar(*args, **kwargs):
+    """
+    Create a notebook progress bar. See ``tqdm.notebook.tqdm``.
+    """
+    from tqdm.notebook import tqdm
+    return tqdm(*args, **kwargs)
 
 @dataclass
 class EvaluationConfig:
@@ -27,35 +46,166 @@ class EvaluationConfig:
                           letters of the class label, but this is usually enough to identify
                           which label it selected. See ``_get_class_id_from_model_response()`` for implementation details.
         prompt (str, optional): Optional system prompt to give the LLM before each text sample. Use to provide the LLM with classification instructions. Leave empty for fine-tuned models.
+        method (str, optional): How the LLM should classify each sample. Defaults to "generate".
+                                - "generate": The LLM writes a response of up to ``max_tokens`` tokens, which is parsed for a class label.
+                                - "score": No text is generated. Instead, the log-likelihood of every class label name is computed
+                                  as a response to the prompt and the most likely label is selected. ``max_tokens`` is ignored.
+                                  This also records the probability of every class in ``EvaluationResult.label_probabilities``.
+                                - "constrained": The LLM may only write tokens which continue one of the class label names,
+                                  and stops as soon as its response identifies exactly one label. ``max_tokens`` is ignored.
+                                - "embedding": No text is generated. Instead, a classifier is trained on the LLM's hidden states.
+                                  Only supported by ``embedding_classifier.evaluate_embeddings()``. ``max_tokens`` is ignored.
+        few_shot_index (FewShotIndex, optional): If given, the ``shots`` most similar training examples of each class are retrieved
+                                                 for every sample and added to its prompt as previous chat turns, each answered with its class label.
+                                                 See ``few_shot.FewShotIndex``. Only its fingerprint is saved with results. Defaults to None.
+        shots (int, optional): How many examples of each class to add to each prompt if ``few_shot_index`` is given. Defaults to 1.
+        truncation (finetune.TruncationConfig, optional): If given, each text sample is truncated to a token budget before it is put into
+                                                          the prompt. The system prompt and few-shot examples are kept intact. Use the same
+                                                          configuration as ``finetune.preprocess_dataset()`` or ``finetune.TrainingDataConfig``
+                                                          so that the LLM sees the same inputs in training and evaluation. Defaults to None.
     """
     name : str
     max_tokens : int
     prompt : str | None = None
+    method : str = "generate"
+    few_shot_index : FewShotIndex | None = field(default=None, repr=False)
+    shots : int = 1
+    truncation : ft.TruncationConfig | None = None
     # extractor_method : func
         
+def _config_to_dict(eval_config : EvaluationConfig) -> dict:
+    """
+    Convert an evaluation configuration into a JSON-serialisable dictionary, replacing the few-shot index with its fingerprint.
+    """
+    config = asdict(replace(eval_config, few_shot_index=None))
+    if eval_config.few_shot_index is not None:
+        config["few_shot_index"] = eval_config.few_shot_index.fingerprint
+    return config
+
+def _config_from_dict(config : dict) -> EvaluationConfig:
+    """
+    Convert a dictionary made by ``_config_to_dict()`` back into an evaluation configuration. The few-shot index is not restored.
+    """
+    config = {key : value for key, value in config.items() if key != "few_shot_index"}
+    if config.get("truncation") is not None:
+        config["truncation"] = ft.TruncationConfig(**config["truncation"])
+    return EvaluationConfig(**config)
+
+def _as_column(values, dtype) -> np.ndarray:
+    """
+    Convert a sequence of per-sample values into a NumPy array, without copying it if it already is one.
+
+    Args:
+        values (Sequence): The values to convert.
+        dtype: The NumPy dtype to store the values as. Text columns use ``object``.
+
+    Returns:
+        column (np.ndarray): The values as an array.
+    """
+    if isinstance(values, np.ndarray) and values.dtype == dtype:
+        return values
+    if dtype == object:
+        # Build the array element by element so that NumPy never tries to split strings or nested sequences.
+        column = np.empty(len(values), dtype=object)
+        column[:] = list(values)
+        return column
+    return np.asarray(values, dtype=dtype)
+
 @dataclass
 class EvaluationResult:
     """
     Raw LLM text classification evaluation results produced from ``evaluate.evaluate()``.
 
+    Every per-sample field is stored as a column (a NumPy array), so results for large datasets stay compact,
+    can be saved to and memory-mapped from Parquet (see ``to_parquet()`` and ``load()``), and can be filtered without copying.
+    Lists passed to the constructor are converted to arrays.
+
     Args:
         config (EvaluationConfig): The instructions given to the LLM to classify each sample.
-        texts (list[str]): Every text sample in the evaluation dataset. (X_test)
-        labels_pred (list[int]): Predicted class ID (int) for each sample. (y_pred)
-        labels_true (list[int]): True class ID (int) for each sample. (y_true)
+        texts (np.ndarray | None): Every text sample in the evaluation dataset. (X_test)
+                                   None if the result stores ``text_indices`` instead.
+        labels_pred (np.ndarray): Predicted class ID (int) for each sample. (y_pred)
+        labels_true (np.ndarray): True class ID (int) for each sample, or -1 for samples without a label (e.g. raw text samples). (y_true)
         label_names (list[str]): List of all class label names.
-        llm_responses (list[str]): Raw LLM response to each sample.
-        prediction_times (list[float]): How long it took the LLM to classify each sample in seconds.
+        llm_responses (np.ndarray): Raw LLM response to each sample.
+        prediction_times (np.ndarray): How long it took the LLM to classify each sample in seconds.
         total_time_elapsed (float): How long the evaluation took to run overall in seconds.
+        label_probabilities (np.ndarray, optional): Probability of each class label for each sample, with shape ``(samples, labels)``.
+                                                    Only available if ``config.method`` is "score".
+        text_indices (np.ndarray, optional): Row of each sample in ``source_dataset``. Used instead of copying every text sample
+                                             into the result. See ``get_texts()``.
+        source_dataset (Dataset, optional): The evaluation dataset that ``text_indices`` refer to. It is not saved with the result.
+        truncated (np.ndarray, optional): Whether the text of each sample was truncated to fit ``config.truncation``.
+                                          Only available if ``config.truncation`` is given. See ``num_truncated``.
+        profile (InferenceProfiler, optional): Per-stage timings, token counts and peak memory usage of every batch, if the evaluation
+                                               was profiled. It is not saved to Parquet, but ``save()`` writes a summary and a trace of it.
     """
     config : EvaluationConfig
-    texts : list[str]
-    labels_pred : list[int]
-    labels_true : list[int]
+    texts : np.ndarray | None
+    labels_pred : np.ndarray
+    labels_true : np.ndarray
     label_names : list[str]
-    llm_responses : list[str]
-    prediction_times : list[float]
+    llm_responses : np.ndarray
+    prediction_times : np.ndarray
     total_time_elapsed : float
+    label_probabilities : np.ndarray | None = None
+    text_indices : np.ndarray | None = None
+    source_dataset : Dataset | None = field(default=None, repr=False, compare=False)
+    profile : InferenceProfiler | None = field(default=None, repr=False, compare=False)
+    truncated : np.ndarray | None = None
+
+    def __post_init__(self):
+        if self.texts is None and self.text_indices is None:
+            raise ValueError("Either texts or text_indices must be given.")
+
+        if self.texts is not None: self.texts = _as_column(self.texts, object)
+        if self.text_indices is not None: self.text_indices = _as_column(self.text_indices, np.int64)
+        self.labels_pred = _as_column(self.labels_pred, np.int64)
+        self.labels_true = _as_column(self.labels_true, np.int64)
+        self.llm_responses = _as_column(self.llm_responses, object)
+        self.prediction_times = _as_column(self.prediction_times, np.float64)
+        if self.label_probabilities is not None:
+            self.label_probabilities = _as_column(self.label_probabilities, np.float64)
+            if self.label_probabilities.ndim == 1 and len(self.labels_pred) > 0:
+                self.label_probabilities = self.label_probabilities.reshape(len(self.labels_pred), -1)
+        if self.truncated is not None: self.truncated = _as_column(self.truncated, np.bool_)
+
+    def __len__(self) -> int:
+        return len(self.labels_pred)
+
+    @property
+    def num_truncated(self) -> int:
+        """
+        How many samples had their text truncated to fit ``config.truncation``.
+        """
+        return int(self.truncated.sum()) if self.truncated is not None else 0
+
+    @property
+    def has_labels(self) -> np.ndarray:
+        """
+        Whether each sample has a true label. Samples without one are left out of ``save()``'s metrics and are never counted as incorrect.
+        """
+        return self.labels_true >= 0
+
+    def get_texts(self, rows : np.ndarray | slice | None = None) -> np.ndarray:
+        """
+        Return the text samples of the result, looking them up in ``source_dataset`` if the result only stores ``text_indices``.
+
+        Args:
+            rows (np.ndarray | slice, optional): Which samples of the result to return the texts of. Defaults to all samples.
+
+        Returns:
+            texts (np.ndarray): The text samples.
+        """
+        if self.texts is not None:
+            return self.texts if rows is None else self.texts[rows]
+
+        if self.source_dataset is None:
+            raise ValueError("This result stores text indices, but source_dataset was not given.")
+
+        indices = self.text_indices if rows is None else self.text_indices[rows]
+        messages = self.source_dataset.select(indices)['messages']
+        return _as_column([_parse_sample(sample)[0] for sample in messages], object)
 
     def get_answers(self, incorrect_only : bool = False) -> pd.DataFrame:
         """
@@ -66,25 +216,151 @@ class EvaluationResult:
 
         Returns:
             pd.DataFrame: A table containing each sample in the evaluation dataset, the LLM's response to each sample, and the predicted/actual labels.
+                          If the result stores ``text_indices`` and has no ``source_dataset``, the "Text Index" of each sample is given instead of its text.
         """
-        # Cast labels from int (class ID) -> str (class name)
-        y_pred = [self.label_names[id] for id in self.labels_pred]
-        y_true = [self.label_names[id] for id in self.labels_true]
-        
+        # Find the incorrect answers from the label columns alone, so only the selected rows of each column are ever copied.
+        rows = np.flatnonzero(self.has_labels & (self.labels_pred != self.labels_true)) if incorrect_only else slice(None)
+
+        # Cast labels from int (class ID) -> str (class name). Samples without a true label get None.
+        label_names = np.array(self.label_names + [None], dtype=object)
+
+        if self.texts is None and self.source_dataset is None:
+            texts = ("Text Index", self.text_indices[rows])
+        else: texts = ("Text", self.get_texts(rows))
+
         answers = {
-        "Text" : np.array(self.texts),
-        "Predicted Label" : np.array(y_pred),
-        "LLM Response" : np.array(self.llm_responses),
-        "True Label" : np.array(y_true),
-        "Prediction Time" : np.array(self.prediction_times)
+        texts[0] : texts[1],
+        "Predicted Label" : label_names[self.labels_pred[rows]],
+        "LLM Response" : self.llm_responses[rows],
+        "True Label" : label_names[self.labels_true[rows]],
+        "Prediction Time" : self.prediction_times[rows]
         }
-        
-        answers = pd.DataFrame(answers)
 
-        if incorrect_only: answers = answers.loc[answers['Predicted Label'] != answers['True Label']]
+        answers = pd.DataFrame(answers)
+        if incorrect_only: answers.index = rows
 
         return answers
-    
+
+    @staticmethod
+    def merge(results : list["EvaluationResult"], total_time_elapsed : float | None = None) -> "EvaluationResult":
+        """
+        Combine the results of evaluating several parts (shards) of a dataset into a single result.
+        Samples are kept in the order of ``results``.
+
+        Args:
+            results (list[EvaluationResult]): The results to combine. Must all use the same class label names.
+            total_time_elapsed (float, optional): How long the evaluation took to run overall in seconds.
+                                                  Defaults to the longest time taken by any of ``results``, since shards are usually evaluated in parallel.
+
+        Returns:
+            EvaluationResult: The combined result.
+        """
+        if len(results) == 0:
+            raise ValueError("At least one result must be given.")
+
+        for result in results:
+            if result.label_names != results[0].label_names:
+                raise ValueError("Cannot merge results with different class label names.")
+
+        if total_time_elapsed is None:
+            total_time_elapsed = max(result.total_time_elapsed for result in results)
+
+        label_probabilities = None
+        if all(result.label_probabilities is not None for result in results):
+            label_probabilities = np.concatenate([result.label_probabilities for result in results])
+
+        truncated = None
+        if all(result.truncated is not None for result in results):
+            truncated = np.concatenate([result.truncated for result in results])
+
+        return EvaluationResult(
+            config=results[0].config,
+            texts=np.concatenate([result.get_texts() for result in results]),
+            labels_pred=np.concatenate([result.labels_pred for result in results]),
+            labels_true=np.concatenate([result.labels_true for result in results]),
+            label_names=results[0].label_names,
+            llm_responses=np.concatenate([result.llm_responses for result in results]),
+            prediction_times=np.concatenate([result.prediction_times for result in results]),
+            total_time_elapsed=total_time_elapsed,
+            label_probabilities=label_probabilities,
+            truncated=truncated)
+
+    def to_parquet(self, path : str) -> None:
+        """
+        Save the raw evaluation data as a single Parquet file, with one row per sample.
+        The configuration, label names and total time elapsed are stored in the file's metadata.
+
+        Args:
+            path (str): The file to write.
+        """
+        columns = {}
+        if self.texts is not None: columns["text"] = pa.array(self.texts, type=pa.large_string())
+        if self.text_indices is not None: columns["text_index"] = pa.array(self.text_indices)
+        columns["label_pred"] = pa.array(self.labels_pred)
+        # Missing true labels are stored as nulls.
+        columns["label_true"] = pa.array(self.labels_true, mask=~self.has_labels)
+        columns["llm_response"] = pa.array(self.llm_responses, type=pa.large_string())
+        columns["prediction_time"] = pa.array(self.prediction_times)
+        if self.label_probabilities is not None:
+            columns["label_probabilities"] = pa.FixedSizeListArray.from_arrays(
+                pa.array(self.label_probabilities.ravel()), self.label_probabilities.shape[1]
+            )
+        if self.truncated is not None: columns["truncated"] = pa.array(self.truncated)
+
+        metadata = {
+            "config" : _config_to_dict(self.config),
+            "label_names" : self.label_names,
+            "total_time_elapsed" : self.total_time_elapsed
+        }
+        table = pa.table(columns).replace_schema_metadata({"evaluation_result" : json.dumps(metadata, ensure_ascii=False)})
+        pq.write_table(table, path)
+
+    @staticmethod
+    def load(path : str, source_dataset : Dataset | None = None) -> "EvaluationResult":
+        """
+        Load raw evaluation data saved by ``to_parquet()`` or ``save()``.
+
+        The file is memory-mapped, so numeric columns are read from the page cache instead of being copied into memory.
+
+        Args:
+            path (str): The Parquet file to read, or a folder containing a ``raw_output.parquet`` file produced by ``save()``.
+            source_dataset (Dataset, optional): The evaluation dataset, if the result stores ``text_indices``. Defaults to None.
+
+        Returns:
+            EvaluationResult: The loaded result.
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, "raw_output.parquet")
+
+        table = pq.read_table(path, memory_map=True)
+        metadata = json.loads(table.schema.metadata[b"evaluation_result"])
+
+        def column(name : str, dtype) -> np.ndarray | None:
+            if name not in table.column_names:
+                return None
+            return _as_column(table.column(name).to_numpy(), dtype)
+
+        labels_true = _as_column(table.column("label_true").fill_null(-1).to_numpy(), np.int64)
+
+        label_probabilities = None
+        if "label_probabilities" in table.column_names:
+            probabilities = table.column("label_probabilities").combine_chunks()
+            label_probabilities = probabilities.flatten().to_numpy().reshape(len(table), probabilities.type.list_size)
+
+        return EvaluationResult(
+            config=_config_from_dict(metadata["config"]),
+            texts=column("text", object),
+            labels_pred=column("label_pred", np.int64),
+            labels_true=labels_true,
+            label_names=metadata["label_names"],
+            llm_responses=column("llm_response", object),
+            prediction_times=column("prediction_time", np.float64),
+            total_time_elapsed=metadata["total_time_elapsed"],
+            label_probabilities=label_probabilities,
+            text_indices=column("text_index", np.int64),
+            source_dataset=source_dataset,
+            truncated=column("truncated", np.bool_))
+
     def get_time_elapsed(self) -> timedelta:
         """
         Return the total time elapsed running the evaluation.
@@ -106,20 +382,23 @@ class EvaluationResult:
         2. Classification report (``evaluation.csv``):
         Report of the LLM's accuracy, precision, recall, and F1 score for all classes.
         
-        3. LLM answer data (``answers.csv, answers_incorrect.csv``):
-        A table containing all LLM responses and a table containing only the incorrect responses.
+        3. Incorrect LLM answers (``incorrect_answers.csv``):
+        A table containing only the incorrect responses. All responses can be loaded from the raw data with ``get_answers()``.
 
-        4. Raw JSON data (``raw_output.json``):
-        Useful if you want to retrieve exact values from the output for future analysis.
+        4. Raw data (``raw_output.parquet``):
+        Useful if you want to retrieve exact values from the output for future analysis. Load it with ``EvaluationResult.load()``.
+
+        5. Inference profile (``profile_stages.csv``, ``profile_batches.csv``, ``profile_trace.json``):
+        Only produced if the evaluation was profiled (see ``profile``). The time spent in each stage of inference,
+        the token counts, throughput and peak memory usage of each batch, and a Chrome trace for flame chart viewers.
 
         Args:
             output_dir (str, optional): Which folder to save the results into. Defaults to "results".
         """
-        
-        # Make result name file safe
-        result_path_name = self.config.name.lower().strip().replace(" ", "_")
-        # Remove all non-alphanumeric characters
-        result_path_name = "".join(c for c in result_path_name if c.isalnum() or c in ["-", "_", " "])
+        from sklearn.metrics import classification_report, ConfusionMatrixDisplay, confusion_matrix
+        from matplotlib import pyplot as plt
+
+        result_path_name = _get_file_safe_name(self.config.name)
 
         if not output_dir:
             output_dir = result_path_name
@@ -128,12 +407,11 @@ class EvaluationResult:
         # shutil.rmtree(output_dir)
         os.makedirs(output_dir, exist_ok=True)
 
-        # Dump the EvaluationResult data as a JSON file into "<output_dir>/raw_output.json"
-        data = asdict(self)
-        with open( os.path.join(output_dir, "raw_output.json"), "w", encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        # Dump the EvaluationResult data as a Parquet file into "<output_dir>/raw_output.parquet"
+        self.to_parquet( os.path.join(output_dir, "raw_output.parquet") )
 
-        y_pred, y_true, label_names = self.labels_pred, self.labels_true, self.label_names
+        # Metrics can only be calculated for samples with a true label.
+        y_pred, y_true, label_names = self.labels_pred[self.has_labels], self.labels_true[self.has_labels], self.label_names
 
         # Calculate accuracy, precision, recall, and F1 score
         classif_report = classification_report(y_true, y_pred, zero_division=0.0, output_dict=True)
@@ -163,16 +441,133 @@ class EvaluationResult:
             disp.ax_.set_xticks([])
             disp.ax_.set_yticks([])
 
-        answers = self.get_answers(incorrect_only=False)
         incorrect_answers = self.get_answers(incorrect_only=True)
 
         classif_report.to_csv( os.path.join(output_dir, "evaluation.csv") )
-        answers.to_csv( os.path.join(output_dir, "answers.csv"), escapechar="\\" )
         incorrect_answers.to_csv( os.path.join(output_dir, "incorrect_answers.csv"), escapechar="\\" )
         plt.savefig( os.path.join(output_dir, "confusion_matrix.png"), dpi=200, bbox_inches='tight' )
 
+        if self.profile is not None:
+            self.profile.get_stage_summary().to_csv( os.path.join(output_dir, "profile_stages.csv") )
+            self.profile.get_batch_summary().to_csv( os.path.join(output_dir, "profile_batches.csv"), index=False )
+            self.profile.to_chrome_trace( os.path.join(output_dir, "profile_trace.json") )
+
         plt.show()
 
+def _get_file_safe_name(name : str) -> str:
+    """
+    Convert the name of an evaluation configuration into a string which is safe to use as a file name.
+
+    Args:
+        name (str): The name to convert, e.g., "Chain-of-Thought 2-shot".
+
+    Returns:
+        name (str): The file safe name, e.g., "chain-of-thought_2-shot".
+    """
+    # Make result name file safe
+    name = name.lower().strip().replace(" ", "_")
+    # Remove all non-alphanumeric characters
+    return "".join(c for c in name if c.isalnum() or c in ["-", "_", " "])
+
+class _EvaluationLog:
+    """
+    Append-only JSON Lines log of per-sample evaluation results.
+    Used by ``evaluate()`` to resume an evaluation which was interrupted.
+
+    Records are buffered and written to disk in batches of ``flush_size``.
+    A partially written final line (e.g. if the process was killed mid-write) is ignored when the log is loaded.
+
+    Args:
+        path (str): The log file to append to.
+        flush_size (int, optional): How many records to buffer before writing them to disk. Defaults to 32.
+    """
+    def __init__(self, path : str, flush_size : int = 32):
+        self.path = path
+        self.flush_size = flush_size
+        self._buffer = []
+
+    def load(self) -> dict[int, dict]:
+        """
+        Read every complete record in the log.
+
+        Returns:
+            records (dict[int, dict]): Each logged record, indexed by the row of its sample in the evaluation dataset.
+        """
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["index"]] = record
+        return records
+
+    def append(self, record : dict) -> None:
+        """
+        Add a record to the log, writing the buffered records to disk if the buffer is full.
+
+        Args:
+            record (dict): The record to add. Must contain the sample's row ``"index"``.
+        """
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write all buffered records to disk.
+        """
+        if len(self._buffer) == 0:
+            return
+
+        # Start on a new line in case the previous write was cut off.
+        needs_newline = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+
+        with open(self.path, "a", encoding="utf-8") as f:
+            if needs_newline: f.write("\n")
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in self._buffer)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._buffer = []
+
+def _get_checkpoint_path(checkpoint_dir : str, model : AutoModelForCausalLM, tokenizer : AutoTokenizer, eval_config : EvaluationConfig, label_names : list) -> str:
+    """
+    Return the path of the evaluation log for a model, tokenizer, evaluation configuration and label set.
+    Evaluating the same configuration with the same model always uses the same log, so a retrained adapter
+    or a different base model never resumes from the predictions of another model.
+
+    Args:
+        checkpoint_dir (str): The folder to store evaluation logs in.
+        model (AutoModelForCausalLM): The LLM being evaluated. See ``inference_cache.fingerprint_model()``.
+        tokenizer (AutoTokenizer): The tokenizer used by the LLM.
+        eval_config (EvaluationConfig): The evaluation configuration.
+        label_names (list): The class label names.
+
+    Returns:
+        path (str): The path of the evaluation log.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(fingerprint_model(model).encode("utf-8"))
+    fingerprint.update(fingerprint_tokenizer(tokenizer).encode("utf-8"))
+    fingerprint.update(json.dumps([_config_to_dict(eval_config), label_names], ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+
+    return os.path.join(checkpoint_dir, f"{_get_file_safe_name(eval_config.name)}-{fingerprint.hexdigest()[0:16]}.jsonl")
+
+def _hash_text(text : str) -> str:
+    """
+    Return a short hash of a text sample, used to check that a logged result belongs to the same sample.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[0:16]
+
 def _get_class_id_from_model_response(model_response : str, label_names : list) -> int:
     """
     After getting an LLM to perform text classification,
@@ -204,76 +599,576 @@ def _get_class_id_from_model_response(model_response : str, label_names : list)
         class_id (int): The predicted class ID, or the final class ID if the LLM did not answer with any class label.
     """
 
-    # Return a direct match if possible
-    try:
-        class_id = label_names.index(model_response)
-        return class_id
-    except Exception as e:
-        pass
-    
-    model_response = model_response.lower().strip()
-    
-    # If the response is an integer, return it if it's a valid class ID
-    if model_response.isdigit():
+    return _get_label_matcher(tuple(label_names)).match(model_response)
+
+class LabelMatcher:
+    """
+    Extracts class IDs from raw LLM outputs for a fixed list of class label names.
+
+    Gives identical results to ``_get_class_id_from_model_response()``, but all work that only depends
+    on ``label_names`` is done once when the matcher is created instead of on every call:
+    - Exact matches are looked up in a dict.
+    - Truncated class labels are matched by walking a prefix trie of the normalised label names.
+    - The RegEx used to find class labels within longer responses (e.g. CoT) is compiled once.
+
+    Args:
+        label_names (list): List of class label names with an additional final entry for unknown cases.
+    """
+    def __init__(self, label_names : list):
+        self.label_names = list(label_names)
+        self.unknown_id = len(self.label_names) - 1
+
+        # Exact matches. Like ``list.index()``, duplicate names resolve to their first position.
+        self._exact = {}
+        for i, label in enumerate(self.label_names):
+            self._exact.setdefault(label, i)
+
+        # Prefix trie of lowercase label names with spaces removed.
+        # Each node stores the lowest class ID of all labels which pass through it.
+        self._trie = {}
+        self._trie_root_id = 0 if len(self.label_names) > 0 else None
+        for i, label in enumerate(self.label_names):
+            node = self._trie
+            for char in label.lower().strip().replace(" ", ""):
+                child = node.setdefault(char, [{}, i])
+                node = child[0]
+
+        # RegEx which finds any class label name in a response.
         try:
-            class_id = int(model_response)
-            # The integer must be within the range of class IDs
-            if class_id >= 0 and class_id < len(label_names) - 2:
-                return class_id
-            else:
-                # If it isn't, just return the last label ("I don't know").
-                return len(label_names) - 1
+            self._pattern = re.compile("|".join(self.label_names).lower().replace(" ", r"\s*"))
         except Exception:
-            pass
-
-    # Match class labels if model_response is truncated.
-    # E.g., "mean" -> "meanoftransportation" -> 5
-    # This allows us to match labels even we don't
-    # have enough tokens to write the entire name.
-    # This allows us to optimise the evaluation
-    # procedure by using lower max tokens.
-    for i, label in enumerate(label_names):
-        
-        label = label.lower().strip()
-        response_trimmed = model_response.replace(" ", "")
-        label = label.replace(" ", "")
-        label_truncated = label[0:len(response_trimmed)]
+            self._pattern = None
 
-        if response_trimmed == label_truncated:
-            return i
-    
-    try:
-        # Concatenate all label names using boolean OR.
-        match = "|".join(label_names).lower().replace(" ", r"\s*")
-
-        # Find all instances of label name strings within the base string.
-        matches = re.findall(match, model_response)
-
-        # If the string contains at least one instance of a class label:
-        if len(matches) > 0:
-            # Get the last matching label from the string.
-            final_match = matches[-1]
-
-            # Remove all capitalisation, non-alphabetic characters, and whitespace
-            labels_sanitised = [re.sub("[^a-z]", "", label.lower()) for label in label_names]
-            match_sanitised = re.sub("[^a-z]", "", final_match.lower())
-            
-            # Return the matching class ID for the label.
-            class_id = labels_sanitised.index(match_sanitised)
+        # Class IDs of the labels with all capitalisation, non-alphabetic characters, and whitespace removed.
+        self._sanitised = {}
+        for i, label in enumerate(self.label_names):
+            self._sanitised.setdefault(re.sub("[^a-z]", "", label.lower()), i)
+
+    def _match_truncated(self, response_trimmed : str) -> int | None:
+        """
+        Return the ID of the first class label which starts with ``response_trimmed``, or None if there isn't one.
+        """
+        class_id = self._trie_root_id
+        node = self._trie
+        for char in response_trimmed:
+            if char not in node:
+                return None
+            node, class_id = node[char]
+        return class_id
+
+    def match(self, model_response : str) -> int:
+        """
+        Extract the class ID from a raw LLM output. See ``_get_class_id_from_model_response()`` for details.
+
+        Args:
+            model_response (str): The raw LLM output, ideally containing a class label.
+
+        Returns:
+            class_id (int): The predicted class ID, or the final class ID if the LLM did not answer with any class label.
+        """
+        # Return a direct match if possible
+        class_id = self._exact.get(model_response)
+        if class_id is not None:
             return class_id
-            
-    except Exception:
-        pass
-    
-    # If no class label is found in the LLM text, return the last label ("I don't know").
-    return len(label_names) - 1
+
+        model_response = model_response.lower().strip()
+
+        # If the response is an integer, return it if it's a valid class ID
+        if model_response.isdigit():
+            try:
+                class_id = int(model_response)
+                # The integer must be within the range of class IDs
+                if class_id >= 0 and class_id < len(self.label_names) - 2:
+                    return class_id
+                else:
+                    # If it isn't, just return the last label ("I don't know").
+                    return self.unknown_id
+            except Exception:
+                pass
+
+        # Match class labels if model_response is truncated.
+        # E.g., "mean" -> "meanoftransportation" -> 5
+        class_id = self._match_truncated(model_response.replace(" ", ""))
+        if class_id is not None:
+            return class_id
+
+        if self._pattern is not None:
+            # Find all instances of label name strings within the response.
+            matches = self._pattern.findall(model_response)
+
+            # If the string contains at least one instance of a class label,
+            # return the matching class ID for the last one.
+            if len(matches) > 0:
+                final_match = matches[-1]
+                try:
+                    class_id = self._sanitised.get(re.sub("[^a-z]", "", final_match.lower()))
+                except Exception:
+                    class_id = None
+                if class_id is not None:
+                    return class_id
+
+        # If no class label is found in the LLM text, return the last label ("I don't know").
+        return self.unknown_id
+
+    def match_many(self, model_responses : list[str]) -> list[int]:
+        """
+        Extract the class ID from many raw LLM outputs. Each distinct response is only matched once.
+
+        Args:
+            model_responses (list[str]): The raw LLM outputs.
+
+        Returns:
+            class_ids (list[int]): The predicted class ID for each response.
+        """
+        class_ids = {response : self.match(response) for response in set(model_responses)}
+        return [class_ids[response] for response in model_responses]
+
+@lru_cache(maxsize=32)
+def _get_label_matcher(label_names : tuple) -> LabelMatcher:
+    """
+    Return a ``LabelMatcher`` for ``label_names``, reusing a previously built one if possible.
+    """
+    return LabelMatcher(label_names)
+
+def _build_prompt(text : str, eval_config : EvaluationConfig, examples : list[tuple[str, str]] | None = None) -> list[dict]:
+    """
+    Build the chat template used to classify a single text sample.
+
+    Args:
+        text (str): The text sample to classify.
+        eval_config (EvaluationConfig): Controls what instructions to give to the LLM.
+        examples (list[tuple[str, str]], optional): The text and label name of each few-shot example to add before the sample. Defaults to None.
+
+    Returns:
+        prompt (list[dict]): The classification prompt in chat template format.
+    """
+    prompt = [
+        {"role":"system", "content":eval_config.prompt},
+        {"role":"user", "content":text}
+    ]
+    # Remove the system prompt from the chat template if none was specified
+    if eval_config.prompt is None or eval_config.prompt == "":
+        prompt.pop(0)
+
+    # Show the LLM how each example should be answered before it answers the sample.
+    if examples is not None:
+        turns = [turn for example_text, example_label in examples for turn in
+                 ({"role":"user", "content":example_text}, {"role":"assistant", "content":example_label})]
+        prompt[-1:-1] = turns
+    return prompt
+
+def _build_truncated_prompts(texts : list[str], eval_config : EvaluationConfig, tokenizer : AutoTokenizer | None = None) -> tuple[list[list[dict]], list[bool]]:
+    """
+    Build the chat template used to classify each text sample, retrieving the few-shot examples of every sample at once
+    if ``eval_config.few_shot_index`` is given. See ``_build_prompt()``.
+
+    If ``eval_config.truncation`` is given, each text sample is truncated first (see ``finetune.truncate_texts()``),
+    which needs the tokenizer. Few-shot examples are retrieved for the truncated text, which is what the LLM sees.
+
+    Returns:
+        prompts (list[list[dict]]): The classification prompt of each text sample.
+        truncated (list[bool]): Whether each text sample was truncated.
+    """
+    if eval_config.truncation is not None:
+        if tokenizer is None:
+            raise ValueError("A tokenizer is required to truncate text samples. See EvaluationConfig.truncation.")
+        texts, truncated = ft.truncate_texts(texts, tokenizer, eval_config.truncation)
+    else: truncated = [False] * len(texts)
+
+    if eval_config.few_shot_index is None or len(texts) == 0:
+        return [_build_prompt(text, eval_config) for text in texts], truncated
+
+    examples = eval_config.few_shot_index.get_examples(texts, k=eval_config.shots)
+    return [_build_prompt(text, eval_config, sample_examples) for text, sample_examples in zip(texts, examples)], truncated
+
+def _build_prompts(texts : list[str], eval_config : EvaluationConfig, tokenizer : AutoTokenizer | None = None) -> list[list[dict]]:
+    """
+    Build the chat template used to classify each text sample. See ``_build_truncated_prompts()``.
+    """
+    return _build_truncated_prompts(texts, eval_config, tokenizer)[0]
+
+@dataclass
+class SampleResult:
+    """
+    Evaluation result for a single text sample, produced by ``evaluate_iter()``.
+
+    Args:
+        index (int): Position of the sample in the evaluation dataset.
+        text (str): The text sample. (X)
+        label_pred (int): Predicted class ID. (y_pred)
+        label_true (int | None): True class ID, or None if the sample has no label. (y_true)
+        llm_response (str): Raw LLM response to the sample.
+        prediction_time (float): How long it took the LLM to classify the sample in seconds.
+        label_probabilities (list[float], optional): Probability of each class label. Only available if ``config.method`` is "score".
+        from_checkpoint (bool, optional): Whether the result was restored from the log of a previous run instead of being evaluated.
+        truncated (bool, optional): Whether the text sample was truncated to fit ``EvaluationConfig.truncation``.
+    """
+    index : int
+    text : str
+    label_pred : int
+    label_true : int | None
+    llm_response : str
+    prediction_time : float
+    label_probabilities : list[float] | None = None
+    from_checkpoint : bool = False
+    truncated : bool = False
+
+def _parse_sample(sample) -> tuple[str, str | None]:
+    """
+    Get the text (X) and label name (y) of a single sample from an evaluation dataset.
+
+    Args:
+        sample (str | list | dict): Either a raw text sample, a conversation in conversational format,
+                                    or a row of a preprocessed dataset with a ``messages`` column.
+
+    Returns:
+        text (str): The text sample.
+        label (str | None): The label name, or None if the sample has no label.
+    """
+    if type(sample) is str:
+        return (sample.strip(), None)
+
+    if isinstance(sample, dict):
+        sample = sample['messages']
+
+    label = sample[-1]['content'] if len(sample) > 1 else None
+    return (sample[0]['content'].strip(), label)
+
+def _iter_sample_chunks(eval_dataset, chunk_size : int):
+    """
+    Read an evaluation dataset in chunks of ``chunk_size`` samples, without loading all of it into memory.
+
+    Args:
+        eval_dataset (Dataset | IterableDataset | Iterable): The evaluation dataset. See ``evaluate_iter()``.
+        chunk_size (int): How many samples to read at once.
+
+    Yields:
+        chunk (list[tuple[str, str | None, finetune.TokenizedPrompt | None]]): The text, label name, and tokenized prompt of each sample in the chunk.
+                                                                              The tokenized prompt is None unless the dataset was prepared
+                                                                              with ``prepare_eval_dataset()``.
+    """
+    if isinstance(eval_dataset, (Dataset, IterableDataset)):
+        for rows in eval_dataset.iter(batch_size=chunk_size):
+            samples = [_parse_sample(messages) for messages in rows['messages']]
+
+            if "input_ids" in rows:
+                truncated = rows['truncated'] if "truncated" in rows else [False] * len(samples)
+                tokenized_prompts = [
+                    ft.TokenizedPrompt(text=text, input_ids=input_ids, prefix_length=prefix_length, truncated=is_truncated)
+                    for text, input_ids, prefix_length, is_truncated in zip(rows['prompt'], rows['input_ids'], rows['prefix_length'], truncated)
+                ]
+            else: tokenized_prompts = [None] * len(samples)
+
+            yield [(text, label, tokenized_prompt) for (text, label), tokenized_prompt in zip(samples, tokenized_prompts)]
+        return
+
+    samples = iter(eval_dataset)
+    while True:
+        chunk = list(itertools.islice(samples, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield [_parse_sample(sample) + (None,) for sample in chunk]
+
+def _get_preparation_fingerprint(tokenizer : AutoTokenizer, eval_dataset : Dataset, eval_config : EvaluationConfig) -> str:
+    """
+    Return a fingerprint of everything which affects the output of ``prepare_eval_dataset()``.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(fingerprint_tokenizer(tokenizer).encode("utf-8"))
+    fingerprint.update(json.dumps(_config_to_dict(eval_config), ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    fingerprint.update(eval_dataset._fingerprint.encode("utf-8"))
+    return fingerprint.hexdigest()[0:16]
+
+def _prepare_samples(rows : dict, tokenizer : AutoTokenizer, eval_config : EvaluationConfig) -> dict:
+    """
+    Build and tokenize the classification prompt of every sample in a batch of rows. See ``prepare_eval_dataset()``.
+    """
+    prompts, truncated = _build_truncated_prompts([_parse_sample(messages)[0] for messages in rows['messages']], eval_config, tokenizer)
+    tokenized_prompts = ft.tokenize_prompts(prompts, tokenizer)
+
+    return {
+        "prompt" : [prompt.text for prompt in tokenized_prompts],
+        "prefix_length" : [prompt.prefix_length for prompt in tokenized_prompts],
+        "input_ids" : [prompt.input_ids for prompt in tokenized_prompts],
+        "length" : [len(prompt.input_ids) for prompt in tokenized_prompts],
+        "truncated" : truncated
+    }
+
+def prepare_eval_dataset(
+    tokenizer : AutoTokenizer,
+    eval_dataset : Dataset,
+    eval_config : EvaluationConfig,
+    cache_dir : str | None = None,
+    batch_size : int = 1000,
+    num_proc : int | None = None
+    ) -> Dataset:
+    """
+    Build the classification prompt of every sample in an evaluation dataset, apply the chat template, and tokenize it ahead of time.
+
+    The prepared dataset has five extra columns: ``prompt`` (the formatted prompt), ``prefix_length``, ``input_ids``, ``length``
+    and ``truncated`` (see ``EvaluationConfig.truncation``).
+    Passing it to ``evaluate()`` or ``evaluate_iter()`` with the same tokenizer and configuration
+    skips all prompt formatting and tokenization while evaluating.
+
+    Args:
+        tokenizer (AutoTokenizer): The tokenizer to use. This should come with the LLM.
+        eval_dataset (Dataset): The evaluation dataset. Must be preprocessed (see ``finetune.preprocess_dataset()``).
+        eval_config (EvaluationConfig): The evaluation configuration to build prompts for.
+        cache_dir (str, optional): If given, the prepared dataset is saved in this folder under a fingerprint of the tokenizer,
+                                   configuration and dataset. Preparing the same dataset again loads it from disk instead. Defaults to None.
+        batch_size (int, optional): How many samples to tokenize at once. Defaults to 1000.
+        num_proc (int, optional): How many processes to tokenize with. Defaults to None (a single process).
+
+    Returns:
+        prepared_dataset (Dataset): The evaluation dataset with its tokenized prompts.
+    """
+    fingerprint = _get_preparation_fingerprint(tokenizer, eval_dataset, eval_config)
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f"{_get_file_safe_name(eval_config.name)}-{fingerprint}")
+        if os.path.isdir(path):
+            return load_from_disk(path)
+
+    prepared_dataset = eval_dataset.map(
+        _prepare_samples,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc,
+        fn_kwargs={"tokenizer" : tokenizer, "eval_config" : eval_config},
+        new_fingerprint=fingerprint,
+        desc="Tokenizing prompts"
+    )
+
+    if path is not None:
+        # Save into a temporary folder first so that an interrupted save is never loaded.
+        temp_path = path + ".tmp"
+        if os.path.isdir(temp_path): shutil.rmtree(temp_path)
+        prepared_dataset.save_to_disk(temp_path)
+        os.replace(temp_path, path)
+        prepared_dataset = load_from_disk(path)
+
+    return prepared_dataset
+
+def evaluate_iter(
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    label_names : list,
+    eval_dataset,
+    eval_config : EvaluationConfig,
+    batch_size : int = 1,
+    prefix_cache : ft.PrefixCache | None = None,
+    checkpoint_dir : str | None = None,
+    cache : InferenceCache | None = None,
+    chunk_size : int = 1024,
+    profiler : InferenceProfiler | None = None
+    ) -> Iterator[SampleResult]:
+    """
+    Evaluate an LLM's text classification performance one chunk of samples at a time, yielding each result as soon as it is ready.
+
+    Unlike ``evaluate()``, the dataset is never loaded into memory all at once, so this works with
+    streaming datasets and datasets which are too large to fit into memory.
+    An "Unknown" class label is added to the end of the label names (see ``_get_class_id_from_model_response()``),
+    but unlike ``evaluate()``, ``label_names`` itself is not modified.
+
+    Args:
+        model (AutoModelForCausalLM): The LLM to use. It can be pre-trained or fine-tuned.
+        tokenizer (AutoTokenizer): The tokenizer to use. This should come with the LLM.
+        label_names (list): The name of each class label in the evaluation dataset.
+        eval_dataset (Dataset | IterableDataset | Iterable): The samples to classify. Either a preprocessed ``Dataset`` or ``IterableDataset``
+                                                            (see ``finetune.preprocess_dataset()``), or any iterable of raw text samples
+                                                            or conversations. Raw text samples have no true label. Datasets prepared with
+                                                            ``prepare_eval_dataset()`` are not tokenized again.
+        eval_config (EvaluationConfig): Controls what instructions to give to the LLM to classify each sample.
+        batch_size (int, optional): How many samples to classify at once. See ``evaluate()``. Defaults to 1.
+        prefix_cache (finetune.PrefixCache, optional): See ``evaluate()``. Defaults to None.
+        checkpoint_dir (str, optional): See ``evaluate()``. Defaults to None.
+        cache (InferenceCache, optional): See ``evaluate()``. Defaults to None.
+        chunk_size (int, optional): How many samples to read from ``eval_dataset`` at once. Samples are only grouped
+                                    by length within each chunk. Defaults to 1024.
+        profiler (InferenceProfiler, optional): See ``evaluate()``. Defaults to None.
+
+    Yields:
+        SampleResult: The evaluation result for each sample. Within each chunk, results are yielded in the order
+                      they finish, which is not necessarily the order of the dataset. Use ``SampleResult.index`` to reorder them.
+    """
+
+    if eval_config.method == "embedding":
+        raise ValueError("The embedding method needs a trained classifier. Use embedding_classifier.evaluate_embeddings() instead.")
+    if eval_config.method not in ["generate", "score", "constrained"]:
+        raise ValueError(f"Unknown evaluation method: {eval_config.method}")
+
+    # Add an "I don't know" label to the end of the label names list.
+    # We will need this as a fallback if the LLM does not provide a
+    # class label in its answer.
+    label_names = list(label_names) + ["Unknown"]
+
+    # Build the class label lookup tables once for the whole evaluation
+    label_matcher = LabelMatcher(label_names)
+
+    # Load the results of every sample which was already evaluated by a previous run.
+    evaluation_log = None
+    logged_records = {}
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        evaluation_log = _EvaluationLog(_get_checkpoint_path(checkpoint_dir, model, tokenizer, eval_config, label_names))
+        logged_records = evaluation_log.load()
+
+    try:
+        total = len(eval_dataset)
+    except TypeError:
+        total = None
+
+    start_index = 0
+    checked_preparation = False
+
+    try:
+        with _progress_bar(total=total, desc="Evaluating model") as progress:
+            for chunk in _iter_sample_chunks(eval_dataset, chunk_size):
+                indices = range(start_index, start_index + len(chunk))
+                start_index += len(chunk)
+
+                texts = {i : text for i, (text, _, _) in zip(indices, chunk)}
+                tokenized_prompts = {i : tokenized_prompt for i, (_, _, tokenized_prompt) in zip(indices, chunk) if tokenized_prompt is not None}
+
+                # A prepared dataset must have been prepared for the same prompt and tokenizer.
+                if not checked_preparation and len(tokenized_prompts) > 0:
+                    i = next(iter(tokenized_prompts))
+                    if tokenized_prompts[i].text != ft._format_prompt(_build_prompts([texts[i]], eval_config, tokenizer)[0], tokenizer):
+                        raise ValueError("eval_dataset was prepared with a different prompt or tokenizer. See prepare_eval_dataset().")
+                    checked_preparation = True
+
+                # Get the class label IDs (y_true) of the samples in the chunk
+                labels_true = {}
+                labelled = [(i, label) for i, (_, label, _) in zip(indices, chunk) if label is not None]
+                for (i, _), label_true in zip(labelled, label_matcher.match_many([label for _, label in labelled])):
+                    labels_true[i] = label_true
+
+                # Restore every sample which was already logged for the same text.
+                remaining = []
+                for i in indices:
+                    record = logged_records.get(i)
+                    if record is not None and record.get("text_hash") == _hash_text(texts[i]):
+                        progress.update(1)
+                        yield SampleResult(
+                            index=i,
+                            text=texts[i],
+                            label_pred=record["label_pred"],
+                            label_true=labels_true.get(i),
+                            llm_response=record["llm_response"],
+                            prediction_time=record["prediction_time"],
+                            label_probabilities=record.get("label_probabilities"),
+                            from_checkpoint=True,
+                            truncated=record.get("truncated", False))
+                    else: remaining.append(i)
+
+                # Generate a classification prompt for every remaining sample, unless the dataset already has one.
+                # Each prompt is templated and tokenized only once here, and then passed on as a ``TokenizedPrompt``.
+                untokenized = [i for i in remaining if i not in tokenized_prompts]
+                with profile_stage(profiler, "template"):
+                    untokenized_prompts, untokenized_truncated = _build_truncated_prompts([texts[i] for i in untokenized], eval_config, tokenizer)
+                with profile_stage(profiler, "tokenize"):
+                    untokenized_prompts = ft.tokenize_prompts(untokenized_prompts, tokenizer)
+                prompts = {i : replace(prompt, truncated=is_truncated) for i, prompt, is_truncated in zip(untokenized, untokenized_prompts, untokenized_truncated)}
+                prompts.update({i : tokenized_prompts[i] for i in remaining if i in tokenized_prompts})
+                truncated = {i : prompts[i].truncated for i in remaining}
+
+                # Group samples of similar length together to reduce padding.
+                lengths = [len(prompts[i].input_ids) for i in remaining]
+                batches = [[remaining[j] for j in batch] for batch in ft._bucket_by_length(lengths, batch_size)]
+
+                for batch in batches:
+                    batch_profile = profiler.batch(batch, model.device) if profiler is not None else nullcontext()
+                    with batch_profile:
+                        batch_start_time = time.perf_counter()
+
+                        labels_pred = {}
+                        llm_responses = {}
+                        label_probabilities = {}
+
+                        if eval_config.method == "score":
+                            # Score every class label (excluding "Unknown") as a response to each sample
+                            scores = ft.score_labels(
+                                            prompts=[prompts[i] for i in batch], label_names=label_names[:-1],
+                                            model=model, tokenizer=tokenizer,
+                                            batch_size = len(batch),
+                                            cache = cache,
+                                            profiler = profiler
+                                            )
+
+                            # Normalise the log-likelihoods into a probability distribution over the classes
+                            probabilities = np.exp(scores - scores.max(axis=1, keepdims=True))
+                            probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+                            for i, probs in zip(batch, probabilities):
+                                class_id = int(np.argmax(probs))
+                                labels_pred[i] = class_id
+                                llm_responses[i] = label_names[class_id]
+                                # "Unknown" can never be predicted, so its probability is always 0
+                                label_probabilities[i] = probs.tolist() + [0.0]
+                        else:
+                            # Get the LLM to generate an answer for every sample in the batch.
+                            # Constrained answers are always the full name of a class label (excluding "Unknown").
+                            responses = ft.generate_batch(
+                                                prompts=[prompts[i] for i in batch], model=model, tokenizer=tokenizer,
+                                                max_new_tokens = eval_config.max_tokens,
+                                                batch_size = len(batch),
+                                                prefix_cache = prefix_cache,
+                                                label_names = label_names[:-1] if eval_config.method == "constrained" else None,
+                                                cache = cache,
+                                                profiler = profiler
+                                                )
+
+                            with profile_stage(profiler, "parse"):
+                                for i, response in zip(batch, responses):
+                                    # Extract the class ID from the LLM's answer if one exists
+                                    labels_pred[i] = label_matcher.match(response)
+                                    llm_responses[i] = response
+
+                    # Split the time taken by the batch evenly between its samples.
+                    prediction_time = (time.perf_counter() - batch_start_time) / len(batch)
+
+                    for i in batch:
+                        if evaluation_log is not None:
+                            evaluation_log.append({
+                                "index" : i,
+                                "text_hash" : _hash_text(texts[i]),
+                                "label_pred" : labels_pred[i],
+                                "llm_response" : llm_responses[i],
+                                "prediction_time" : prediction_time,
+                                "label_probabilities" : label_probabilities.get(i),
+                                "truncated" : truncated[i]
+                            })
+
+                    progress.update(len(batch))
+
+                    for i in batch:
+                        yield SampleResult(
+                            index=i,
+                            text=texts[i],
+                            label_pred=labels_pred[i],
+                            label_true=labels_true.get(i),
+                            llm_response=llm_responses[i],
+                            prediction_time=prediction_time,
+                            label_probabilities=label_probabilities.get(i),
+                            truncated=truncated[i])
+    finally:
+        # Keep every finished sample on disk, even if the evaluation was interrupted.
+        if evaluation_log is not None:
+            evaluation_log.flush()
 
 def evaluate(
     model : AutoModelForCausalLM,
     tokenizer : AutoTokenizer,
     label_names : list,
     eval_dataset : Dataset,
-    eval_config : EvaluationConfig
+    eval_config : EvaluationConfig,
+    batch_size : int = 1,
+    prefix_cache : ft.PrefixCache | None = None,
+    checkpoint_dir : str | None = None,
+    cache : InferenceCache | None = None,
+    store_texts : bool = True,
+    profiler : InferenceProfiler | None = None
     ) -> EvaluationResult:
     """
     Evaluate an LLM's text classification performance on a supervised dataset.
@@ -282,67 +1177,214 @@ def evaluate(
         model (AutoModelForCausalLM): The LLM to use. It can be pre-trained or fine-tuned.
         tokenizer (AutoTokenizer): The tokenizer to use. This should come with the LLM.
         label_names (list): The name of each class label in the evaluation dataset.
-        eval_dataset (Dataset): The evaluation dataset. Must be preprocessed (see ``finetune.preprocess_dataset()``).
+        eval_dataset (Dataset | IterableDataset): The evaluation dataset. Must be preprocessed (see ``finetune.preprocess_dataset()``).
+                                                  If it was also prepared with ``prepare_eval_dataset()`` for the same tokenizer and configuration,
+                                                  its ready-made token IDs are used instead of tokenizing every prompt again.
         eval_config (EvaluationConfig): Controls what instructions to give to the LLM to classify each sample.
+        batch_size (int, optional): How many samples to classify at once. Samples are grouped by token length
+                                    to minimise padding, and the prediction time of each batch is split evenly
+                                    between its samples. Defaults to 1.
+        prefix_cache (finetune.PrefixCache, optional): If given, the system prompt shared by every sample is only prefilled
+                                                       once and its KV cache is reused for each sample. Not used when
+                                                       ``eval_config.method`` is "score". Defaults to None.
+        checkpoint_dir (str, optional): If given, the result for each sample is appended to a log file in this folder as the
+                                        evaluation runs. If the evaluation is interrupted, running it again with the same
+                                        model, tokenizer, configuration and dataset skips every sample which was already logged.
+                                        The prediction times of logged samples are included in ``total_time_elapsed``. Defaults to None.
+        cache (InferenceCache, optional): If given, the LLM's output for each sample is looked up in and saved to this cache,
+                                          so samples which were evaluated before with the same model, prompt and settings
+                                          are not run through the LLM again. Defaults to None.
+        store_texts (bool, optional): Whether to copy every text sample into the result. If False, the result stores the row of each
+                                      sample in ``eval_dataset`` instead (see ``EvaluationResult.text_indices``), which keeps
+                                      results for large datasets small. Only supported if ``eval_dataset`` is a ``Dataset``. Defaults to True.
+        profiler (InferenceProfiler, optional): If given, records how long each stage of inference takes for every batch, along with
+                                                token counts and peak memory usage. It is stored in ``EvaluationResult.profile``. Defaults to None.
 
     Returns:
         EvaluationResult: Raw evaluation data, including all samples, predicted/actual labels, and the LLM's response for each sample.
     """
 
+    if not store_texts and not isinstance(eval_dataset, Dataset):
+        raise ValueError("store_texts=False requires eval_dataset to be a Dataset, so that samples can be looked up by row.")
+
+    # Start logging how long the evaluation takes to run.
+    start_time = time.perf_counter()
+
+    results = list(evaluate_iter(
+        model, tokenizer,
+        label_names=label_names,
+        eval_dataset=eval_dataset,
+        eval_config=eval_config,
+        batch_size=batch_size,
+        prefix_cache=prefix_cache,
+        checkpoint_dir=checkpoint_dir,
+        cache=cache,
+        profiler=profiler
+    ))
+
+    # Include the time taken to evaluate samples restored from a previous run.
+    total_time_elapsed = time.perf_counter() - start_time
+    total_time_elapsed += sum(result.prediction_time for result in results if result.from_checkpoint)
+
+    # Put the results back into the order of the dataset.
+    results.sort(key=lambda result : result.index)
+
     # Add an "I don't know" label to the end of the label names list.
     # We will need this as a fallback if the LLM does not provide a
     # class label in its answer.
     label_names.append("Unknown")
 
-    labels_pred = []
-    llm_responses = []
+    label_probabilities = None
+    if eval_config.method == "score":
+        label_probabilities = np.array([result.label_probabilities for result in results], dtype=np.float64)
 
-    # Get all text inputs (X) in eval_dataset
-    texts = [message[0]['content'].strip() for message in eval_dataset['messages']]
+    return EvaluationResult(
+        config=eval_config,
+        texts=[result.text for result in results] if store_texts else None,
+        labels_pred=np.fromiter((result.label_pred for result in results), dtype=np.int64, count=len(results)),
+        labels_true=np.fromiter((result.label_true if result.label_true is not None else -1 for result in results), dtype=np.int64, count=len(results)),
+        label_names=label_names,
+        llm_responses=[result.llm_response for result in results],
+        prediction_times=np.fromiter((result.prediction_time for result in results), dtype=np.float64, count=len(results)),
+        total_time_elapsed=total_time_elapsed,
+        label_probabilities=label_probabilities,
+        text_indices=None if store_texts else np.arange(len(results)),
+        source_dataset=None if store_texts else eval_dataset,
+        profile=profiler,
+        truncated=np.fromiter((result.truncated for result in results), dtype=np.bool_, count=len(results)) if eval_config.truncation is not None else None)
 
-    # Start logging how long the evaluation takes to run.
-    time_elapsed = [time.time()]
+@dataclass
+class WorkerStats:
+    """
+    Throughput of a single worker process in ``evaluate_sharded()``.
 
-    # For every sample:
-    for text in tqdm(texts, "Evaluating model"):
-        
-        # Generate a classification prompt for the sample
-        prompt = [
-            {"role":"system", "content":eval_config.prompt},
-            {"role":"user", "content":text}
-        ]
-        # Remove the system prompt from the chat template if none was specified
-        if eval_config.prompt is None or eval_config.prompt == "":
-            prompt.pop(0)
-
-        # Get the LLM to generate an answer
-        response = ft.generate(
-                            prompt=prompt, model=model, tokenizer=tokenizer,
-                            max_new_tokens = eval_config.max_tokens
-                            )
-        
-        # Extract the class ID from the LLM's answer if one exists
-        pred_class = _get_class_id_from_model_response(response, label_names)
+    Args:
+        worker (int): The index of the worker (and of its shard).
+        num_samples (int): How many samples the worker evaluated.
+        num_threads (int): How many intra-op threads the worker was allowed to use.
+        load_time (float): How long it took the worker to load its model in seconds.
+        evaluation_time (float): How long it took the worker to evaluate its shard in seconds.
+        samples_per_second (float): How many samples the worker evaluated per second, excluding ``load_time``.
+    """
+    worker : int
+    num_samples : int
+    num_threads : int
+    load_time : float
+    evaluation_time : float
+    samples_per_second : float
 
-        labels_pred.append(pred_class)
-        llm_responses.append(response)
+def _evaluate_shard(
+    worker : int,
+    model_loader,
+    label_names : list,
+    eval_dataset : Dataset,
+    eval_config : EvaluationConfig,
+    num_threads : int,
+    batch_size : int,
+    checkpoint_dir : str | None,
+    cache_path : str | None,
+    use_prefix_cache : bool
+    ) -> tuple[EvaluationResult, WorkerStats]:
+    """
+    Evaluate a single shard of a dataset inside a worker process. See ``evaluate_sharded()``.
+    """
+    torch.set_num_threads(num_threads)
 
-        # Add each iteration to the time taken.
-        time_elapsed.append(time.time())
+    load_start_time = time.perf_counter()
+    model, tokenizer = model_loader()
+    load_time = time.perf_counter() - load_start_time
 
-    total_time_elapsed = time_elapsed[-1] - time_elapsed[0]
-    prediction_times = list(np.diff(time_elapsed))
+    result = evaluate(
+        model, tokenizer,
+        label_names=label_names,
+        eval_dataset=eval_dataset,
+        eval_config=eval_config,
+        batch_size=batch_size,
+        prefix_cache=ft.PrefixCache() if use_prefix_cache else None,
+        checkpoint_dir=checkpoint_dir,
+        cache=InferenceCache(cache_path) if cache_path is not None else None
+    )
 
-    # Get all class label IDs (y_true) in eval_dataset
-    groundtruth = [message[-1]['content'] for message in eval_dataset['messages']]
-    labels_true = [_get_class_id_from_model_response(label, label_names) for label in groundtruth]
+    stats = WorkerStats(
+        worker=worker,
+        num_samples=len(result),
+        num_threads=num_threads,
+        load_time=load_time,
+        evaluation_time=result.total_time_elapsed,
+        samples_per_second=len(result) / result.total_time_elapsed if result.total_time_elapsed > 0 else 0.0
+    )
+    return (result, stats)
 
-    return EvaluationResult(
-        config=eval_config,
-        texts=texts,
-        labels_pred=labels_pred,
-        labels_true=labels_true,
-        label_names=label_names,
-        llm_responses=llm_responses,
-        prediction_times=prediction_times,
-        total_time_elapsed=total_time_elapsed)
+def evaluate_sharded(
+    model_loader,
+    label_names : list,
+    eval_dataset : Dataset,
+    eval_config : EvaluationConfig,
+    num_workers : int = 2,
+    threads_per_worker : int | None = None,
+    batch_size : int = 1,
+    checkpoint_dir : str | None = None,
+    cache_path : str | None = None,
+    use_prefix_cache : bool = False
+    ) -> tuple[EvaluationResult, list[WorkerStats]]:
+    """
+    Evaluate an LLM's text classification performance on a supervised dataset using several worker processes.
+
+    The dataset is split into ``num_workers`` contiguous shards. Each worker process loads its own copy of the LLM
+    using ``model_loader``, evaluates its shard with ``evaluate()``, and the results are merged back together in the
+    original order of the dataset. This is mainly useful for CPU inference, where one process cannot use every core.
+
+    Args:
+        model_loader (Callable): Function which loads the LLM and returns ``(model, tokenizer)``, e.g.,
+                                 ``functools.partial(finetune.load_finetuned_llm, model_directory, "cpu", False)``.
+                                 It is sent to each worker process, so it must be picklable (e.g., a module-level function).
+        label_names (list): The name of each class label in the evaluation dataset.
+        eval_dataset (Dataset): The evaluation dataset. Must be preprocessed (see ``finetune.preprocess_dataset()``).
+        eval_config (EvaluationConfig): Controls what instructions to give to the LLM to classify each sample.
+        num_workers (int, optional): How many worker processes (and shards) to use. Defaults to 2.
+        threads_per_worker (int, optional): How many intra-op threads each worker may use.
+                                            Defaults to the number of CPU cores divided by ``num_workers``.
+        batch_size (int, optional): How many samples each worker classifies at once. See ``evaluate()``. Defaults to 1.
+        checkpoint_dir (str, optional): Folder to log each worker's results in so they can be resumed. Each shard is logged in its own
+                                        subfolder, so resuming needs the same ``num_workers``. See ``evaluate()``. Defaults to None.
+        cache_path (str, optional): Path of an ``InferenceCache`` database shared by every worker. Defaults to None.
+        use_prefix_cache (bool, optional): Whether each worker should reuse the KV cache of the system prompt. See ``evaluate()``. Defaults to False.
+
+    Returns:
+        result (EvaluationResult): The merged evaluation result for the whole dataset.
+        worker_stats (list[WorkerStats]): The throughput of each worker process.
+    """
+    num_workers = max(1, min(num_workers, len(eval_dataset)))
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+    shards = [eval_dataset.shard(num_shards=num_workers, index=i, contiguous=True) for i in range(num_workers)]
+
+    # Every shard restarts its row indices at 0, so give each shard its own evaluation log.
+    shard_checkpoint_dirs = [
+        os.path.join(checkpoint_dir, f"shard-{i}-of-{num_workers}") if checkpoint_dir is not None else None
+        for i in range(num_workers)
+    ]
+
+    start_time = time.perf_counter()
+
+    # CUDA and most BLAS libraries are not fork-safe, so start each worker in a fresh interpreter.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+        futures = [
+            executor.submit(_evaluate_shard, i, model_loader, list(label_names), shard, eval_config,
+                            threads_per_worker, batch_size, shard_checkpoint_dirs[i], cache_path, use_prefix_cache)
+            for i, shard in enumerate(shards)
+        ]
+        outputs = [future.result() for future in futures]
+
+    results = [result for result, _ in outputs]
+    worker_stats = [stats for _, stats in outputs]
+
+    result = EvaluationResult.merge(results, total_time_elapsed=time.perf_counter() - start_time)
+
+    # Match evaluate(), which adds the "Unknown" label to label_names.
+    label_names.append("Unknown")
+
+    return (result, worker_stats)
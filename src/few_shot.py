@@ -0,0 +1,235 @@
+from datasets import Dataset
+from sklearn.feature_extraction.text import CountVectorizer
+import scipy.sparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+import numpy as np
+import os, json, hashlib, time
+
+class FewShotIndex:
+    """
+    Inverted index of training examples for building dynamic k-shot prompts, ranked with [Okapi BM25](https://en.wikipedia.org/wiki/Okapi_BM25).
+
+    The index is built once from a training dataset. Given a batch of text samples, it finds the ``k`` most similar
+    training examples *of each class* for every sample, so every class is represented in each prompt.
+    Pass it to ``evaluate.EvaluationConfig`` as ``few_shot_index`` to add the examples to each classification prompt.
+
+    Every (document, term) BM25 weight is computed ahead of time and stored as a sparse term-by-document matrix,
+    so scoring a batch of queries against every training example is a single sparse matrix product.
+
+    Args:
+        texts (list[str]): The text of each training example.
+        labels (list[int]): The class ID of each training example.
+        label_names (list[str]): The name of each class label.
+        k1 (float, optional): BM25 term frequency saturation. Defaults to 1.5.
+        b (float, optional): BM25 document length normalisation. Defaults to 0.75.
+
+    Attributes:
+        build_time (float): How long it took to build the index in seconds.
+        query_time (float): The total time spent answering queries in seconds.
+        num_queries (int): How many text samples have been queried.
+    """
+    # Case-insensitive words of one or more characters.
+    TOKEN_PATTERN = r"(?u)\b\w+\b"
+
+    def __init__(self, texts : list[str], labels : list[int], label_names : list[str], k1 : float = 1.5, b : float = 0.75):
+        start_time = time.perf_counter()
+
+        self.texts = np.array(texts, dtype=object)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.label_names = list(label_names)
+        self.k1 = k1
+        self.b = b
+
+        self._vectorizer = CountVectorizer(lowercase=True, token_pattern=self.TOKEN_PATTERN, dtype=np.float32)
+        term_frequencies = self._vectorizer.fit_transform(self.texts).tocsr() if len(self.texts) > 0 else scipy.sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._weights = self._get_bm25_weights(term_frequencies)
+        self._class_rows = self._group_classes()
+
+        self.fingerprint = self._get_fingerprint()
+        self.build_time = time.perf_counter() - start_time
+        self.query_time = 0.0
+        self.num_queries = 0
+
+    @staticmethod
+    def from_dataset(dataset : Dataset, label_names : list[str], k1 : float = 1.5, b : float = 0.75) -> "FewShotIndex":
+        """
+        Build an index from a preprocessed training dataset (see ``finetune.preprocess_dataset()``).
+
+        Args:
+            dataset (Dataset): The training dataset in conversational format.
+            label_names (list[str]): The name of each class label. Examples with any other label are left out.
+            k1 (float, optional): See ``FewShotIndex``. Defaults to 1.5.
+            b (float, optional): See ``FewShotIndex``. Defaults to 0.75.
+
+        Returns:
+            FewShotIndex: The index.
+        """
+        class_ids = {name : i for i, name in enumerate(label_names)}
+        texts, labels = [], []
+        for rows in dataset.iter(batch_size=10_000):
+            for messages in rows['messages']:
+                label = class_ids.get(messages[-1]['content'])
+                if label is None:
+                    continue
+                texts.append(messages[0]['content'].strip())
+                labels.append(label)
+        return FewShotIndex(texts, labels, label_names, k1=k1, b=b)
+
+    def _get_bm25_weights(self, term_frequencies : scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+        """
+        Return the BM25 weight of every term in every document as a sparse (term, document) matrix.
+        """
+        num_documents = term_frequencies.shape[0]
+        if num_documents == 0:
+            return scipy.sparse.csr_matrix((term_frequencies.shape[1], 0), dtype=np.float32)
+
+        document_lengths = np.asarray(term_frequencies.sum(axis=1)).ravel()
+        average_length = max(document_lengths.mean(), 1.0)
+
+        # Number of documents containing each term
+        document_frequencies = np.bincount(term_frequencies.indices, minlength=term_frequencies.shape[1])
+        idf = np.log(1 + (num_documents - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+
+        # The document of each stored term frequency
+        rows = np.repeat(np.arange(num_documents), np.diff(term_frequencies.indptr))
+        tf = term_frequencies.data
+        length_norm = self.k1 * (1 - self.b + self.b * document_lengths[rows] / average_length)
+
+        weights = term_frequencies.copy()
+        weights.data = (idf[term_frequencies.indices] * tf * (self.k1 + 1) / (tf + length_norm)).astype(np.float32)
+        return weights.T.tocsr()
+
+    def _group_classes(self) -> list[np.ndarray]:
+        """
+        Return the rows of the examples of each class.
+        """
+        class_order = np.argsort(self.labels, kind="stable")
+        class_starts = np.concatenate([[0], np.cumsum(np.bincount(self.labels, minlength=len(self.label_names)))])
+        return [class_order[class_starts[i]:class_starts[i + 1]] for i in range(len(self.label_names))]
+
+    def _get_fingerprint(self) -> str:
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps([self.label_names, self.k1, self.b], ensure_ascii=False).encode("utf-8"))
+        fingerprint.update(self.labels.tobytes())
+        for text in self.texts:
+            fingerprint.update(text.encode("utf-8"))
+            fingerprint.update(b"\0")
+        return fingerprint.hexdigest()[0:16]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def score(self, texts : list[str]) -> np.ndarray:
+        """
+        Return the BM25 score of every training example for each text, with shape ``(len(texts), len(self))``.
+        """
+        if len(self) == 0:
+            return np.zeros((len(texts), 0), dtype=np.float32)
+        queries = self._vectorizer.transform(texts)
+        return (queries @ self._weights).toarray()
+
+    def query(self, texts : list[str], k : int = 1, batch_size : int = 64) -> np.ndarray:
+        """
+        Find the ``k`` most similar training examples of each class for each text.
+
+        Args:
+            texts (list[str]): The text samples to find examples for.
+            k (int, optional): How many examples of each class to find. Defaults to 1.
+            batch_size (int, optional): How many texts to score at once. Each batch needs ``batch_size * len(self)`` floats of memory. Defaults to 64.
+
+        Returns:
+            rows (np.ndarray): The row of each example in the index, with shape ``(len(texts), num_classes * k)``.
+                               Examples are grouped by class in order of class ID, most similar first. Classes with fewer than ``k``
+                               examples are padded with -1.
+        """
+        start_time = time.perf_counter()
+
+        results = np.full((len(texts), len(self.label_names) * k), -1, dtype=np.int64)
+        for start in range(0, len(texts), batch_size):
+            scores = self.score(texts[start:start + batch_size])
+            for class_id in range(len(self.label_names)):
+                class_rows = self._class_rows[class_id]
+                n = min(k, len(class_rows))
+                if n == 0:
+                    continue
+
+                class_scores = scores[:, class_rows]
+                # Find the top n scores without sorting every score, then sort only those.
+                top = np.argpartition(-class_scores, n - 1, axis=1)[:, 0:n] if n < len(class_rows) else np.tile(np.arange(n), (len(class_scores), 1))
+                top = np.take_along_axis(top, np.argsort(-np.take_along_axis(class_scores, top, axis=1), axis=1, kind="stable"), axis=1)
+                results[start:start + len(class_scores), class_id * k:class_id * k + n] = class_rows[top]
+
+        self.query_time += time.perf_counter() - start_time
+        self.num_queries += len(texts)
+        return results
+
+    def get_examples(self, texts : list[str], k : int = 1) -> list[list[tuple[str, str]]]:
+        """
+        Find the ``k`` most similar training examples of each class for each text. See ``query()``.
+
+        Returns:
+            examples (list[list[tuple[str, str]]]): The text and label name of each example, for each text.
+        """
+        return [
+            [(self.texts[row], self.label_names[self.labels[row]]) for row in rows if row >= 0]
+            for rows in self.query(texts, k)
+        ]
+
+    def get_stats(self) -> dict:
+        """
+        Return the size of the index and how long building and querying it took.
+        """
+        return {
+            "examples" : len(self),
+            "terms" : self._weights.shape[0],
+            "build_time" : self.build_time,
+            "queries" : self.num_queries,
+            "query_time" : self.query_time,
+            "queries_per_second" : self.num_queries / self.query_time if self.query_time > 0 else 0.0
+        }
+
+    def save(self, path : str) -> None:
+        """
+        Save the index to a folder, so that it can be loaded with ``load()`` instead of being built again.
+        """
+        os.makedirs(path, exist_ok=True)
+        scipy.sparse.save_npz(os.path.join(path, "weights.npz"), self._weights)
+        pq.write_table(pa.table({"text" : pa.array(self.texts, type=pa.large_string()), "label" : pa.array(self.labels)}),
+                       os.path.join(path, "examples.parquet"))
+
+        metadata = {
+            "label_names" : self.label_names,
+            "k1" : self.k1,
+            "b" : self.b,
+            "fingerprint" : self.fingerprint,
+            "build_time" : self.build_time,
+            "vocabulary" : {term : int(i) for term, i in getattr(self._vectorizer, "vocabulary_", {}).items()}
+        }
+        with open(os.path.join(path, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False)
+
+    @staticmethod
+    def load(path : str) -> "FewShotIndex":
+        """
+        Load an index saved with ``save()``.
+        """
+        with open(os.path.join(path, "metadata.json"), "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        examples = pq.read_table(os.path.join(path, "examples.parquet"))
+
+        index = FewShotIndex.__new__(FewShotIndex)
+        index.texts = np.array(examples.column("text").to_pylist(), dtype=object)
+        index.labels = examples.column("label").to_numpy().astype(np.int64)
+        index.label_names = metadata["label_names"]
+        index.k1 = metadata["k1"]
+        index.b = metadata["b"]
+        index.fingerprint = metadata["fingerprint"]
+        index.build_time = metadata["build_time"]
+        index.query_time = 0.0
+        index.num_queries = 0
+
+        index._vectorizer = CountVectorizer(lowercase=True, token_pattern=FewShotIndex.TOKEN_PATTERN, dtype=np.float32, vocabulary=metadata["vocabulary"])
+        index._weights = scipy.sparse.load_npz(os.path.join(path, "weights.npz")).tocsr()
+        index._class_rows = index._group_classes()
+        return index
@@ -1,51 +1,125 @@
+from __future__ import annotations
 from datasets import Dataset, Value, ClassLabel, DatasetDict
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-from peft import LoraConfig, PeftConfig, AutoPeftModelForCausalLM, prepare_model_for_kbit_training, get_peft_model
-from trl import SFTConfig, SFTTrainer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+from inference_cache import InferenceCache, _get_active_adapters
+from inference_profiler import InferenceProfiler, profile_stage
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import transformers, torch
 from pandas import DataFrame
-from copy import copy
-import math
+from copy import copy, deepcopy
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING
+import math, json, os, shutil, hashlib, time
 import warnings
+import weakref
 
-transformers.set_seed(42) # Enable deterministic LLM output
+# Training libraries are slow to import, so they are only imported by the functions which need them.
+if TYPE_CHECKING:
+    from peft import LoraConfig, AutoPeftModelForCausalLM
+    from trl import SFTConfig
 
-def create_dataset_from_dataframe(df : DataFrame, text_column : str, labels_column : str, test_size : float | None = 0.1) -> Dataset:
+def set_seed(seed : int = 42) -> None:
+    """
+    Seed every random number generator (Python, NumPy and PyTorch), so that sampled LLM output and LoRA initialisation are reproducible.
+    ``finetune()`` calls this with ``SFTConfig.seed``. Call it yourself before generating with ``do_sample=True``.
+
+    Args:
+        seed (int, optional): The seed. Defaults to 42.
+    """
+    transformers.set_seed(seed)
+
+def _clean_chunk(df : DataFrame, text_column : str, labels_column : str) -> pa.Table:
+    """
+    Clean a chunk of a DataFrame and convert it into an Arrow table with a "text" column and a "label" column.
+
+    Label strings have their whitespace stripped, and any rows with an empty text or label are deleted.
+    """
+    labels = df[labels_column]
+    if labels.dtype == object or pd.api.types.is_string_dtype(labels.dtype):
+        # Strip string labels, leaving any other values unchanged.
+        stripped = labels.str.strip()
+        labels = stripped.where(stripped.notna(), labels)
+
+    chunk = DataFrame({"text" : df[text_column], "label" : labels}, copy=False)
+
+    # Delete any empty values
+    chunk = chunk.dropna()
+
+    return pa.Table.from_pandas(chunk, preserve_index=False)
+
+def _create_dataset_from_chunks(chunks, text_column : str, labels_column : str, test_size : float | None) -> Dataset:
+    """
+    Build a Dataset from an iterable of DataFrame chunks. See ``create_dataset_from_dataframe()``.
+    """
+    tables = [_clean_chunk(chunk, text_column, labels_column) for chunk in chunks]
+    tables = [table for table in tables if table.num_rows > 0]
+
+    if len(tables) > 0:
+        table = pa.concat_tables([table.cast(tables[0].schema) for table in tables])
+    else:
+        table = pa.table({"text" : pa.array([], pa.string()), "label" : pa.array([], pa.string())})
+
+    ds = Dataset(table)
+    ds = ds.class_encode_column("label") # Convert label from Value to ClassLabel
+
+    if test_size is not None:
+        ds = ds.train_test_split(test_size=test_size)
+
+    return ds
+
+def create_dataset_from_dataframe(df : DataFrame, text_column : str, labels_column : str, test_size : float | None = 0.1, chunk_size : int = 100_000) -> Dataset:
     """
     Convert a DataFrame into a Dataset for pre-processing.
 
+    The DataFrame is cleaned and converted into Arrow ``chunk_size`` rows at a time, so it is never copied in full.
+    To load a large CSV or Parquet file, use ``create_dataset_from_file()`` instead.
+
     Args:
         df (DataFrame): The DataFrame to convert.
         text_column (str): The column name for the input text column (X).
         labels_column (str): The column name for the output label column (y). Labels *must* be a string, not a class ID.
         test_size (float, optional): If specified, splits the dataset into train and test subsets where test_size is the ratio of the test subset. Defaults to 0.1.
+        chunk_size (int, optional): How many rows to convert at a time. Defaults to 100,000.
 
     Returns:
         Dataset: The dataset.
     """
-    df = df.copy() # Copy the dataframe to prevent the original being modified
+    for column in [text_column, labels_column]:
+        if column not in df.columns: raise ValueError(f"DataFrame has no column: {column}")
 
-    df[labels_column] = df[labels_column].map(lambda x : x.strip() if type(x) is str else x)
+    chunks = (df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size))
+    return _create_dataset_from_chunks(chunks, text_column, labels_column, test_size)
 
-    # Delete any empty values
-    df = df.dropna(subset=[text_column, labels_column])
-    
-    data = {
-        "text" : df[text_column].to_list(),
-        "label" : df[labels_column].to_list()
-    }
-    
-    ds = Dataset.from_dict(data)
-    ds = ds.class_encode_column("label") # Convert label from Value to ClassLabel
+def create_dataset_from_file(path : str, text_column : str, labels_column : str, test_size : float | None = 0.1, chunk_size : int = 100_000) -> Dataset:
+    """
+    Load a CSV or Parquet file into a Dataset for pre-processing, reading ``chunk_size`` rows at a time.
 
-    if test_size is not None:
-        ds = ds.train_test_split(test_size=test_size)
-    
-    #ds = ds.flatten_indices() # Call .flatten_indices() after .filter() otherwise .sort() takes ages.
+    Only the text and label columns are read. CSV columns are read as strings.
+    The result is the same as reading the whole file with pandas and calling ``create_dataset_from_dataframe()``.
 
-    return ds
+    Args:
+        path (str): The path to a CSV file, or a Parquet file ending in ".parquet".
+        text_column (str): The column name for the input text column (X).
+        labels_column (str): The column name for the output label column (y).
+        test_size (float, optional): If specified, splits the dataset into train and test subsets where test_size is the ratio of the test subset. Defaults to 0.1.
+        chunk_size (int, optional): How many rows to read at a time. Defaults to 100,000.
+
+    Returns:
+        Dataset: The dataset.
+    """
+    columns = [text_column, labels_column]
+
+    if str(path).endswith(".parquet"):
+        parquet_file = pq.ParquetFile(path)
+        chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns))
+    else:
+        chunks = pd.read_csv(path, usecols=columns, dtype=str, chunksize=chunk_size)
+
+    return _create_dataset_from_chunks(chunks, text_column, labels_column, test_size)
 
 def select_top_n_classes(dataset : Dataset | DatasetDict, n : int = 10, labels_column : str = "label", main_subset : str = 'train', top_n_labels : list | None = None) -> Dataset:
     """
@@ -54,6 +128,9 @@ def select_top_n_classes(dataset : Dataset | DatasetDict, n : int = 10, labels_c
     
     NOTE: This does *not* adjust the number of samples *per* class to be equal; use ``undersample_dataset()`` for that.
 
+    If the labels column is a ``ClassLabel``, the class IDs are remapped to a new ``ClassLabel`` containing only the selected classes,
+    sorted by name. Every subset of a ``DatasetDict`` gets the same ``ClassLabel``, even if some classes are missing from a subset.
+
     Args:
         dataset (Dataset | DatasetDict): The dataset to sample.
         n (int, optional): Top ``n`` most common classes to select from the dataset. Defaults to 10.
@@ -74,7 +151,7 @@ def select_top_n_classes(dataset : Dataset | DatasetDict, n : int = 10, labels_c
             main_dataset = dataset[main_subset]
         else: main_dataset = dataset
         
-        labels = pd.Series(main_dataset[labels_column])
+        labels = pd.Series(_get_column(main_dataset, labels_column))
         n = max(n, 1)
         n = min(n, labels.size)
         
@@ -87,53 +164,57 @@ def select_top_n_classes(dataset : Dataset | DatasetDict, n : int = 10, labels_c
         dataset = copy(dataset) # Shallow copy the DatasetDict to prevent the original being modified
         for subset in dataset.keys():
             dataset[subset] = select_top_n_classes(dataset[subset], labels_column=labels_column, n=n, top_n_labels = top_n_labels)
-        #dataset = dataset.flatten_indices() # Call .flatten_indices() after .filter() otherwise .sort() takes ages.
         return dataset
     
-    dataset = dataset.filter(lambda x : x[labels_column] in top_n_labels)
+    labels = _get_column(dataset, labels_column)
+    dataset = dataset.select(np.flatnonzero(np.isin(labels, top_n_labels)))
 
     # If the labels column is a ClassLabel, we also have to update the label names to match the new classes.
     if type(dataset.features[labels_column]) is ClassLabel:
-
-        # Convert class label column into raw strings.
         label_names = dataset.features[labels_column].names
-        dataset = dataset.cast_column(labels_column, Value(dtype='string'))
-        dataset = dataset.map( lambda sample : _label_to_string(sample, label_names, label_column=labels_column) )
-        
-        # Cast class label column back into a ClassLabel.
-        dataset = dataset.class_encode_column(labels_column)
 
-    #dataset = dataset.flatten_indices() # Call .flatten_indices() after .filter() otherwise .sort() takes ages.
+        # The new class labels are sorted by name, like ``Dataset.class_encode_column()``.
+        class_ids = sorted(set(int(class_id) for class_id in top_n_labels), key=lambda class_id : label_names[class_id])
+
+        # Map each old class ID to its new class ID.
+        new_class_ids = np.full(len(label_names), -1, dtype=np.int64)
+        new_class_ids[class_ids] = np.arange(len(class_ids))
+
+        features = dataset.features.copy()
+        features[labels_column] = ClassLabel(names=[label_names[class_id] for class_id in class_ids])
+
+        dataset = dataset.map(lambda batch : {labels_column : new_class_ids[np.asarray(batch[labels_column])]}, batched=True, features=features)
+
     return dataset
 
-def _get_n_samples_per_class(dataset : Dataset, n : int, labels_column : str, shuffle:bool=True, seed:int=0) -> Dataset:
+def _get_column(dataset : Dataset, column : str) -> np.ndarray:
     """
-    Given a dataset, obtain a smaller dataset containing the first **n** samples from each class.
+    Read a single column of a dataset as a NumPy array, without reading any other columns.
+    """
+    return dataset.with_format("numpy", columns=[column])[column]
+
+def _get_n_samples_per_class(labels : np.ndarray, n : int) -> np.ndarray:
+    """
+    Given the label of every sample in a dataset, find the first **n** samples from each class.
+
+    Samples are grouped by class with a single stable argsort, so no sorting of the dataset itself is needed.
 
     Args:
-        dataset (Dataset): The dataset to sample.
-        labels_column (str): The column name for the labels in the dataset.
+        labels (np.ndarray): The label of each sample.
         n (int): How many samples from each class to extract.
-        shuffle (bool): Whether to sort the final result by class or randomly.
-        seed (int, optional): RNG seed. Defaults to 0.
 
     Returns:
-        Dataset: The sample of the dataset.
+        indices (np.ndarray): The positions of the selected samples in ``labels``, grouped by class in ascending order of label.
+                              Within each class, samples keep their order in ``labels``.
     """
-
-    if labels_column not in dataset.features.keys(): raise ValueError(f"Dataset has no column: {labels_column}")
-
-
-    ds_sorted = dataset.flatten_indices().sort(labels_column) # BUG: .sort() takes forever if called after .filter() unless you call .flatten_indices()
-
-    _, class_indices = np.unique(ds_sorted[labels_column], return_index=True)
+    # Positions of the samples of each class, one class after another.
+    order = np.argsort(labels, kind="stable")
+    _, class_starts, class_counts = np.unique(labels[order], return_index=True, return_counts=True)
 
     # Get the number of samples from the least common class.
-    num_samples_in_minority_class = pd.Series(ds_sorted[labels_column]).value_counts().min()
+    num_samples_in_minority_class = class_counts.min()
 
     # Ensure n is not greater than the number of samples per class.
-    samples_per_class = np.diff(class_indices).min()
-    n = min(n, samples_per_class)
     n = max(n, 1)
 
     # Undersample if needed to ensure an equal number of samples per class.
@@ -141,14 +222,7 @@ def _get_n_samples_per_class(dataset : Dataset, n : int, labels_column : str, sh
         warnings.warn(f"\nCannot sample {n} samples per class equally because some classes have fewer samples.\nSampling {num_samples_in_minority_class} samples per class instead.\n")
     n = min(n, num_samples_in_minority_class)
 
-    class_indices = np.array([list(range(index, index + n)) for index in class_indices])
-    class_indices = class_indices.flatten()
-
-    sample = ds_sorted.select(class_indices)
-
-    if shuffle: sample = sample.shuffle(seed=seed)
-    
-    return sample
+    return order[(class_starts[:, np.newaxis] + np.arange(n)).ravel()]
 
 def undersample_dataset(dataset : Dataset | DatasetDict, labels_column : str = "label", ratio : float = None, size : int = None, samples_per_class : int = None, shuffle : bool = True, seed:int=0) -> Dataset:
     """
@@ -159,6 +233,9 @@ def undersample_dataset(dataset : Dataset | DatasetDict, labels_column : str = "
     - **size**: Specify how many items the sample should have in total.
     - **samples_per_class**: Specify how many items each class should have inside the sample.
 
+    The label column is only read once, and the sample is taken with a single call to ``Dataset.select()``.
+    Shuffling gives the same result as ``Dataset.shuffle(seed=seed)``.
+
     Args:
         dataset (Dataset | DatasetDict): The dataset to sample.
         labels_column (str, optional): The column name for the labels in the dataset. Defaults to "label".
@@ -180,25 +257,33 @@ def undersample_dataset(dataset : Dataset | DatasetDict, labels_column : str = "
             dataset[subset] = undersample_dataset(dataset[subset], labels_column, ratio, size, samples_per_class, shuffle, seed)
         return dataset
 
-    if shuffle: dataset=dataset.shuffle(seed=seed)
-    
     if labels_column not in dataset.features.keys(): raise ValueError(f"Dataset has no column: {labels_column}")
 
     if ratio is None and size is None and samples_per_class is None:
         raise ValueError("Either ratio, size, or samples_per_class must be given.")
 
+    # Shuffle the row positions instead of the dataset. Like ``Dataset.shuffle()``, a new generator is seeded for each shuffle.
+    if shuffle: rows = np.random.default_rng(seed).permutation(dataset.num_rows)
+    else: rows = np.arange(dataset.num_rows)
+
+    labels = _get_column(dataset, labels_column)[rows]
+
     if samples_per_class is None:
         if size is not None:
             ratio = size / dataset.num_rows
         ratio = max(ratio, 0)
         ratio = min(ratio, 1)
 
-        num_labels = np.unique(dataset[labels_column]).size
+        num_labels = np.unique(labels).size
         
         samples_per_class = dataset.num_rows / num_labels * ratio
         samples_per_class = int(math.floor(samples_per_class))
 
-    return _get_n_samples_per_class(dataset, samples_per_class, labels_column, shuffle=shuffle, seed=seed)
+    rows = rows[_get_n_samples_per_class(labels, samples_per_class)]
+
+    if shuffle: rows = rows[np.random.default_rng(seed).permutation(rows.size)]
+
+    return dataset.select(rows)
 
 def _format_dataset(examples : Dataset) -> dict:
     """
@@ -229,31 +314,118 @@ def _format_dataset(examples : Dataset) -> dict:
         ]
         return {'messages': converted_sample}
 
-def _label_to_string(sample : dict, class_label_names : list, label_column : str = "completion") -> dict:
+TRUNCATION_STRATEGIES = ["head", "tail", "head_tail"]
+
+@dataclass
+class TruncationConfig:
+    """
+    Controls how long text samples are shortened to a token budget before they are put into a prompt.
+
+    Only the text sample itself is truncated. The chat template, system prompt and any few-shot examples are always kept intact.
+
+    Args:
+        max_tokens (int): The maximum number of tokens to keep from each text sample.
+        strategy (str, optional): Which tokens to keep. Defaults to "head".
+                                  - "head": The first ``max_tokens`` tokens.
+                                  - "tail": The last ``max_tokens`` tokens.
+                                  - "head_tail": The first ``head_fraction`` of the budget and the rest from the end, joined by ``separator``.
+        head_fraction (float, optional): The fraction of ``max_tokens`` taken from the start of the text by "head_tail". Defaults to 0.5.
+        separator (str, optional): The text put between the head and the tail by "head_tail". Defaults to " ... ".
+    """
+    max_tokens : int
+    strategy : str = "head"
+    head_fraction : float = 0.5
+    separator : str = " ... "
+
+    def __post_init__(self):
+        if self.max_tokens < 1:
+            raise ValueError("max_tokens must be at least 1.")
+        if self.strategy not in TRUNCATION_STRATEGIES:
+            raise ValueError(f"Unknown truncation strategy: {self.strategy}. Must be one of {TRUNCATION_STRATEGIES}.")
+        if not 0 <= self.head_fraction <= 1:
+            raise ValueError("head_fraction must be between 0 and 1.")
+
+def truncate_texts(texts : list[str], tokenizer : AutoTokenizer, truncation : TruncationConfig) -> tuple[list[str], list[bool]]:
+    """
+    Shorten every text sample to at most ``truncation.max_tokens`` tokens. The texts are tokenized all at once,
+    and only the texts which are too long are decoded again.
+
+    Args:
+        texts (list[str]): The text samples.
+        tokenizer (AutoTokenizer): The tokenizer to count tokens with. Should come with the LLM.
+        truncation (TruncationConfig): How to truncate each text.
+
+    Returns:
+        texts (list[str]): The truncated text samples.
+        truncated (list[bool]): Whether each text sample was truncated.
+    """
+    texts = list(texts)
+    if len(texts) == 0:
+        return texts, []
+
+    max_tokens = truncation.max_tokens
+    input_ids = tokenizer(texts, add_special_tokens=False)['input_ids']
+    truncated = [len(ids) > max_tokens for ids in input_ids]
+
+    for i, ids in enumerate(input_ids):
+        if not truncated[i]:
+            continue
+        if truncation.strategy == "head":
+            texts[i] = tokenizer.decode(ids[0:max_tokens])
+        elif truncation.strategy == "tail":
+            texts[i] = tokenizer.decode(ids[len(ids) - max_tokens:])
+        else:
+            num_head = int(round(max_tokens * truncation.head_fraction))
+            num_tail = max_tokens - num_head
+            head = tokenizer.decode(ids[0:num_head])
+            tail = tokenizer.decode(ids[len(ids) - num_tail:]) if num_tail > 0 else ""
+            texts[i] = head + truncation.separator + tail
+
+    return texts, truncated
+
+def _to_conversational(batch : dict, text_column : str, labels_column : str, label_names : list | None,
+                       truncation : TruncationConfig | None = None, tokenizer : AutoTokenizer | None = None) -> dict:
     """
-    Given a sample from a supervised text classification dataset
-    in prompt/completion format, replace the class label ID with
-    a label name string. The class label column must already have
-    a string data type.
+    Convert a batch of samples from a supervised text classification dataset into conversational format.
 
     Args:
-        sample (dict): The data sample in prompt/completion format with string data type.
-        class_label_names (list): A list of all class label names.
+        batch (dict): The batch of samples.
+        text_column (str): The column name for the input text column (X).
+        labels_column (str): The column name for the output label column (y).
+        label_names (list | None): If the labels are class IDs, a list of all class label names to replace them with.
+        truncation (TruncationConfig, optional): If given, each text is truncated with ``truncate_texts()``. Defaults to None.
+        tokenizer (AutoTokenizer, optional): The tokenizer to count tokens with. Required if ``truncation`` is given. Defaults to None.
 
     Returns:
-        dict: The data sample with class ID replaced with label name.
+        dict: The batch in conversational format, with a ``truncated`` column if ``truncation`` is given.
     """
-    sample[label_column] = class_label_names[ int(sample[label_column]) ]
-    return sample
+    completions = batch[labels_column]
+    if label_names is not None:
+        # Replace all class label IDs with label names.
+        completions = np.array(label_names, dtype=object)[np.asarray(completions, dtype=np.int64)].tolist()
+
+    if truncation is None:
+        return _format_dataset({"prompt" : batch[text_column], "completion" : completions})
 
-def preprocess_dataset(dataset : Dataset | DatasetDict, text_column : str = "text", labels_column : str = "label") -> tuple[Dataset, list]:
+    texts, truncated = truncate_texts(batch[text_column], tokenizer, truncation)
+    return {**_format_dataset({"prompt" : texts, "completion" : completions}), "truncated" : truncated}
+
+def preprocess_dataset(dataset : Dataset | DatasetDict, text_column : str = "text", labels_column : str = "label", batch_size : int = 1000, num_proc : int | None = None,
+                       truncation : TruncationConfig | None = None, tokenizer : AutoTokenizer | None = None) -> tuple[Dataset, list]:
     """
     Pre-process a supervised text-classification dataset into a format usable for fine-tuning.
 
+    The conversational ``messages`` column is written in a single batched ``Dataset.map()``.
+
     Args:
         dataset (Dataset | DatasetDict): A supervised text-classification dataset.
         text_column (str): The column name for the input text column (X).
         labels_column (str, optional): The column name for the output label column (y). Defaults to "label".
+        batch_size (int, optional): How many samples to convert at a time. Defaults to 1000.
+        num_proc (int | None, optional): How many processes to convert the dataset with. Defaults to None (the current process only).
+        truncation (TruncationConfig, optional): If given, every text sample is truncated to a token budget (see ``truncate_texts()``),
+                                                 and a boolean ``truncated`` column records which samples were. Defaults to None.
+        tokenizer (AutoTokenizer, optional): The tokenizer to count tokens with. Required if ``truncation`` is given. Defaults to None.
     
     Returns:
         formatted_dataset (Dataset): The dataset in conversational format.
@@ -266,36 +438,334 @@ def preprocess_dataset(dataset : Dataset | DatasetDict, text_column : str = "tex
         label_names = []
         dataset = copy(dataset) # Shallow copy the DatasetDict to prevent the original being modified
         for subset in dataset.keys():
-            dataset[subset], new_labels = preprocess_dataset(dataset[subset], text_column, labels_column)
+            dataset[subset], new_labels = preprocess_dataset(dataset[subset], text_column, labels_column, batch_size, num_proc, truncation, tokenizer)
             if len(new_labels) > len(label_names): label_names = new_labels
         return dataset, label_names
 
     for column in [text_column, labels_column]:
         if column not in dataset.features.keys(): raise ValueError(f"Dataset has no column: {column}")
-
-    # Select only the text and label columns.
-    dataset = dataset.select_columns([text_column,labels_column])
-
-    # Convert the dataset into prompt/completion format.
-    dataset = dataset.rename_column(text_column, "prompt")
-    dataset = dataset.rename_column(labels_column, "completion")
+    if truncation is not None and tokenizer is None:
+        raise ValueError("A tokenizer is required to truncate the dataset.")
 
     # Map the class label column from integer to string.
-    if type(dataset.features['completion']) is ClassLabel:
-        label_names = [n.strip() for n in dataset.features['completion'].names]
-        # Cast label column from int to str.
-        dataset = dataset.cast_column("completion", Value(dtype='string'))
-        # Replace all class label IDs with label names.
-        dataset = dataset.map( lambda sample : _label_to_string(sample, label_names) )
+    if type(dataset.features[labels_column]) is ClassLabel:
+        label_names = [n.strip() for n in dataset.features[labels_column].names]
+        class_label_names = label_names
     else:
-        label_names = [n.strip() for n in list(np.unique(dataset['completion']))]
+        label_names = [n.strip() for n in list(np.unique(_get_column(dataset, labels_column)))]
+        class_label_names = None
 
     # Convert the dataset into conversational format
-    dataset = dataset.map(_format_dataset).remove_columns(['prompt', 'completion'])
+    dataset = dataset.map(
+        _to_conversational,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        fn_kwargs={"text_column" : text_column, "labels_column" : labels_column, "label_names" : class_label_names,
+                   "truncation" : truncation, "tokenizer" : tokenizer}
+    )
 
     return dataset, label_names
 
-def finetune(model : AutoModelForCausalLM, tokenizer : AutoTokenizer, train_dataset : Dataset, lora_config : LoraConfig, sft_config : SFTConfig, output_dir : str | None = None) -> None:
+@dataclass
+class TrainingDataConfig:
+    """
+    Controls how ``finetune()`` turns a preprocessed dataset into training batches.
+
+    Args:
+        max_length (int, optional): The maximum number of tokens in each training sequence. Longer samples are truncated. Defaults to 1024.
+        packing (bool, optional): Whether to pack several samples into each sequence of up to ``max_length`` tokens instead of padding
+                                  every sample. Samples in the same sequence cannot attend to each other. Defaults to False.
+        token_budget (int, optional): If given, batches are formed from samples of similar length, with as many samples as fit into
+                                      ``token_budget`` tokens including padding, instead of ``per_device_train_batch_size`` samples. Defaults to None.
+        completion_only_loss (bool, optional): Whether to only train on the completion (the class label), masking the loss of the prompt. Defaults to True.
+        truncation (TruncationConfig, optional): If given, the text sample of each conversation is truncated to a token budget before the
+                                                 chat template is applied, so the class label is never cut off. Use the same configuration
+                                                 as ``evaluate.EvaluationConfig.truncation``. Defaults to None.
+    """
+    max_length : int = 1024
+    packing : bool = False
+    token_budget : int | None = None
+    completion_only_loss : bool = True
+    truncation : TruncationConfig | None = None
+
+@dataclass
+class TrainingThroughput:
+    """
+    Training throughput measured by ``finetune()`` when a ``TrainingDataConfig`` is given.
+
+    Args:
+        num_sequences (int): How many sequences were trained on, including repeated epochs.
+        num_tokens (int): How many real (non-padding) tokens were trained on.
+        num_padded_tokens (int): How many token positions were run through the LLM, including padding.
+        padding_ratio (float): The fraction of token positions which were padding.
+        train_time (float): How long training took in seconds.
+        tokens_per_second (float): How many real tokens were trained on per second.
+        num_truncated (int, optional): How many training samples were truncated by ``TrainingDataConfig.truncation``. Defaults to 0.
+    """
+    num_sequences : int
+    num_tokens : int
+    num_padded_tokens : int
+    padding_ratio : float
+    train_time : float
+    tokens_per_second : float
+    num_truncated : int = 0
+
+def _tokenize_training_samples(rows : dict, tokenizer : AutoTokenizer, max_length : int | None, completion_only_loss : bool,
+                               truncation : TruncationConfig | None = None) -> dict:
+    """
+    Tokenize a batch of conversations for training. See ``tokenize_training_dataset()``.
+    """
+    conversations = rows['messages']
+    if truncation is not None:
+        # Truncate the text sample (the final user message) of each conversation, leaving the rest of the conversation intact.
+        texts, truncated = truncate_texts([messages[-2]['content'] for messages in conversations], tokenizer, truncation)
+        conversations = [messages[:-2] + [{**messages[-2], "content" : text}, messages[-1]] for messages, text in zip(conversations, texts)]
+
+    full_texts = [tokenizer.apply_chat_template(messages, tokenize=False) for messages in conversations]
+    prompt_texts = [_format_prompt(messages[:-1], tokenizer) for messages in conversations]
+
+    # Split each conversation into its prompt and completion, so they can be masked separately.
+    splits = [(prompt, full[len(prompt):]) if full.startswith(prompt) else ("", full) for prompt, full in zip(prompt_texts, full_texts)]
+    prompt_ids = tokenizer([prompt for prompt, _ in splits], add_special_tokens=False)['input_ids']
+    completion_ids = tokenizer([completion for _, completion in splits], add_special_tokens=False)['input_ids']
+
+    input_ids, labels = [], []
+    for prompt, completion in zip(prompt_ids, completion_ids):
+        ids = (prompt + completion)[0:max_length]
+        input_ids.append(ids)
+        labels.append(([-100] * len(prompt) + completion)[0:max_length] if completion_only_loss else list(ids))
+
+    tokenized = {"input_ids" : input_ids, "labels" : labels, "length" : [len(ids) for ids in input_ids]}
+    if truncation is not None:
+        tokenized["truncated"] = truncated
+    return tokenized
+
+def tokenize_training_dataset(
+    dataset : Dataset,
+    tokenizer : AutoTokenizer,
+    max_length : int | None = None,
+    completion_only_loss : bool = True,
+    batch_size : int = 1000,
+    num_proc : int | None = None,
+    truncation : TruncationConfig | None = None
+    ) -> Dataset:
+    """
+    Tokenize a preprocessed dataset (see ``preprocess_dataset()``) for fine-tuning, applying the chat template to each conversation.
+
+    Args:
+        dataset (Dataset): The dataset in conversational format.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+        max_length (int, optional): If given, every sample is truncated to this many tokens. Defaults to None.
+        completion_only_loss (bool, optional): Whether to mask the labels of the prompt, so only the completion is trained on. Defaults to True.
+        batch_size (int, optional): How many samples to tokenize at once. Defaults to 1000.
+        num_proc (int, optional): How many processes to tokenize with. Defaults to None (a single process).
+        truncation (TruncationConfig, optional): If given, the text sample of each conversation is truncated to a token budget
+                                                 before the chat template is applied. See ``truncate_texts()``. Defaults to None.
+
+    Returns:
+        Dataset: The dataset with ``input_ids``, ``labels`` (-100 for masked tokens) and ``length`` columns,
+                 and a ``truncated`` column if ``truncation`` is given.
+    """
+    return dataset.map(
+        _tokenize_training_samples,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        fn_kwargs={"tokenizer" : tokenizer, "max_length" : max_length, "completion_only_loss" : completion_only_loss, "truncation" : truncation},
+        desc="Tokenizing training samples"
+    )
+
+def _pack_samples(rows : dict, max_length : int) -> dict:
+    """
+    Pack a batch of tokenized samples into sequences of up to ``max_length`` tokens. See ``pack_dataset()``.
+    """
+    packed = {"input_ids" : [], "labels" : [], "position_ids" : [], "length" : []}
+
+    def add_sequence(sequence : list[int]):
+        packed["input_ids"].append([token for i in sequence for token in rows['input_ids'][i]])
+        # The first token of each sample must not be predicted from the end of the previous sample.
+        packed["labels"].append([label for i in sequence for label in [-100] + rows['labels'][i][1:]])
+        packed["position_ids"].append([position for i in sequence for position in range(len(rows['input_ids'][i]))])
+        packed["length"].append(len(packed["input_ids"][-1]))
+
+    # Next-fit packing: keep adding samples to the sequence until the next one does not fit.
+    sequence, sequence_length = [], 0
+    for i, length in enumerate(rows['length']):
+        if length == 0:
+            continue
+        if sequence_length + length > max_length and len(sequence) > 0:
+            add_sequence(sequence)
+            sequence, sequence_length = [], 0
+        sequence.append(i)
+        sequence_length += length
+    if len(sequence) > 0:
+        add_sequence(sequence)
+
+    return packed
+
+def pack_dataset(dataset : Dataset, max_length : int, batch_size : int = 1000, num_proc : int | None = None) -> Dataset:
+    """
+    Pack a tokenized dataset (see ``tokenize_training_dataset()``) into sequences of up to ``max_length`` tokens, so that
+    short samples do not have to be padded. Samples are never split between sequences.
+
+    Each packed sequence has a ``position_ids`` column which restarts from 0 at the start of each sample.
+    ``TrainingDataCollator`` uses it to stop samples in the same sequence from attending to each other.
+
+    Args:
+        dataset (Dataset): The tokenized dataset.
+        max_length (int): The maximum number of tokens in each sequence.
+        batch_size (int, optional): How many samples to pack at once. Samples are only packed with others from the same batch. Defaults to 1000.
+        num_proc (int, optional): How many processes to pack with. Defaults to None (a single process).
+
+    Returns:
+        Dataset: The packed dataset with ``input_ids``, ``labels``, ``position_ids`` and ``length`` columns.
+    """
+    return dataset.map(
+        _pack_samples,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        fn_kwargs={"max_length" : max_length},
+        desc="Packing training samples"
+    )
+
+class TrainingDataCollator:
+    """
+    Pads a batch of tokenized (and optionally packed) training samples, and counts how much of each batch is padding.
+
+    For packed sequences, the attention mask is a 4D block-diagonal causal mask, so that each sample only attends to itself.
+
+    Args:
+        pad_token_id (int): The token to pad with.
+        dtype (torch.dtype, optional): The dtype of the LLM, used for 4D attention masks. Defaults to torch.float32.
+
+    Attributes:
+        num_sequences (int): How many sequences have been collated.
+        num_tokens (int): How many real tokens have been collated.
+        num_padded_tokens (int): How many token positions have been collated, including padding.
+    """
+    def __init__(self, pad_token_id : int, dtype : torch.dtype = torch.float32):
+        self.pad_token_id = pad_token_id
+        self.dtype = dtype
+        self.num_sequences = 0
+        self.num_tokens = 0
+        self.num_padded_tokens = 0
+
+    def __call__(self, samples : list[dict]) -> dict:
+        max_length = max(len(sample["input_ids"]) for sample in samples)
+        batch_size = len(samples)
+
+        input_ids = torch.full((batch_size, max_length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_length), -100, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_length), dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long)
+
+        for row, sample in enumerate(samples):
+            length = len(sample["input_ids"])
+            input_ids[row, 0:length] = torch.tensor(sample["input_ids"], dtype=torch.long)
+            labels[row, 0:length] = torch.tensor(sample["labels"], dtype=torch.long)
+            position_ids[row, 0:length] = torch.tensor(sample["position_ids"] if "position_ids" in sample else range(length), dtype=torch.long)
+            attention_mask[row, 0:length] = 1
+
+        self.num_sequences += batch_size
+        self.num_tokens += int(attention_mask.sum())
+        self.num_padded_tokens += batch_size * max_length
+
+        batch = {"input_ids" : input_ids, "labels" : labels, "position_ids" : position_ids}
+        if any("position_ids" in sample for sample in samples):
+            batch["attention_mask"] = self._get_packed_attention_mask(position_ids, attention_mask)
+        else: batch["attention_mask"] = attention_mask
+        return batch
+
+    def _get_packed_attention_mask(self, position_ids : torch.Tensor, attention_mask : torch.Tensor) -> torch.Tensor:
+        """
+        Return an additive 4D attention mask of shape ``(batch, 1, length, length)`` which lets each token attend only
+        to itself and the earlier tokens of the same sample.
+        """
+        # Number the samples in each sequence; a new sample starts wherever the position restarts from 0.
+        sample_ids = torch.cumsum(position_ids == 0, dim=1)
+        length = position_ids.shape[1]
+        causal = torch.ones((length, length), dtype=torch.bool).tril()
+
+        allowed = (sample_ids[:, :, None] == sample_ids[:, None, :]) & causal & attention_mask[:, None, :].bool()
+        # Padding tokens attend to themselves, so that no row of the mask is empty.
+        allowed |= torch.eye(length, dtype=torch.bool)
+
+        mask = torch.zeros(allowed.shape, dtype=self.dtype)
+        mask.masked_fill_(~allowed, torch.finfo(self.dtype).min)
+        return mask[:, None]
+
+def _token_budget_batches(lengths : list[int], token_budget : int, seed : int) -> list[list[int]]:
+    """
+    Group samples of similar length into batches with at most ``token_budget`` tokens each, including padding.
+    The order of the batches is shuffled.
+    """
+    order = np.argsort(np.asarray(lengths), kind="stable")
+    batches, batch, batch_length = [], [], 0
+    for i in order:
+        # Samples are sorted by length, so the padded length of the batch is the length of its newest sample.
+        if len(batch) > 0 and (len(batch) + 1) * max(batch_length, lengths[i]) > token_budget:
+            batches.append(batch)
+            batch, batch_length = [], 0
+        batch.append(int(i))
+        batch_length = max(batch_length, lengths[i])
+    if len(batch) > 0:
+        batches.append(batch)
+
+    rng = np.random.default_rng(seed)
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+class _TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields the batches of ``_token_budget_batches()``, reshuffling their order every epoch.
+    """
+    def __init__(self, lengths : list[int], token_budget : int, seed : int = 0):
+        self.lengths = list(lengths)
+        self.token_budget = token_budget
+        self.seed = seed
+        self.epoch = 0
+        self._num_batches = len(_token_budget_batches(self.lengths, token_budget, seed))
+
+    def __iter__(self):
+        batches = _token_budget_batches(self.lengths, self.token_budget, self.seed + self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return self._num_batches
+
+@lru_cache(maxsize=None)
+def _get_token_budget_trainer() -> type:
+    """
+    Return the ``SFTTrainer`` subclass which forms each training batch from a token budget instead of a fixed number of samples.
+    It is only defined the first time it is needed, so that trl is not imported until then.
+    """
+    from trl import SFTTrainer
+
+    class _TokenBudgetTrainer(SFTTrainer):
+        def __init__(self, *args, token_budget : int, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.token_budget = token_budget
+
+        def get_train_dataloader(self) -> torch.utils.data.DataLoader:
+            batch_sampler = _TokenBudgetBatchSampler(self.train_dataset["length"], self.token_budget, seed=self.args.seed)
+            dataloader = torch.utils.data.DataLoader(
+                self.train_dataset,
+                batch_sampler=batch_sampler,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory
+            )
+            return self.accelerator.prepare(dataloader)
+
+    return _TokenBudgetTrainer
+
+def finetune(model : AutoModelForCausalLM, tokenizer : AutoTokenizer, train_dataset : Dataset, lora_config : LoraConfig, sft_config : SFTConfig, output_dir : str | None = None,
+             data_config : TrainingDataConfig | None = None) -> TrainingThroughput | None:
     """Fine-tune an LLM using LoRA and save the resulting adapters in ``output_dir``. The LLM specified in ``model`` **will** be modified by this function.
 
     Args:
@@ -305,25 +775,162 @@ def finetune(model : AutoModelForCausalLM, tokenizer : AutoTokenizer, train_data
         lora_config (LoraConfig): LoRA hyperparameters, including the rank of the adapters and the scaling factor.
         sft_config (SFTConfig): Fine-tuning training configuration, including number of epochs, checkpoints, etc.
         output_dir (str, optional): Where to save the fine-tuned model to. Defaults to ``sft_config.output_dir``.
+        data_config (TrainingDataConfig, optional): If given, the dataset is tokenized (and optionally packed) ahead of time and batched
+                                                    as configured, instead of being prepared by ``SFTTrainer``. Defaults to None.
+
+    Returns:
+        throughput (TrainingThroughput | None): The training throughput and padding ratio, if ``data_config`` was given.
+                                                Only measured with ``sft_config.dataloader_num_workers`` set to 0.
     """
+    from peft import AutoPeftModelForCausalLM, prepare_model_for_kbit_training, get_peft_model
+    from trl import SFTTrainer
+
     if output_dir is None:
         output_dir = sft_config.output_dir
+
+    # Make the initial LoRA weights reproducible.
+    set_seed(sft_config.seed)
     
     if type(model) is not AutoPeftModelForCausalLM:
         model = prepare_model_for_kbit_training(model)
         model = get_peft_model(model, lora_config)
 
-    trainer = SFTTrainer(
+    if data_config is None:
+        trainer = SFTTrainer(
+            model=model,
+            processing_class=tokenizer,
+            args=sft_config,
+            train_dataset=train_dataset,
+        )
+
+        trainer.train()
+        trainer.save_model(output_dir)
+        return None
+
+    train_dataset = tokenize_training_dataset(train_dataset, tokenizer, data_config.max_length, data_config.completion_only_loss,
+                                              truncation=data_config.truncation)
+    num_truncated = int(np.sum(_get_column(train_dataset, "truncated"))) if data_config.truncation is not None else 0
+    if data_config.packing:
+        train_dataset = pack_dataset(train_dataset, data_config.max_length)
+
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    data_collator = TrainingDataCollator(pad_token_id, dtype=model.dtype)
+
+    # The dataset is already tokenized, so SFTTrainer must not prepare it or remove its columns.
+    sft_config = copy(sft_config)
+    sft_config.remove_unused_columns = False
+    sft_config.dataset_kwargs = {**(sft_config.dataset_kwargs or {}), "skip_prepare_dataset" : True}
+
+    trainer_kwargs = {"token_budget" : data_config.token_budget} if data_config.token_budget is not None else {}
+    trainer = (_get_token_budget_trainer() if data_config.token_budget is not None else SFTTrainer)(
         model=model,
         processing_class=tokenizer,
         args=sft_config,
         train_dataset=train_dataset,
+        data_collator=data_collator,
+        **trainer_kwargs
     )
 
-    trainer.train()
+    train_output = trainer.train()
     trainer.save_model(output_dir)
 
-def load_finetuned_llm(model_directory : str, device_map : str = "cuda:0", quantized:bool = True) -> tuple[AutoPeftModelForCausalLM, AutoTokenizer]:
+    train_time = train_output.metrics.get("train_runtime", 0.0)
+    return TrainingThroughput(
+        num_sequences=data_collator.num_sequences,
+        num_tokens=data_collator.num_tokens,
+        num_padded_tokens=data_collator.num_padded_tokens,
+        padding_ratio=1 - data_collator.num_tokens / data_collator.num_padded_tokens if data_collator.num_padded_tokens > 0 else 0.0,
+        train_time=train_time,
+        tokens_per_second=data_collator.num_tokens / train_time if train_time > 0 else 0.0,
+        num_truncated=num_truncated
+    )
+
+def _get_merged_fingerprint(model_directory : str) -> str:
+    """
+    Return a fingerprint of a fine-tuned LoRA adapter and the base model it was trained on.
+
+    The adapter's configuration and weights are small, so they are hashed in full. The base model is identified by its
+    name and revision, and if it is a local folder, also by its configuration and the name and size of each weight file.
+    """
+    from peft import PeftConfig
+
+    config = PeftConfig.from_pretrained(model_directory)
+
+    fingerprint = hashlib.sha256()
+    for file_name in sorted(os.listdir(model_directory)):
+        if file_name == "adapter_config.json" or file_name.startswith("adapter_model"):
+            fingerprint.update(file_name.encode("utf-8"))
+            with open(os.path.join(model_directory, file_name), "rb") as f:
+                for block in iter(lambda : f.read(1 << 20), b""):
+                    fingerprint.update(block)
+
+    base_model = config.base_model_name_or_path
+    fingerprint.update(json.dumps([base_model, config.revision]).encode("utf-8"))
+    if os.path.isdir(base_model):
+        for file_name in sorted(os.listdir(base_model)):
+            path = os.path.join(base_model, file_name)
+            if file_name == "config.json":
+                with open(path, "rb") as f: fingerprint.update(f.read())
+            elif file_name.endswith((".safetensors", ".bin")):
+                fingerprint.update(f"{file_name}:{os.path.getsize(path)}".encode("utf-8"))
+
+    return fingerprint.hexdigest()[0:16]
+
+def export_merged_llm(model_directory : str, cache_dir : str | None = None, torch_dtype : str | torch.dtype = "auto") -> str:
+    """
+    Merge a fine-tuned LoRA adapter into the weights of its base model, and save the merged model as a ready-to-serve checkpoint.
+
+    A merged model runs exactly like the base model, without the extra matrix multiplications of the LoRA adapters,
+    and can be loaded in a single step. The checkpoint is saved in ``cache_dir`` under a fingerprint of the adapter and the base model,
+    so merging the same adapter again returns the existing checkpoint. The adapters are merged in full precision,
+    since merging into 4-bit quantized weights loses accuracy. Quantize the merged model when loading it instead.
+
+    Args:
+        model_directory (str): Where the fine-tuned LoRA adapter was saved by ``finetune()``.
+        cache_dir (str, optional): The folder to save merged checkpoints in. Defaults to a ``merged`` folder inside ``model_directory``.
+        torch_dtype (str | torch.dtype, optional): The dtype to merge and save the weights in. Defaults to "auto" (the dtype of the base model checkpoint).
+
+    Returns:
+        path (str): The folder of the merged checkpoint. Load it with ``load_finetuned_llm(model_directory, merged=True)``
+                    or ``AutoModelForCausalLM.from_pretrained(path)``.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(model_directory, "merged")
+
+    fingerprint = _get_merged_fingerprint(model_directory)
+    path = os.path.join(cache_dir, fingerprint)
+    if os.path.isdir(path):
+        return path
+
+    from peft import PeftConfig, AutoPeftModelForCausalLM
+
+    start_time = time.perf_counter()
+
+    config = PeftConfig.from_pretrained(model_directory)
+    model = AutoPeftModelForCausalLM.from_pretrained(model_directory, device_map="cpu", torch_dtype=torch_dtype)
+    model = model.merge_and_unload()
+    tokenizer = AutoTokenizer.from_pretrained(config.base_model_name_or_path)
+
+    # Save into a temporary folder first so that an interrupted export is never loaded.
+    temp_path = path + ".tmp"
+    if os.path.isdir(temp_path): shutil.rmtree(temp_path)
+    model.save_pretrained(temp_path, safe_serialization=True)
+    tokenizer.save_pretrained(temp_path)
+
+    merge_info = {
+        "fingerprint" : fingerprint,
+        "adapter" : os.path.abspath(model_directory),
+        "base_model" : config.base_model_name_or_path,
+        "merge_time" : time.perf_counter() - start_time
+    }
+    with open(os.path.join(temp_path, "merge_info.json"), "w", encoding="utf-8") as f:
+        json.dump(merge_info, f, indent=2)
+
+    os.replace(temp_path, path)
+    return path
+
+def load_finetuned_llm(model_directory : str, device_map : str = "cuda:0", quantized:bool = True, merged : bool = False,
+                       cache_dir : str | None = None) -> tuple[AutoPeftModelForCausalLM | AutoModelForCausalLM, AutoTokenizer]:
     """
     Load a finetuned LLM from disk.
 
@@ -331,9 +938,13 @@ def load_finetuned_llm(model_directory : str, device_map : str = "cuda:0", quant
         model_directory (str): Where to load the fine-tuned model.
         device_map (str, optional): Which device to load the fine-tuned model onto. Defaults to "cuda:0".
         quantized (bool, optional): Whether to load the model with 4-bit quantization. Defaults to True.
+        merged (bool, optional): Whether to load the LoRA adapter merged into the base model (see ``export_merged_llm()``) instead of
+                                 running the adapter on top of the base model. The merged checkpoint is exported the first time,
+                                 and loaded directly from ``cache_dir`` afterwards. Defaults to False.
+        cache_dir (str, optional): Where merged checkpoints are saved. See ``export_merged_llm()``. Defaults to None.
 
     Returns:
-        model (AutoPeftModelForCausalLM): The fine-tuned LLM.
+        model (AutoPeftModelForCausalLM | AutoModelForCausalLM): The fine-tuned LLM. A plain ``AutoModelForCausalLM`` if ``merged`` is True.
         tokenizer (AutoTokenizer): The tokenizer (unchanged from the base model).
     """
 
@@ -344,6 +955,14 @@ def load_finetuned_llm(model_directory : str, device_map : str = "cuda:0", quant
         bnb_4bit_compute_dtype=torch.float16
     ) if quantized else None
 
+    if merged:
+        path = export_merged_llm(model_directory, cache_dir)
+        tokenizer = AutoTokenizer.from_pretrained(path)
+        model = AutoModelForCausalLM.from_pretrained(path, device_map=device_map, quantization_config=bnb_config, torch_dtype="auto")
+        return (model, tokenizer)
+
+    from peft import PeftConfig, AutoPeftModelForCausalLM
+
     config = PeftConfig.from_pretrained(model_directory)
 
     tokenizer = AutoTokenizer.from_pretrained(config.base_model_name_or_path)
@@ -351,7 +970,26 @@ def load_finetuned_llm(model_directory : str, device_map : str = "cuda:0", quant
 
     return (model, tokenizer)
 
-def _format_prompt(prompt : str | dict, tokenizer : AutoTokenizer) -> str:
+@dataclass(frozen=True)
+class TokenizedPrompt:
+    """
+    A prompt which already has its chat template applied and has been tokenized, so it can be passed to
+    ``generate_batch()`` or ``score_labels()`` without any further formatting or tokenization.
+    Use ``tokenize_prompts()`` to create them.
+
+    Args:
+        text (str): The prompt with chat template applied, in string format.
+        input_ids (list[int]): The token IDs of ``text``.
+        prefix_length (int, optional): How many characters of ``text`` belong to the prefix shared by all prompts
+                                       with the same instructions. See ``_split_prompt_prefix()``. Defaults to 0.
+        truncated (bool, optional): Whether the text sample in the prompt was truncated. See ``truncate_texts()``. Defaults to False.
+    """
+    text : str
+    input_ids : list[int]
+    prefix_length : int = 0
+    truncated : bool = False
+
+def _format_prompt(prompt : str | dict | TokenizedPrompt, tokenizer : AutoTokenizer) -> str:
     """
     Convert an LLM prompt into string format with a chat template
     and special tokens.
@@ -365,6 +1003,9 @@ def _format_prompt(prompt : str | dict, tokenizer : AutoTokenizer) -> str:
     Returns:
         prompt (str): The prompt with chat template applied converted to string format using special tokens.
     """
+    if isinstance(prompt, TokenizedPrompt):
+        return prompt.text
+
     if type(prompt) is str:
         prompt = [{"role": "user", "content": prompt}]
     
@@ -374,6 +1015,188 @@ def _format_prompt(prompt : str | dict, tokenizer : AutoTokenizer) -> str:
 
     return prompt
 
+def _split_prompt_prefix(prompt : str | dict | TokenizedPrompt, tokenizer : AutoTokenizer) -> tuple[str, str]:
+    """
+    Split a prompt with chat template applied into the prefix shared by all prompts
+    with the same instructions (special tokens, system prompt and prior chat history)
+    and the suffix containing the final user message.
+
+    Args:
+        prompt (str | dict | TokenizedPrompt): The prompt for the LLM. See ``generate()``.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+
+    Returns:
+        prefix (str): The formatted prompt up to the content of the final message. Empty if the prompt could not be split.
+        suffix (str): The rest of the formatted prompt.
+    """
+    if isinstance(prompt, TokenizedPrompt):
+        return (prompt.text[:prompt.prefix_length], prompt.text[prompt.prefix_length:])
+
+    formatted_prompt = _format_prompt(prompt, tokenizer)
+    prefix = _get_prompt_prefix(prompt, tokenizer)
+
+    if not formatted_prompt.startswith(prefix):
+        return ("", formatted_prompt)
+
+    return (prefix, formatted_prompt[len(prefix):])
+
+def _get_prompt_template(prompt : str | dict) -> list[dict]:
+    """
+    Return a copy of a prompt in chat template format with a placeholder (``"\\x00"``) in place of the final message's content.
+    """
+    if type(prompt) is str:
+        prompt = [{"role": "user", "content": prompt}]
+
+    template = [dict(message) for message in prompt]
+    template[-1]["content"] = "\x00"
+    return template
+
+def _get_prompt_prefix(prompt : str | dict, tokenizer : AutoTokenizer) -> str:
+    """
+    Return the formatted prefix of a prompt up to the content of its final message. See ``_split_prompt_prefix()``.
+
+    Returns:
+        prefix (str): The prefix, or an empty string if the prompt could not be split.
+    """
+    # Format the prompt with a placeholder for the final message's content,
+    # then use the placeholder to find where the shared prefix ends.
+    placeholder = "\x00"
+    prefix = _format_prompt(_get_prompt_template(prompt), tokenizer).split(placeholder)[0]
+
+    if placeholder in prefix:
+        return ""
+    return prefix
+
+def tokenize_prompts(prompts : list, tokenizer : AutoTokenizer) -> list[TokenizedPrompt]:
+    """
+    Apply the chat template to many prompts and tokenize them all at once.
+
+    The shared prefix of each prompt (see ``_split_prompt_prefix()``) only depends on the messages before
+    the final one, so it is only computed once for each distinct set of instructions.
+
+    Args:
+        prompts (list): The prompts for the LLM. Each prompt can be a string or a chat template (see ``generate()``).
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+
+    Returns:
+        tokenized_prompts (list[TokenizedPrompt]): The formatted and tokenized prompts.
+    """
+    formatted_prompts = [_format_prompt(prompt, tokenizer=tokenizer) for prompt in prompts]
+    input_ids = tokenizer(formatted_prompts, add_special_tokens=False)['input_ids'] if len(prompts) > 0 else []
+
+    prefixes = {}
+    tokenized_prompts = []
+    for prompt, text, ids in zip(prompts, formatted_prompts, input_ids):
+        template = json.dumps(_get_prompt_template(prompt), ensure_ascii=False, sort_keys=True)
+        if template not in prefixes:
+            prefixes[template] = _get_prompt_prefix(prompt, tokenizer)
+        prefix = prefixes[template]
+
+        prefix_length = len(prefix) if text.startswith(prefix) else 0
+        tokenized_prompts.append(TokenizedPrompt(text=text, input_ids=list(ids), prefix_length=prefix_length))
+
+    return tokenized_prompts
+
+def _tokenize_prompts(prompts : list, tokenizer : AutoTokenizer, profiler : InferenceProfiler | None = None) -> list[list[int]]:
+    """
+    Return the token IDs of each prompt with its chat template applied.
+    Prompts which are already a ``TokenizedPrompt`` are not tokenized again.
+    """
+    input_ids = [prompt.input_ids if isinstance(prompt, TokenizedPrompt) else None for prompt in prompts]
+
+    missing = [i for i, ids in enumerate(input_ids) if ids is None]
+    if len(missing) > 0:
+        with profile_stage(profiler, "template"):
+            formatted_prompts = [_format_prompt(prompts[i], tokenizer=tokenizer) for i in missing]
+        with profile_stage(profiler, "tokenize"):
+            tokenized = tokenizer(formatted_prompts, add_special_tokens=False)['input_ids']
+        for i, ids in zip(missing, tokenized):
+            input_ids[i] = ids
+
+    return input_ids
+
+def _pad_left(input_ids : list[list[int]], pad_token_id : int, device) -> dict:
+    """
+    Left-pad sequences of token IDs into a single batch, like ``tokenizer(..., padding=True)`` with ``padding_side="left"``.
+
+    Args:
+        input_ids (list[list[int]]): The token IDs of each sequence.
+        pad_token_id (int): The token to pad with.
+        device: The device to put the batch on.
+
+    Returns:
+        tokenized_input (dict): The padded ``input_ids`` and their ``attention_mask``, both with shape ``(len(input_ids), max_length)``.
+    """
+    max_length = max(len(ids) for ids in input_ids)
+
+    padded_ids = torch.full((len(input_ids), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), max_length), dtype=torch.long)
+    for row, ids in enumerate(input_ids):
+        if len(ids) == 0:
+            continue
+        padded_ids[row, max_length - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, max_length - len(ids):] = 1
+
+    return {"input_ids" : padded_ids.to(device), "attention_mask" : attention_mask.to(device)}
+
+class PrefixCache:
+    """
+    Stores the KV cache (``past_key_values``) of prompt prefixes which are shared by many prompts,
+    such as a long system prompt, so that each prefix is only prefilled once per model and set of active LoRA adapters.
+
+    Pass the same ``PrefixCache`` to ``generate()``, ``generate_batch()`` or ``evaluate.evaluate()``
+    to reuse the cached prefixes between calls.
+
+    Attributes:
+        hits (int): How many times a cached prefix was reused.
+        misses (int): How many times a prefix had to be prefilled.
+    """
+    def __init__(self):
+        # Entries are dropped automatically when their model is garbage collected.
+        self._entries = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prefix : str, model : AutoModelForCausalLM, tokenizer : AutoTokenizer) -> tuple:
+        """
+        Return the token IDs and KV cache of a prompt prefix, prefilling it if it is not cached yet.
+
+        NOTE: The returned KV cache must not be modified. Copy it with ``copy.deepcopy()`` before use.
+
+        Args:
+            prefix (str): The formatted prompt prefix.
+            model (AutoModelForCausalLM): The LLM to use.
+            tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+
+        Returns:
+            prefix_ids (torch.Tensor): The token IDs of the prefix with shape ``(1, prefix_length)``.
+            past_key_values (Cache): The KV cache of the prefix.
+        """
+        entries = self._entries.setdefault(model, {})
+
+        # Models with several LoRA adapters (see ``adapter_registry.AdapterRegistry``) give a different KV cache for each adapter.
+        key = (_get_active_adapters(model), prefix)
+        if key in entries:
+            self.hits += 1
+            return entries[key]
+
+        self.misses += 1
+
+        prefix_ids = tokenizer(prefix, add_special_tokens=False, return_tensors="pt")['input_ids'].to(model.device)
+
+        model.eval()
+        with torch.no_grad():
+            past_key_values = model(input_ids=prefix_ids, use_cache=True).past_key_values
+
+        entries[key] = (prefix_ids, past_key_values)
+        return entries[key]
+
+    def clear(self) -> None:
+        """Remove all cached prefixes and reset the hit/miss counters."""
+        self._entries = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
 def generate(
     prompt : str | dict,
     model : AutoModelForCausalLM,
@@ -385,7 +1208,10 @@ def generate(
     temperature : float | None = None,
     top_p : float | None = None,
     top_k : float | None = None,
-    kwargs : dict = {}
+    kwargs : dict = {},
+    prefix_cache : PrefixCache | None = None,
+    label_names : list | None = None,
+    cache : InferenceCache | None = None
     ) -> str:
     """
     Generate an LLM response to a given query.
@@ -404,10 +1230,30 @@ def generate(
         top_p (float, optional): If set to < 1, only the smallest set of most probable tokens with probabilities that add up to ``top_p`` or higher are kept for generation. Leave empty if ``do_sample`` is False. Defaults to None.
         top_k (float, optional): The number of highest probability vocabulary tokens to keep for top-k-filtering. Leave empty if ``do_sample`` is False. Defaults to None.
         kwargs (dict, optional): Additional parameters to pass into ``model.generate()``. Defaults to {}.
+        prefix_cache (PrefixCache, optional): If given, reuses the KV cache of the prompt's chat template prefix
+                                              (e.g., the system prompt) instead of prefilling it again. Defaults to None.
+        label_names (list, optional): If given, the LLM may only answer with one of these class label names.
+                                      See ``generate_batch()``. Defaults to None.
+        cache (InferenceCache, optional): If given, the response is looked up in and saved to this cache. Defaults to None.
     Returns:
         response (str): The LLM's response.
     """
 
+    if prefix_cache is not None or label_names is not None or cache is not None:
+        return generate_batch([prompt], model, tokenizer,
+                              max_new_tokens=max_new_tokens,
+                              batch_size=1,
+                              response_only=response_only,
+                              skip_special_tokens=skip_special_tokens,
+                              do_sample=do_sample,
+                              temperature=temperature,
+                              top_p=top_p,
+                              top_k=top_k,
+                              kwargs=kwargs,
+                              prefix_cache=prefix_cache,
+                              label_names=label_names,
+                              cache=cache)[0]
+
     # Convert user query into a formatted prompt
     prompt = _format_prompt(prompt, tokenizer=tokenizer)
 
@@ -435,7 +1281,514 @@ def generate(
     output = tokenizer.batch_decode(generation_output, skip_special_tokens=skip_special_tokens)[0]
     return output
 
+class LabelTrie:
+    """
+    Prefix trie of tokenized class label names, used to constrain an LLM to only answer with a class label.
 
+    Args:
+        label_names (list): The class label names.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+    """
+    def __init__(self, label_names : list, tokenizer : AutoTokenizer):
+        self.label_names = list(label_names)
+        self.eos_token_id = tokenizer.eos_token_id
+
+        label_ids = tokenizer(self.label_names, add_special_tokens=False)['input_ids']
+
+        # The longest label, plus one token in case the LLM has to end a label which is a prefix of another.
+        self.max_length = max(len(ids) for ids in label_ids) + 1
+
+        # Each node stores the IDs of all labels which pass through it,
+        # and the ID of the label which ends on it (if any).
+        self._root = {"children" : {}, "labels" : [], "end" : None}
+        for label_id, ids in enumerate(label_ids):
+            node = self._root
+            node["labels"].append(label_id)
+            for token in ids:
+                node = node["children"].setdefault(token, {"children" : {}, "labels" : [], "end" : None})
+                node["labels"].append(label_id)
+            if node["end"] is None:
+                node["end"] = label_id
+
+    def allowed_tokens(self, token_ids : list[int]) -> list[int]:
+        """
+        Return every token which continues ``token_ids`` towards a class label.
+
+        Args:
+            token_ids (list[int]): The tokens generated so far.
+
+        Returns:
+            allowed_tokens (list[int]): The valid next tokens. Empty if ``token_ids`` is not the start of a class label.
+        """
+        node = self._root
+        for token in token_ids:
+            if token not in node["children"]:
+                return []
+            node = node["children"][token]
+
+        allowed_tokens = list(node["children"].keys())
+        # Allow the LLM to stop on a label which is a prefix of another.
+        if node["end"] is not None and self.eos_token_id is not None:
+            allowed_tokens.append(self.eos_token_id)
+        return allowed_tokens
+
+    def resolve(self, token_ids : list[int], strict : bool = True) -> int | None:
+        """
+        Return the ID of the class label identified by ``token_ids``.
+
+        Args:
+            token_ids (list[int]): The tokens generated so far.
+            strict (bool, optional): If True, returns None unless exactly one label starts with ``token_ids``.
+                                     If False, returns the closest matching label instead. Defaults to True.
+
+        Returns:
+            label_id (int | None): The ID of the class label.
+        """
+        node = self._root
+        for token in token_ids:
+            if len(node["labels"]) == 1:
+                break
+            if token == self.eos_token_id and node["end"] is not None:
+                return node["end"]
+            if token not in node["children"]:
+                break
+            node = node["children"][token]
+
+        if len(node["labels"]) == 1:
+            return node["labels"][0]
+        if strict:
+            return None
+        return node["end"] if node["end"] is not None else node["labels"][0]
+
+class _LabelLogitsProcessor(LogitsProcessor):
+    """
+    Masks every token which would not continue the response towards one of the labels in a ``LabelTrie``.
+    """
+    def __init__(self, label_trie : LabelTrie, input_length : int):
+        self.label_trie = label_trie
+        self.input_length = input_length
+
+    def __call__(self, input_ids : torch.LongTensor, scores : torch.FloatTensor) -> torch.FloatTensor:
+        mask = torch.full_like(scores, float("-inf"))
+        for row, token_ids in enumerate(input_ids[:, self.input_length:].tolist()):
+            allowed_tokens = self.label_trie.allowed_tokens(token_ids)
+            # Finished responses are padded by ``model.generate()``, so leave them unconstrained.
+            if len(allowed_tokens) == 0:
+                mask[row] = 0
+            else: mask[row, allowed_tokens] = 0
+        return scores + mask
+
+class _LabelStoppingCriteria(StoppingCriteria):
+    """
+    Stops each response as soon as it identifies exactly one of the labels in a ``LabelTrie``.
+    """
+    def __init__(self, label_trie : LabelTrie, input_length : int):
+        self.label_trie = label_trie
+        self.input_length = input_length
 
-    
+    def __call__(self, input_ids : torch.LongTensor, scores : torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        is_done = [self.label_trie.resolve(token_ids) is not None for token_ids in input_ids[:, self.input_length:].tolist()]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+class _FirstTokenTimer(StoppingCriteria):
+    """
+    Records when ``model.generate()`` produces its first token, which marks the end of the prefill. Never stops generation.
+    """
+    def __init__(self, profiler : InferenceProfiler, device):
+        self.profiler = profiler
+        self.device = device
+        self.time = None
+
+    def __call__(self, input_ids : torch.LongTensor, scores : torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.time is None:
+            self.time = self.profiler.now(self.device)
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+def _bucket_by_length(lengths : list[int], batch_size : int) -> list[list[int]]:
+    """
+    Group sample indices into batches of similar length to minimise padding.
+
+    Args:
+        lengths (list[int]): The length (in tokens) of each sample.
+        batch_size (int): Maximum number of samples per batch.
+
+    Returns:
+        batches (list[list[int]]): Indices of the samples in each batch. If ``batch_size`` is 1, the original order is kept.
+    """
+    batch_size = max(batch_size, 1)
+
+    if batch_size == 1:
+        order = np.arange(len(lengths))
+    else:
+        # Sort longest first so that any out-of-memory errors surface on the first batch.
+        order = np.argsort(-np.asarray(lengths), kind="stable")
+
+    return [order[i:i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+def _run_cached(prompts : list, model : AutoModelForCausalLM, tokenizer : AutoTokenizer, cache : InferenceCache | None, parameters : dict, run,
+                profiler : InferenceProfiler | None = None) -> list:
+    """
+    Run ``run`` on each distinct prompt which is not already in ``cache``, then fan the results back out to every prompt.
+
+    Args:
+        prompts (list): The prompts for the LLM. Each prompt can be a string, a chat template (see ``generate()``), or a ``TokenizedPrompt``.
+        model (AutoModelForCausalLM): The LLM to use.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM.
+        cache (InferenceCache | None): The cache to use. If None, or if ``parameters`` cannot be cached (see ``InferenceCache.can_cache()``),
+                                       duplicate prompts are still only run once.
+        parameters (dict): Every other parameter which affects the output of ``run``.
+        run (Callable): Function which returns the result for each prompt in a list of distinct prompts.
+        profiler (InferenceProfiler, optional): If given, the time spent formatting prompts and using the cache is recorded. Defaults to None.
+
+    Returns:
+        results (list): The result for each prompt.
+    """
+    with profile_stage(profiler, "template"):
+        formatted_prompts = [_format_prompt(prompt, tokenizer=tokenizer) for prompt in prompts]
+
+    if cache is not None and not cache.can_cache(parameters):
+        cache = None
+
+    # Position of the first occurrence of each distinct prompt
+    first_index = {}
+    for i, prompt in enumerate(formatted_prompts):
+        first_index.setdefault(prompt, i)
+
+    results = {}
+    if cache is not None:
+        with profile_stage(profiler, "cache"):
+            keys = {prompt : cache.make_key(model, tokenizer, prompt, parameters) for prompt in first_index}
+            cached = cache.get_many(list(keys.values()))
+            results = {prompt : cached[key] for prompt, key in keys.items() if key in cached}
+
+    missing = [prompt for prompt in first_index if prompt not in results]
+    if len(missing) > 0:
+        outputs = run([prompts[first_index[prompt]] for prompt in missing])
+        results.update(zip(missing, outputs))
+        if cache is not None:
+            with profile_stage(profiler, "cache"):
+                cache.put_many({keys[prompt] : results[prompt] for prompt in missing})
+
+    return [results[prompt] for prompt in formatted_prompts]
+
+def generate_batch(
+    prompts : list,
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    max_new_tokens : int = 64,
+    batch_size : int = 8,
+    response_only : bool = True,
+    skip_special_tokens : bool = True,
+    do_sample : bool = False,
+    temperature : float | None = None,
+    top_p : float | None = None,
+    top_k : float | None = None,
+    kwargs : dict = {},
+    prefix_cache : PrefixCache | None = None,
+    label_names : list | None = None,
+    cache : InferenceCache | None = None,
+    profiler : InferenceProfiler | None = None
+    ) -> list[str]:
+    """
+    Generate LLM responses to many queries at once.
+
+    Prompts are sorted by token length and split into left-padded batches of ``batch_size``,
+    so that each call to ``model.generate()`` wastes as little compute on padding as possible.
+    Responses are returned in the same order as ``prompts``.
+
+    Args:
+        prompts (list): The prompts for the LLM. Each prompt can be a string, a chat template (see ``generate()``), or a ``TokenizedPrompt``.
+        model (AutoModelForCausalLM): The LLM to use. Use ``AutoModelForCausalLM.from_pretrained(model_name)`` to instantiate.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM. Use ``AutoTokenizer.from_pretrained(model_name)`` to instantiate.
+        max_new_tokens (int, optional): Maximum number of tokens for the model to output. Defaults to 64.
+        batch_size (int, optional): Maximum number of prompts to pass to ``model.generate()`` at once. Defaults to 8.
+        response_only (bool, optional): If True, excludes all previous messages from the output. Defaults to True.
+        skip_special_tokens (bool, optional): If True, removes model special tokens from the output. Defaults to True.
+        do_sample (bool, optional): If False, enables deterministic generation. Defaults to False.
+        temperature (float, optional): See ``generate()``. Defaults to None.
+        top_p (float, optional): See ``generate()``. Defaults to None.
+        top_k (float, optional): See ``generate()``. Defaults to None.
+        kwargs (dict, optional): Additional parameters to pass into ``model.generate()``. Defaults to {}.
+        prefix_cache (PrefixCache, optional): If given, reuses the KV cache of the chat template prefix shared by
+                                              each batch of prompts (e.g., the system prompt). Defaults to None.
+        label_names (list, optional): If given, the LLM may only answer with one of these class label names.
+                                      Generation stops as soon as the response identifies exactly one label,
+                                      which is then returned in full as the response. ``max_new_tokens`` and
+                                      ``response_only`` are ignored. Defaults to None.
+        cache (InferenceCache, optional): If given, responses are looked up in and saved to this cache. Defaults to None.
+        profiler (InferenceProfiler, optional): If given, the time taken by each stage of generation and the number of prompt
+                                                and generated tokens are recorded. Defaults to None.
+    Returns:
+        responses (list[str]): The LLM's response to each prompt.
+    """
+    if len(prompts) == 0:
+        return []
+
+    # Deterministic generation always gives the same response to the same prompt,
+    # so only generate a response for each distinct prompt which is not cached yet.
+    if not do_sample and (cache is not None or len(prompts) > 1):
+        parameters = {
+            "method" : "generate",
+            "max_new_tokens" : max_new_tokens,
+            "response_only" : response_only,
+            "skip_special_tokens" : skip_special_tokens,
+            "temperature" : temperature,
+            "top_p" : top_p,
+            "top_k" : top_k,
+            "kwargs" : kwargs,
+            "label_names" : label_names
+        }
+        run = lambda prompts : _generate_batch(prompts, model, tokenizer, max_new_tokens, batch_size, response_only, skip_special_tokens,
+                                               do_sample, temperature, top_p, top_k, kwargs, prefix_cache, label_names, profiler)
+        return _run_cached(prompts, model, tokenizer, cache, parameters, run, profiler)
+
+    return _generate_batch(prompts, model, tokenizer, max_new_tokens, batch_size, response_only, skip_special_tokens,
+                           do_sample, temperature, top_p, top_k, kwargs, prefix_cache, label_names, profiler)
+
+def _generate_batch(
+    prompts : list,
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    max_new_tokens : int,
+    batch_size : int,
+    response_only : bool,
+    skip_special_tokens : bool,
+    do_sample : bool,
+    temperature : float | None,
+    top_p : float | None,
+    top_k : float | None,
+    kwargs : dict,
+    prefix_cache : PrefixCache | None,
+    label_names : list | None,
+    profiler : InferenceProfiler | None = None
+    ) -> list[str]:
+    """
+    Implementation of ``generate_batch()`` without caching or de-duplication of prompts.
+    """
+    if label_names is not None:
+        label_trie = LabelTrie(label_names, tokenizer)
+        max_new_tokens = label_trie.max_length
+
+    # Split each prompt into its shared prefix and the sample-specific suffix.
+    if prefix_cache is not None:
+        with profile_stage(profiler, "template"):
+            prompt_parts = [_split_prompt_prefix(prompt, tokenizer=tokenizer) for prompt in prompts]
+
+    # Convert user queries into formatted, tokenized prompts
+    input_ids = _tokenize_prompts(prompts, tokenizer, profiler)
+    lengths = [len(ids) for ids in input_ids]
+
+    # Batched generation needs a padding token. Fall back to EOS like most decoder-only models do.
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    model.eval()
+
+    responses = [None] * len(prompts)
+
+    for batch in _bucket_by_length(lengths, batch_size):
+
+        past_key_values = None
+        batch_ids = [input_ids[i] for i in batch]
+        batch_kwargs = dict(kwargs)
+
+        # The prefix cache can only be used if every prompt in the batch shares the same prefix.
+        if prefix_cache is not None:
+            prefixes = set(prompt_parts[i][0] for i in batch)
+            prefix = prefixes.pop() if len(prefixes) == 1 else ""
+            if prefix != "":
+                with profile_stage(profiler, "prefill", model.device):
+                    prefix_ids, past_key_values = prefix_cache.get(prefix, model, tokenizer)
+                prefix_length = prefix_ids.shape[1]
+
+                # Only use the cache if the tokens of every full prompt start with the tokens of the prefix.
+                if all(ids[0:prefix_length] == prefix_ids[0].tolist() for ids in batch_ids):
+                    batch_ids = [ids[prefix_length:] for ids in batch_ids]
+                else: past_key_values = None
+
+        # Decoder-only models must be padded on the left, otherwise
+        # the model would continue generating after the padding tokens.
+        tokenized_input = _pad_left(batch_ids, tokenizer.pad_token_id, model.device)
+
+        if past_key_values is not None:
+            # Put the cached prefix in front of the padded suffixes.
+            # The padding ends up between the prefix and each suffix, which the attention mask hides.
+            num_prompts = len(batch)
+            tokenized_input['input_ids'] = torch.cat([prefix_ids.repeat(num_prompts, 1), tokenized_input['input_ids']], dim=1)
+            tokenized_input['attention_mask'] = torch.cat([torch.ones_like(prefix_ids).repeat(num_prompts, 1), tokenized_input['attention_mask']], dim=1)
+
+            # Each generation appends to its KV cache, so work on a copy of the cached prefix.
+            past_key_values = deepcopy(past_key_values)
+            past_key_values.batch_repeat_interleave(num_prompts)
+            batch_kwargs["past_key_values"] = past_key_values
+
+        input_length = tokenized_input['input_ids'].shape[1]
+
+        stopping_criteria = list(kwargs.get("stopping_criteria", []))
+        if label_names is not None:
+            batch_kwargs["logits_processor"] = LogitsProcessorList(list(kwargs.get("logits_processor", [])) + [_LabelLogitsProcessor(label_trie, input_length)])
+            stopping_criteria.append(_LabelStoppingCriteria(label_trie, input_length))
+        if profiler is not None:
+            first_token_timer = _FirstTokenTimer(profiler, model.device)
+            stopping_criteria.append(first_token_timer)
+        if label_names is not None or profiler is not None:
+            batch_kwargs["stopping_criteria"] = StoppingCriteriaList(stopping_criteria)
+
+        if profiler is not None: generation_start = profiler.now(model.device)
+
+        generation_output = model.generate(**tokenized_input,
+                                           max_new_tokens=max_new_tokens,
+                                           do_sample=do_sample,
+                                           temperature=temperature,
+                                           top_p = top_p,
+                                           top_k = top_k,
+                                           pad_token_id=tokenizer.pad_token_id,
+                                           **batch_kwargs)
+
+        if profiler is not None:
+            # Everything up to the first generated token is the prefill, and the rest is decoding.
+            generation_end = profiler.now(model.device)
+            first_token_time = first_token_timer.time if first_token_timer.time is not None else generation_end
+            profiler.record("prefill", generation_start, first_token_time - generation_start)
+            profiler.record("decode", first_token_time, generation_end - first_token_time)
+            profiler.add_tokens(
+                prompt_tokens=sum(len(input_ids[i]) for i in batch),
+                generated_tokens=(generation_output[:, input_length:] != tokenizer.pad_token_id).sum().item()
+            )
+
+        with profile_stage(profiler, "detokenize"):
+            if label_names is not None:
+                # Return the full name of the class label each response identifies
+                outputs = [label_names[label_trie.resolve(token_ids, strict=False)] for token_ids in generation_output[:, input_length:].tolist()]
+            else:
+                # If required, remove the tokens belonging to the prompts
+                if response_only:
+                    generation_output = generation_output[:, input_length:]
+                outputs = tokenizer.batch_decode(generation_output, skip_special_tokens=skip_special_tokens)
+
+        # Map each response back to the position of its prompt
+        for i, output in zip(batch, outputs):
+            responses[i] = output
+
+    return responses
+
+def score_labels(
+    prompts : list,
+    label_names : list,
+    model : AutoModelForCausalLM,
+    tokenizer : AutoTokenizer,
+    batch_size : int = 8,
+    cache : InferenceCache | None = None,
+    profiler : InferenceProfiler | None = None
+    ) -> np.ndarray:
+    """
+    Compute the log-likelihood of every class label name as the LLM's response to each prompt, without generating any text.
+
+    Each prompt is prefilled once. Its KV cache is then repeated for every label so that
+    all label continuations are scored with a single extra forward pass.
+    Note that each batch holds ``batch_size * len(label_names)`` copies of the KV cache.
+
+    Args:
+        prompts (list): The prompts for the LLM. Each prompt can be a string, a chat template (see ``generate()``), or a ``TokenizedPrompt``.
+        label_names (list): The class label names to score.
+        model (AutoModelForCausalLM): The LLM to use. Use ``AutoModelForCausalLM.from_pretrained(model_name)`` to instantiate.
+        tokenizer (AutoTokenizer): The tokenizer to use. Should come with the LLM. Use ``AutoTokenizer.from_pretrained(model_name)`` to instantiate.
+        batch_size (int, optional): Maximum number of prompts to prefill at once. Defaults to 8.
+        cache (InferenceCache, optional): If given, scores are looked up in and saved to this cache. Defaults to None.
+        profiler (InferenceProfiler, optional): If given, the time taken by each stage of scoring and the number of prompt tokens are recorded. Defaults to None.
+
+    Returns:
+        scores (np.ndarray): Array of shape ``(len(prompts), len(label_names))`` containing the total log-probability of each label for each prompt.
+    """
+    if len(prompts) == 0:
+        return np.zeros((0, len(label_names)))
+
+    # Only score each distinct prompt which is not cached yet.
+    if cache is not None or len(prompts) > 1:
+        run = lambda prompts : _score_labels(prompts, label_names, model, tokenizer, batch_size, profiler).tolist()
+        scores = _run_cached(prompts, model, tokenizer, cache, {"method" : "score", "label_names" : label_names}, run, profiler)
+        return np.array(scores, dtype=float).reshape(len(prompts), len(label_names))
+
+    return _score_labels(prompts, label_names, model, tokenizer, batch_size, profiler)
+
+def _score_labels(prompts : list, label_names : list, model : AutoModelForCausalLM, tokenizer : AutoTokenizer, batch_size : int,
+                  profiler : InferenceProfiler | None = None) -> np.ndarray:
+    """
+    Implementation of ``score_labels()`` without caching or de-duplication of prompts.
+    """
+    input_ids = _tokenize_prompts(prompts, tokenizer, profiler)
+    lengths = [len(ids) for ids in input_ids]
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    # Tokenize every label once and right-pad them into a single tensor.
+    label_ids = tokenizer(label_names, add_special_tokens=False)['input_ids']
+    num_labels = len(label_ids)
+    max_label_length = max(len(ids) for ids in label_ids)
+
+    label_tokens = torch.full((num_labels, max_label_length), tokenizer.pad_token_id, dtype=torch.long)
+    label_mask = torch.zeros((num_labels, max_label_length), dtype=torch.long)
+    for i, ids in enumerate(label_ids):
+        label_tokens[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        label_mask[i, :len(ids)] = 1
+
+    label_tokens = label_tokens.to(model.device)
+    label_mask = label_mask.to(model.device)
+
+    model.eval()
+
+    scores = np.zeros((len(prompts), num_labels))
+
+    for batch in _bucket_by_length(lengths, batch_size):
+
+        tokenized_input = _pad_left([input_ids[i] for i in batch], tokenizer.pad_token_id, model.device)
+
+        num_prompts = len(batch)
+
+        # Left padding shifts each prompt, so count positions from the first real token like ``model.generate()`` does.
+        position_ids = (tokenized_input['attention_mask'].cumsum(dim=1) - 1).clamp(min=0)
+
+        with torch.no_grad():
+            # Prefill every prompt once.
+            with profile_stage(profiler, "prefill", model.device):
+                prompt_output = model(**tokenized_input, position_ids=position_ids, use_cache=True)
+            if profiler is not None: profiler.add_tokens(prompt_tokens=tokenized_input['attention_mask'].sum().item())
+
+            # Score every label on top of the prompt.
+            with profile_stage(profiler, "score", model.device):
+                # The first token of each label is predicted by the final prompt position.
+                log_probs = torch.log_softmax(prompt_output.logits[:, -1, :].float(), dim=-1)
+                log_probs = log_probs.repeat_interleave(num_labels, dim=0).unsqueeze(1)
+
+                # Score the remaining label tokens on top of the prompt's KV cache.
+                # The final label token is never fed in because its predictions are not needed.
+                if max_label_length > 1:
+                    cache = prompt_output.past_key_values
+                    cache.batch_repeat_interleave(num_labels)
+
+                    prompt_mask = tokenized_input['attention_mask'].repeat_interleave(num_labels, dim=0)
+                    continuation_mask = label_mask[:, :-1].repeat(num_prompts, 1)
+
+                    # Continue counting positions from the end of each prompt.
+                    position_ids = prompt_mask.sum(dim=1, keepdim=True) + torch.arange(max_label_length - 1, device=model.device)
+
+                    label_output = model(
+                        input_ids=label_tokens[:, :-1].repeat(num_prompts, 1),
+                        attention_mask=torch.cat([prompt_mask, continuation_mask], dim=1),
+                        position_ids=position_ids,
+                        past_key_values=cache,
+                        use_cache=True
+                    )
+                    continuation_log_probs = torch.log_softmax(label_output.logits.float(), dim=-1)
+                    log_probs = torch.cat([log_probs, continuation_log_probs], dim=1)
+
+                # Sum the log-probability of every token in each label, ignoring padding.
+                targets = label_tokens.repeat(num_prompts, 1)
+                token_log_probs = log_probs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+                token_log_probs = token_log_probs * label_mask.repeat(num_prompts, 1)
+                batch_scores = token_log_probs.sum(dim=1).view(num_prompts, num_labels)
+
+        scores[batch] = batch_scores.cpu().numpy()
 
+    return scores
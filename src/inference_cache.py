@@ -0,0 +1,329 @@
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from collections import OrderedDict
+import hashlib, json, os, sqlite3, threading, time
+import weakref
+import torch
+
+# Fingerprints are expensive to compute for large models, so only compute them once per object.
+_model_fingerprints = weakref.WeakKeyDictionary()
+_tokenizer_fingerprints = weakref.WeakKeyDictionary()
+
+def _get_active_adapters(model : AutoModelForCausalLM) -> tuple[str, ...]:
+    """
+    Return the names of the LoRA adapters which are active on a PEFT model, or an empty tuple for a model without adapters.
+    """
+    if not hasattr(model, "peft_config"):
+        return ()
+    try:
+        active = model.active_adapters
+        if callable(active): active = active()
+    except ValueError:
+        return ()
+    if isinstance(active, str): active = [active]
+    return tuple(active or ())
+
+def _get_adapter_name(tensor_name : str) -> str | None:
+    """
+    Return the name of the LoRA adapter a tensor belongs to (e.g. "default" for ``...q_proj.lora_A.default.weight``),
+    or None if it belongs to the base model.
+    """
+    parts = tensor_name.split(".")
+    for i, part in enumerate(parts[:-1]):
+        if part.startswith("lora_"):
+            return parts[i + 1]
+    return None
+
+def fingerprint_model(model : AutoModelForCausalLM, sample_size : int = 1024) -> str:
+    """
+    Compute a fingerprint of an LLM's weights, including any active LoRA adapters.
+
+    Hashing every weight of a multi-billion parameter model would take too long, so only the name, shape, dtype and
+    the first and last ``sample_size`` values of each base model tensor are hashed. LoRA adapter tensors are small
+    and are always hashed in full, but only for the adapters which are active, so switching between the adapters loaded
+    on a model changes its fingerprint. The fingerprint is computed once per model object and set of active adapters,
+    so it will not change if the model is modified in place afterwards (e.g., by ``finetune.finetune()``).
+    Use ``forget_model_fingerprint()`` after replacing the weights of an adapter.
+
+    Args:
+        model (AutoModelForCausalLM): The LLM to fingerprint.
+        sample_size (int, optional): How many values to hash from each end of each base model tensor. Defaults to 1024.
+
+    Returns:
+        fingerprint (str): Hex digest identifying the model's weights.
+    """
+    adapters = _get_active_adapters(model)
+    fingerprints = _model_fingerprints.setdefault(model, {})
+    if adapters in fingerprints:
+        return fingerprints[adapters]
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(model.config.to_json_string().encode("utf-8"))
+
+    with torch.no_grad():
+        for name, tensor in model.state_dict().items():
+            # Inactive adapters do not affect the model's output.
+            adapter = _get_adapter_name(name)
+            if adapter is not None and len(adapters) > 0 and adapter not in adapters:
+                continue
+
+            fingerprint.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode("utf-8"))
+
+            # Weights which are offloaded to the meta device have no values to hash.
+            if tensor.device.type == "meta":
+                continue
+
+            values = tensor.detach().flatten()
+            if "lora_" not in name and values.numel() > 2 * sample_size:
+                values = torch.cat([values[0:sample_size], values[-sample_size:]])
+
+            fingerprint.update(values.cpu().contiguous().view(torch.uint8).numpy().tobytes())
+
+    fingerprints[adapters] = fingerprint.hexdigest()
+    return fingerprints[adapters]
+
+def forget_model_fingerprint(model : AutoModelForCausalLM) -> None:
+    """
+    Forget every fingerprint computed for ``model``, so that ``fingerprint_model()`` hashes its weights again.
+    """
+    _model_fingerprints.pop(model, None)
+
+def fingerprint_tokenizer(tokenizer : AutoTokenizer) -> str:
+    """
+    Compute a fingerprint of a tokenizer's vocabulary, special tokens, and chat template.
+
+    Args:
+        tokenizer (AutoTokenizer): The tokenizer to fingerprint.
+
+    Returns:
+        fingerprint (str): Hex digest identifying the tokenizer.
+    """
+    if tokenizer in _tokenizer_fingerprints:
+        return _tokenizer_fingerprints[tokenizer]
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(str(tokenizer.chat_template).encode("utf-8"))
+    fingerprint.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+
+    # Fast tokenizers can serialise their entire vocabulary and merge rules.
+    if hasattr(tokenizer, "backend_tokenizer"):
+        fingerprint.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        fingerprint.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode("utf-8"))
+
+    _tokenizer_fingerprints[tokenizer] = fingerprint.hexdigest()
+    return _tokenizer_fingerprints[tokenizer]
+
+class InferenceCache:
+    """
+    Persistent cache of LLM outputs, so that the same prompt never has to be run through the same LLM twice.
+
+    Results are stored in an SQLite database on disk, with a least-recently-used (LRU) layer in memory in front of it.
+    When the database grows larger than ``max_disk_size`` bytes, the least recently used results are evicted.
+
+    Pass an ``InferenceCache`` to ``finetune.generate()``, ``finetune.generate_batch()``, ``finetune.score_labels()``
+    or ``evaluate.evaluate()`` to use it. Outputs are only cached for deterministic generation (``do_sample=False``)
+    and generation ``kwargs`` which can be serialised to JSON.
+
+    Args:
+        path (str | None, optional): Where to store the database. If None, results are only cached in memory. Defaults to "inference_cache.sqlite".
+        max_memory_items (int, optional): How many results to keep in memory. Defaults to 4096.
+        max_disk_size (int, optional): Maximum total size of all results stored on disk in bytes. Defaults to 1 GiB.
+
+    Attributes:
+        hits (int): How many results were found in the cache.
+        misses (int): How many results were not found in the cache.
+    """
+    def __init__(self, path : str | None = "inference_cache.sqlite", max_memory_items : int = 4096, max_disk_size : int = 2**30):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_size = max_disk_size
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+
+        if path is not None:
+            if os.path.dirname(path) != "":
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+            self._connection.commit()
+
+    @staticmethod
+    def can_cache(parameters : dict) -> bool:
+        """
+        Return whether outputs produced with ``parameters`` can be cached.
+
+        Parameters which cannot be serialised to JSON (e.g. stopping criteria or logits processors passed in
+        the generation ``kwargs``) have no stable description, so outputs produced with them are never cached.
+        """
+        try:
+            json.dumps(parameters, sort_keys=True)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def make_key(self, model : AutoModelForCausalLM, tokenizer : AutoTokenizer, prompt : str, parameters : dict) -> str:
+        """
+        Build the cache key for an LLM output.
+
+        Args:
+            model (AutoModelForCausalLM): The LLM which produces the output.
+            tokenizer (AutoTokenizer): The tokenizer used by the LLM.
+            prompt (str): The prompt with chat template applied.
+            parameters (dict): Every other parameter which affects the output, e.g., ``max_new_tokens``. Must be serialisable to JSON
+                               (see ``can_cache()``).
+
+        Returns:
+            key (str): The cache key.
+        """
+        if not self.can_cache(parameters):
+            raise ValueError("Outputs can only be cached for parameters which can be serialised to JSON.")
+
+        key = hashlib.sha256()
+        key.update(fingerprint_model(model).encode("utf-8"))
+        key.update(fingerprint_tokenizer(tokenizer).encode("utf-8"))
+        key.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+        key.update(prompt.encode("utf-8"))
+        return key.hexdigest()
+
+    def get_many(self, keys : list[str]) -> dict:
+        """
+        Look up many results at once.
+
+        Args:
+            keys (list[str]): The cache keys to look up.
+
+        Returns:
+            results (dict): The cached result for every key which was found.
+        """
+        results = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    results[key] = self._memory[key]
+                else: missing.append(key)
+
+            if self._connection is not None and len(missing) > 0:
+                # SQLite limits how many parameters a query can have, so look keys up in chunks.
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = self._connection.execute(
+                        f"SELECT key, value FROM results WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                    for key, value in rows:
+                        results[key] = json.loads(value)
+                        self._remember(key, results[key])
+
+                    self._connection.executemany(
+                        "UPDATE results SET last_access = ? WHERE key = ?", [(time.time(), key) for key, _ in rows]
+                    )
+                self._connection.commit()
+
+            self.hits += len(results)
+            self.misses += len(keys) - len(results)
+        return results
+
+    def get(self, key : str):
+        """
+        Look up a single result.
+
+        Args:
+            key (str): The cache key to look up.
+
+        Returns:
+            result: The cached result, or None if it was not found.
+        """
+        return self.get_many([key]).get(key)
+
+    def put_many(self, results : dict) -> None:
+        """
+        Store many results at once, evicting the least recently used results on disk if the cache is full.
+
+        Args:
+            results (dict): The results to store, indexed by cache key. Results must be JSON serialisable.
+        """
+        with self._lock:
+            for key, value in results.items():
+                self._remember(key, value)
+
+            if self._connection is None or len(results) == 0:
+                return
+
+            now = time.time()
+            rows = []
+            for key, value in results.items():
+                value = json.dumps(value, ensure_ascii=False)
+                rows.append((key, value, len(value.encode("utf-8")), now))
+
+            self._connection.executemany("INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+            self._connection.commit()
+
+    def put(self, key : str, value) -> None:
+        """
+        Store a single result.
+
+        Args:
+            key (str): The cache key.
+            value: The result to store. Must be JSON serialisable.
+        """
+        self.put_many({key : value})
+
+    def _remember(self, key : str, value) -> None:
+        """
+        Add a result to the in-memory LRU layer, dropping the least recently used result if it is full.
+        """
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self) -> None:
+        """
+        Delete the least recently used results on disk until their total size is within ``max_disk_size``.
+        """
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total_size <= self.max_disk_size:
+            return
+
+        evicted = []
+        for key, size in self._connection.execute("SELECT key, size FROM results ORDER BY last_access ASC"):
+            if total_size <= self.max_disk_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+
+        self._connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._connection is None:
+                return len(self._memory)
+            return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def clear(self) -> None:
+        """Remove every cached result and reset the hit/miss counters."""
+        with self._lock:
+            self._memory.clear()
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM results")
+                self._connection.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def close(self) -> None:
+        """Close the database. The cache cannot be used afterwards."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,262 @@
+from dataclasses import dataclass
+from contextlib import contextmanager, nullcontext
+import json, os, sys, time
+import pandas as pd
+import torch
+
+# Stages of inference which are timed by ``InferenceProfiler``, in the order they happen.
+STAGES = ("template", "tokenize", "cache", "prefill", "decode", "score", "detokenize", "parse")
+
+@dataclass
+class StageEvent:
+    """
+    A single timed stage of inference, recorded by ``InferenceProfiler``.
+
+    Args:
+        stage (str): The name of the stage. See ``STAGES``.
+        batch (int): The batch which the stage belongs to, or -1 if it happened outside of a batch.
+        start (float): When the stage started in seconds, relative to when the profiler was created.
+        duration (float): How long the stage took in seconds.
+    """
+    stage : str
+    batch : int
+    start : float
+    duration : float
+
+@dataclass
+class BatchProfile:
+    """
+    Token counts, timings and memory usage of a single batch of samples, recorded by ``InferenceProfiler``.
+
+    Args:
+        batch (int): The position of the batch in the profile.
+        indices (list[int]): The row of each sample in the batch.
+        start (float): When the batch started in seconds, relative to when the profiler was created.
+        duration (float): How long the batch took in seconds.
+        prompt_tokens (int): How many prompt tokens were run through the LLM for the batch, excluding padding.
+        generated_tokens (int): How many tokens the LLM generated for the batch, excluding padding.
+        peak_memory (int | None): The peak memory usage during the batch in bytes. For models on a GPU, this is the peak
+                                  memory allocated by PyTorch on the GPU. Otherwise, it is the peak resident set size
+                                  of the process so far. None if it could not be measured.
+    """
+    batch : int
+    indices : list[int]
+    start : float
+    duration : float = 0.0
+    prompt_tokens : int = 0
+    generated_tokens : int = 0
+    peak_memory : int | None = None
+
+    @property
+    def tokens_per_second(self) -> float:
+        """How many tokens the LLM generated per second for the batch."""
+        return self.generated_tokens / self.duration if self.duration > 0 else 0.0
+
+def _is_cuda(device) -> bool:
+    return device is not None and torch.device(device).type == "cuda"
+
+def _get_peak_memory(device) -> int | None:
+    """
+    Return the peak memory usage in bytes. See ``BatchProfile.peak_memory``.
+    """
+    if _is_cuda(device):
+        return torch.cuda.max_memory_allocated(device)
+
+    try:
+        import resource
+    except ImportError: # Not available on Windows
+        return None
+
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports the peak resident set size in kilobytes, macOS in bytes.
+    return peak_memory if sys.platform == "darwin" else peak_memory * 1024
+
+class InferenceProfiler:
+    """
+    Records how long each stage of inference takes, along with token counts and peak memory usage for each batch.
+
+    Pass an ``InferenceProfiler`` to ``finetune.generate_batch()``, ``finetune.score_labels()`` or ``evaluate.evaluate()``
+    to use it. Timings come from ``time.perf_counter()``, which is monotonic and has the highest available resolution.
+
+    The stages are (see ``STAGES``):
+    - "template": Applying the chat template to each prompt.
+    - "tokenize": Tokenizing each formatted prompt.
+    - "cache": Looking up and storing results in an ``InferenceCache``.
+    - "prefill": Running the prompt through the LLM up to its first generated token.
+    - "decode": Generating every other token.
+    - "score": Scoring every class label on top of the prompt (``EvaluationConfig.method`` "score"), or running an ``EmbeddingClassifier``.
+    - "detokenize": Decoding the generated tokens back into text.
+    - "parse": Extracting the class label from each response.
+
+    Args:
+        synchronize (bool, optional): Whether to wait for the GPU to finish its work before timing each stage.
+                                      This makes GPU timings accurate, but slows inference down slightly. Defaults to True.
+
+    Attributes:
+        events (list[StageEvent]): Every timed stage.
+        batches (list[BatchProfile]): Every profiled batch.
+    """
+    def __init__(self, synchronize : bool = True):
+        self.synchronize = synchronize
+        self.events = []
+        self.batches = []
+        self._origin = time.perf_counter()
+        self._batch = None
+
+    def now(self, device = None) -> float:
+        """
+        Return the time in seconds since the profiler was created, waiting for ``device`` to finish its work first.
+        """
+        if self.synchronize and _is_cuda(device):
+            torch.cuda.synchronize(device)
+        return time.perf_counter() - self._origin
+
+    def record(self, stage : str, start : float, duration : float) -> None:
+        """
+        Record a stage which was timed with ``now()``.
+
+        Args:
+            stage (str): The name of the stage. See ``STAGES``.
+            start (float): When the stage started, from ``now()``.
+            duration (float): How long the stage took in seconds.
+        """
+        batch = self._batch.batch if self._batch is not None else -1
+        self.events.append(StageEvent(stage=stage, batch=batch, start=start, duration=duration))
+
+    @contextmanager
+    def stage(self, stage : str, device = None):
+        """
+        Time the code inside a ``with`` block as a single stage.
+
+        Args:
+            stage (str): The name of the stage. See ``STAGES``.
+            device (optional): The device the stage runs on. Defaults to None.
+        """
+        start = self.now(device)
+        try:
+            yield
+        finally:
+            self.record(stage, start, self.now(device) - start)
+
+    @contextmanager
+    def batch(self, indices : list[int], device = None):
+        """
+        Profile the code inside a ``with`` block as a single batch. Every stage recorded inside the block belongs to the batch.
+
+        Args:
+            indices (list[int]): The row of each sample in the batch.
+            device (optional): The device the batch runs on. Defaults to None.
+
+        Yields:
+            BatchProfile: The profile of the batch.
+        """
+        if _is_cuda(device):
+            torch.cuda.reset_peak_memory_stats(device)
+
+        profile = BatchProfile(batch=len(self.batches), indices=list(indices), start=self.now(device))
+        self._batch = profile
+        try:
+            yield profile
+        finally:
+            profile.duration = self.now(device) - profile.start
+            profile.peak_memory = _get_peak_memory(device)
+            self.batches.append(profile)
+            self._batch = None
+
+    def add_tokens(self, prompt_tokens : int = 0, generated_tokens : int = 0) -> None:
+        """
+        Add to the token counts of the current batch. Does nothing outside of a batch.
+        """
+        if self._batch is None:
+            return
+        self._batch.prompt_tokens += int(prompt_tokens)
+        self._batch.generated_tokens += int(generated_tokens)
+
+    def get_stage_summary(self) -> pd.DataFrame:
+        """
+        Summarise how much time was spent in each stage.
+
+        Returns:
+            pd.DataFrame: The number of calls, total time, mean time and share of the total time of each stage.
+        """
+        events = pd.DataFrame([(event.stage, event.duration) for event in self.events], columns=["Stage", "Time"])
+        summary = events.groupby("Stage")["Time"].agg(["count", "sum", "mean"])
+        summary.columns = ["Calls", "Total Time", "Mean Time"]
+        summary["Share"] = summary["Total Time"] / summary["Total Time"].sum()
+
+        # Order the stages as they happen.
+        order = [stage for stage in STAGES if stage in summary.index] + [stage for stage in summary.index if stage not in STAGES]
+        return summary.loc[order]
+
+    def get_batch_summary(self) -> pd.DataFrame:
+        """
+        Return the token counts, timings and memory usage of every batch.
+
+        Returns:
+            pd.DataFrame: One row per batch.
+        """
+        return pd.DataFrame({
+            "Batch" : [profile.batch for profile in self.batches],
+            "Samples" : [len(profile.indices) for profile in self.batches],
+            "Time" : [profile.duration for profile in self.batches],
+            "Prompt Tokens" : [profile.prompt_tokens for profile in self.batches],
+            "Generated Tokens" : [profile.generated_tokens for profile in self.batches],
+            "Tokens/s" : [profile.tokens_per_second for profile in self.batches],
+            "Peak Memory" : [profile.peak_memory for profile in self.batches]
+        })
+
+    def to_chrome_trace(self, path : str | None = None) -> dict:
+        """
+        Export the profile in the [Chrome trace event format](https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU),
+        which can be opened as a flame chart in ``chrome://tracing`` or [Perfetto](https://ui.perfetto.dev).
+
+        Each batch is a slice containing the slices of its stages, and the peak memory usage is a counter.
+
+        Args:
+            path (str, optional): If given, the trace is also written to this JSON file. Defaults to None.
+
+        Returns:
+            trace (dict): The trace.
+        """
+        pid = os.getpid()
+        trace_events = []
+
+        for profile in self.batches:
+            trace_events.append({
+                "name" : f"batch {profile.batch}", "cat" : "batch", "ph" : "X", "pid" : pid, "tid" : 0,
+                "ts" : profile.start * 1e6, "dur" : profile.duration * 1e6,
+                "args" : {
+                    "samples" : len(profile.indices),
+                    "prompt_tokens" : profile.prompt_tokens,
+                    "generated_tokens" : profile.generated_tokens,
+                    "tokens_per_second" : profile.tokens_per_second
+                }
+            })
+            if profile.peak_memory is not None:
+                trace_events.append({
+                    "name" : "peak_memory", "ph" : "C", "pid" : pid, "tid" : 0,
+                    "ts" : profile.start * 1e6, "args" : {"bytes" : profile.peak_memory}
+                })
+
+        for event in self.events:
+            trace_events.append({
+                "name" : event.stage, "cat" : "stage", "ph" : "X", "pid" : pid, "tid" : 0,
+                "ts" : event.start * 1e6, "dur" : event.duration * 1e6,
+                "args" : {"batch" : event.batch}
+            })
+
+        trace = {"traceEvents" : trace_events, "displayTimeUnit" : "ms"}
+
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(trace, f)
+
+        return trace
+
+def profile_stage(profiler : InferenceProfiler | None, stage : str, device = None):
+    """
+    Time the code inside a ``with`` block as a stage of ``profiler``, or do nothing if ``profiler`` is None.
+    """
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(stage, device)
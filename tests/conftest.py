@@ -0,0 +1,94 @@
+import pytest
+import finetune as ft
+from datasets import Dataset, ClassLabel
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast, LlamaConfig, AutoModelForCausalLM
+from peft import LoraConfig, get_peft_model
+import torch
+import os
+
+# Minimal ChatML template, the same layout Qwen2.5 uses.
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+LABEL_NAMES = ["Company", "Artist", "Athlete", "Building", "Animal", "Album"]
+
+WORDS = "the a of in was is and by an to for from with on as at it band club river town song species built born".split()
+
+def _make_texts(n : int, seed : int = 0) -> list[str]:
+    rng = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(3, 40, (n,), generator=rng).tolist()
+    texts = []
+    for length in lengths:
+        word_ids = torch.randint(0, len(WORDS), (length,), generator=rng).tolist()
+        texts.append(" ".join(WORDS[i] for i in word_ids))
+    return texts
+
+def build_tiny_llm() -> tuple:
+    """Build a tiny random-weight causal LM with a locally trained BPE tokenizer. Needs no network access and always gives the same model."""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=320,
+        special_tokens=["<|endoftext|>", "<|im_start|>", "<|im_end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(_make_texts(200) + LABEL_NAMES, trainer)
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|im_end|>", pad_token="<|endoftext|>")
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=1024,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=None,
+        initializer_range=0.5 # Large weights make the output depend strongly on the input
+    )
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_config(config)
+    model.eval()
+    return (model, tokenizer)
+
+def save_tiny_finetuned_llm(path : str, seed : int = 0) -> str:
+    """Save the tiny LLM and a random LoRA adapter for it into ``path``, like ``finetune.finetune()`` would. Returns the adapter's folder."""
+    model, tokenizer = build_tiny_llm()
+    base_directory = os.path.join(path, "base")
+    model.save_pretrained(base_directory)
+    tokenizer.save_pretrained(base_directory)
+
+    # Random (rather than zero) adapter weights, so that the adapter changes the model's output.
+    torch.manual_seed(seed)
+    lora_config = LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "v_proj"], init_lora_weights=False, task_type="CAUSAL_LM")
+    model = get_peft_model(model, lora_config)
+    model.peft_config["default"].base_model_name_or_path = base_directory
+
+    adapter_directory = os.path.join(path, "adapter")
+    model.save_pretrained(adapter_directory)
+    return adapter_directory
+
+@pytest.fixture(scope="session")
+def tiny_llm():
+    return build_tiny_llm()
+
+@pytest.fixture
+def tiny_dataset():
+    """A small preprocessed classification dataset in conversational format."""
+    n = 24
+    dataset = Dataset.from_dict({
+        "content" : _make_texts(n, seed=1),
+        "label" : [i % len(LABEL_NAMES) for i in range(n)]
+    })
+    dataset = dataset.cast_column("label", ClassLabel(names=LABEL_NAMES))
+    return ft.preprocess_dataset(dataset, text_column="content", labels_column="label")
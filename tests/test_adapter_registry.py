@@ -0,0 +1,94 @@
+import pytest
+import torch
+import finetune as ft
+from adapter_registry import AdapterRegistry
+from inference_cache import fingerprint_model
+from conftest import build_tiny_llm, save_tiny_finetuned_llm
+
+@pytest.fixture
+def adapters(tmp_path):
+    return {name : save_tiny_finetuned_llm(str(tmp_path / name), seed=seed) for seed, name in enumerate(["dbpedia", "osha", "custom"])}
+
+def _get_logits(model, tokenizer) -> torch.Tensor:
+    input_ids = torch.tensor([tokenizer("the band was born in the town", add_special_tokens=False)["input_ids"]])
+    with torch.no_grad():
+        return model(input_ids=input_ids).logits
+
+def test_adapter_registry_matches_load_finetuned_llm(adapters):
+    base_model, tokenizer = build_tiny_llm()
+    base_logits = _get_logits(base_model, tokenizer)
+    registry = AdapterRegistry(base_model, tokenizer)
+    for name, path in adapters.items():
+        registry.register(name, path)
+
+    # Switching back and forth between adapters gives the same output as loading each one on its own.
+    fingerprints = {}
+    for name in ["dbpedia", "osha", "dbpedia", "custom", "osha"]:
+        expected_model, _ = ft.load_finetuned_llm(adapters[name], device_map="cpu", quantized=False)
+        with registry.use(name) as model:
+            assert torch.allclose(_get_logits(model, tokenizer), _get_logits(expected_model, tokenizer), atol=1e-5)
+            fingerprints.setdefault(name, fingerprint_model(model))
+            assert fingerprint_model(model) == fingerprints[name]
+    assert len(set(fingerprints.values())) == 3
+
+    stats = registry.get_stats()
+    assert stats.active_adapter == "osha"
+    assert stats.num_loads == 3 and stats.num_switches == 4 and stats.num_evictions == 0
+    assert stats.loaded_adapters == ["dbpedia", "custom", "osha"]
+
+    prompts = ["the band was born in the town", "a song"]
+    assert registry.generate("custom", prompts, max_new_tokens=3) == \
+           ft.generate_batch(prompts, ft.load_finetuned_llm(adapters["custom"], device_map="cpu", quantized=False)[0], tokenizer, max_new_tokens=3)
+
+    # Evicting every adapter leaves the bare base model.
+    for name in adapters:
+        registry.unregister(name)
+    assert torch.allclose(_get_logits(registry.model, tokenizer), base_logits)
+
+def test_adapter_registry_evicts_least_recently_used(adapters):
+    base_model, tokenizer = build_tiny_llm()
+    registry = AdapterRegistry(base_model, tokenizer, max_adapters=2)
+    for name, path in adapters.items():
+        registry.register(name, path)
+
+    registry.activate("dbpedia")
+    registry.activate("osha")
+    registry.activate("dbpedia")
+    registry.activate("custom") # Evicts "osha", the least recently used adapter
+    stats = registry.get_stats()
+    assert stats.loaded_adapters == ["dbpedia", "custom"]
+    assert stats.num_evictions == 1 and stats.num_loads == 3
+
+    # An adapter which was evicted is loaded again when it is needed.
+    registry.activate("osha")
+    stats = registry.get_stats()
+    assert stats.loaded_adapters == ["custom", "osha"]
+    assert [info.num_loads for info in registry.get_adapters()] == [1, 2, 1]
+
+    # The memory budget is measured from the loaded weights.
+    adapter_memory = registry.get_adapters()[1].memory
+    assert adapter_memory > 0 and stats.memory_used == 2 * adapter_memory
+    registry.max_memory = adapter_memory
+    registry.activate("dbpedia")
+    assert registry.get_stats().loaded_adapters == ["dbpedia"]
+
+    with pytest.raises(ValueError):
+        registry.activate("unknown")
+
+def test_adapter_registry_load_after_evicting_active_adapter(adapters):
+    base_model, tokenizer = build_tiny_llm()
+    registry = AdapterRegistry(base_model, tokenizer)
+    for name, path in adapters.items():
+        registry.register(name, path)
+
+    registry.activate("dbpedia")
+    registry.activate("osha")
+    registry.unregister("osha") # Evicts the active adapter while "dbpedia" stays loaded
+    assert registry.active_adapter is None
+
+    # Loading an adapter while none is active must also switch the model to it.
+    registry.load("custom")
+    assert registry.active_adapter == "custom"
+    expected_model, _ = ft.load_finetuned_llm(adapters["custom"], device_map="cpu", quantized=False)
+    with registry.use("custom") as model:
+        assert torch.allclose(_get_logits(model, tokenizer), _get_logits(expected_model, tokenizer), atol=1e-5)
@@ -0,0 +1,42 @@
+import pytest
+import os, sys, json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import run_benchmarks
+
+def test_synthetic_datasets():
+    dbpedia = run_benchmarks.make_dbpedia_dataset(140)
+    assert dbpedia.column_names == ["label", "title", "content"]
+    assert sorted(set(dbpedia['label'])) == list(range(14))
+
+    osha = run_benchmarks.make_osha_dataframe(1000)
+    assert osha.columns.tolist() == ["Final Narrative", "NatureTitle"]
+    counts = osha["NatureTitle"].value_counts()
+    assert counts.iloc[0] > 5 * counts.iloc[-1], "OSHA classes should be imbalanced"
+
+def test_benchmarks_write_json(tmp_path):
+    output = str(tmp_path / "results.json")
+    assert run_benchmarks.main(["--quick", "--only", "labels", "preprocessing", "--sizes", "500", "--output", output]) == 0
+
+    with open(output, "r", encoding="utf-8") as f:
+        results = json.load(f)
+
+    assert results["metadata"]["versions"]["torch"]
+    names = set(result["name"] for result in results["results"])
+    assert names == {"get_class_id_from_response", "undersample_dataset", "preprocess_dataset", "create_dataset_from_dataframe", "select_top_n_classes"}
+    assert all(result["median"] > 0 and result["rows_per_second"] > 0 for result in results["results"])
+
+    # Comparing a run against itself should never find a regression
+    assert run_benchmarks.main(["--quick", "--only", "labels", "--output", str(tmp_path / "again.json"), "--compare", output, "--tolerance", "100"]) == 0
+
+@pytest.mark.parametrize("module", ["finetune", "evaluate"])
+def test_imports_are_lazy(module):
+    # Plotting, metrics, training libraries and notebook progress bars are only imported when they are first used.
+    _, heavy_modules = run_benchmarks.measure_import(module)
+    assert heavy_modules == []
+
+def test_check_import_targets():
+    result = lambda module, median, heavy_modules : {"name" : "import", "params" : {"module" : module}, "median" : median, "heavy_modules" : heavy_modules}
+    assert run_benchmarks.check_import_targets([result("evaluate", 1.0, []), result("finetune", 5.0, [])], 2.0) == []
+    assert len(run_benchmarks.check_import_targets([result("evaluate", 3.0, [])], 2.0)) == 1
+    assert len(run_benchmarks.check_import_targets([result("finetune", 0.5, ["trl"])], 2.0)) == 1
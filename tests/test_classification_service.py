@@ -0,0 +1,85 @@
+import pytest
+import asyncio
+import evaluate as ev
+import finetune as ft
+import model_prompts
+from classification_service import ClassificationService
+from conftest import LABEL_NAMES
+
+def _get_texts(tiny_dataset) -> list[str]:
+    eval_data, _ = tiny_dataset
+    return [messages[0]["content"] for messages in eval_data["messages"]][0:10]
+
+@pytest.mark.parametrize("method", ["generate", "score"])
+def test_classification_service_matches_evaluate(tiny_llm, tiny_dataset, method):
+    model, tokenizer = tiny_llm
+    texts = _get_texts(tiny_dataset)
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2, method=method)
+
+    async def run():
+        async with ClassificationService(model, tokenizer, LABEL_NAMES, eval_config, max_batch_size=4, max_wait=0.05) as service:
+            results = await service.classify_many(texts)
+            return results, service.get_stats()
+
+    results, stats = asyncio.run(run())
+
+    expected = ev.evaluate(model, tokenizer, list(LABEL_NAMES), texts, eval_config, batch_size=1)
+    assert [result.label_id for result in results] == expected.labels_pred.tolist()
+    assert [result.response for result in results] == expected.llm_responses.tolist()
+    assert all(result.label_name == (LABEL_NAMES + ["Unknown"])[result.label_id] for result in results)
+
+    # Concurrent requests are grouped into micro-batches.
+    assert stats.num_requests == len(texts)
+    assert stats.num_batches < len(texts)
+    assert stats.last_batch_size <= 4 and stats.mean_batch_size > 1
+    assert stats.queue_depth == 0
+    assert 0 < stats.p50_latency <= stats.p99_latency
+
+def test_classification_service_errors(tiny_llm):
+    model, tokenizer = tiny_llm
+    eval_config = ev.EvaluationConfig(name="Zero-shot", max_tokens=2)
+    service = ClassificationService(model, tokenizer, LABEL_NAMES, eval_config)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(service.classify("the band"))
+
+    async def run():
+        async with service:
+            # Every request in a failing batch gets the exception.
+            service._classify_batch = lambda texts : 1 / 0
+            with pytest.raises(ZeroDivisionError):
+                await service.classify("the band")
+            return service.get_stats()
+
+    stats = asyncio.run(run())
+    assert stats.num_errors == 1 and not service.is_running
+
+def test_classification_service_rejects_requests_while_stopping(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    texts = _get_texts(tiny_dataset)
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+    service = ClassificationService(model, tokenizer, LABEL_NAMES, eval_config, max_batch_size=2, max_wait=0.05)
+
+    async def run():
+        await service.start()
+        queued = [asyncio.create_task(service.classify(text)) for text in texts[0:4]]
+        await asyncio.sleep(0) # Let every request reach the queue
+
+        stopping = asyncio.create_task(service.stop())
+        await asyncio.sleep(0) # Let stop() queue its sentinel
+
+        # A request which arrives after stop() would otherwise queue up behind the sentinel and never be answered.
+        with pytest.raises(RuntimeError):
+            await service.classify(texts[4])
+
+        # A request which still got queued behind the sentinel is failed instead of left waiting.
+        late = asyncio.get_running_loop().create_future()
+        service._queue.put_nowait((texts[5], late, 0.0))
+
+        await stopping
+        with pytest.raises(RuntimeError):
+            await late
+        return await asyncio.gather(*queued)
+
+    results = asyncio.run(run())
+    assert len(results) == 4 and not service.is_running
@@ -0,0 +1,69 @@
+import pytest
+import evaluate as ev
+import model_prompts
+import embedding_classifier as ec
+from conftest import LABEL_NAMES
+import numpy as np
+
+def _get_prompts(tiny_dataset) -> list:
+    eval_data, _ = tiny_dataset
+    return [messages[0]["content"] for messages in eval_data["messages"]][0:8]
+
+@pytest.mark.parametrize("pooling", ["last", "mean"])
+def test_embed_prompts_batched(tiny_llm, tiny_dataset, pooling):
+    model, tokenizer = tiny_llm
+    prompts = _get_prompts(tiny_dataset)
+
+    expected = ec.embed_prompts(prompts, model, tokenizer, pooling=pooling, batch_size=1)
+    actual = ec.embed_prompts(prompts, model, tokenizer, pooling=pooling, batch_size=3)
+
+    assert actual.shape == (len(prompts), model.config.hidden_size)
+    assert np.allclose(actual, expected, atol=1e-5), "Padding should not change the embedding of a prompt"
+
+def test_embedding_store(tiny_llm, tiny_dataset, tmp_path, monkeypatch):
+    model, tokenizer = tiny_llm
+    eval_data, _ = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Embedding", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=0, method="embedding")
+
+    expected = ec.embed_dataset(model, tokenizer, eval_data, eval_config)
+    actual = ec.embed_dataset(model, tokenizer, eval_data, eval_config, path=str(tmp_path), chunk_size=5)
+    assert np.allclose(actual, expected, atol=1e-5)
+    assert isinstance(actual, np.memmap)
+
+    # Rows which are already in the store are never embedded again.
+    monkeypatch.setattr(ec, "embed_prompts", lambda *args, **kwargs : pytest.fail("The store should be reused"))
+    assert np.array_equal(ec.embed_dataset(model, tokenizer, eval_data, eval_config, path=str(tmp_path)), actual)
+
+    with pytest.raises(ValueError):
+        ec.embed_dataset(model, tokenizer, eval_data, eval_config, path=str(tmp_path), pooling="mean")
+
+    # A different dataset of the same length cannot reuse the store either.
+    reversed_data = eval_data.select(range(len(eval_data) - 1, -1, -1))
+    with pytest.raises(ValueError):
+        ec.embed_dataset(model, tokenizer, reversed_data, eval_config, path=str(tmp_path))
+
+@pytest.mark.parametrize("method", ["linear", "knn"])
+def test_evaluate_embeddings(tiny_llm, tiny_dataset, tmp_path, method):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Embedding", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=0, method="embedding")
+
+    classifier = ec.train_embedding_classifier(model, tokenizer, label_names, eval_data, eval_config, method=method, k=1)
+    classifier.save(str(tmp_path / "classifier.pkl"))
+    classifier = ec.EmbeddingClassifier.load(str(tmp_path / "classifier.pkl"))
+
+    result = ec.evaluate_embeddings(model, tokenizer, classifier, eval_data, eval_config, batch_size=5, store_path=str(tmp_path / "store"))
+
+    assert len(result) == len(eval_data)
+    assert result.label_names == list(LABEL_NAMES) + ["Unknown"]
+    assert result.label_probabilities.shape == (len(eval_data), len(LABEL_NAMES) + 1)
+    assert np.allclose(result.label_probabilities.sum(axis=1), 1)
+    assert np.array_equal(result.labels_pred, np.argmax(result.label_probabilities, axis=1))
+    assert result.llm_responses.tolist() == [result.label_names[i] for i in result.labels_pred]
+
+    # The nearest neighbour of each training sample is itself.
+    if method == "knn":
+        assert np.array_equal(result.labels_pred, result.labels_true)
+
+    with pytest.raises(ValueError):
+        ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config)
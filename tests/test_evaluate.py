@@ -5,6 +5,10 @@ import model_prompts
 from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 from datasets import load_dataset
 import torch
+import numpy as np
+import re
+import json
+from copy import deepcopy
 
 @pytest.fixture
 def llm():
@@ -46,3 +50,483 @@ def test_evaluate_llm(llm, eval_dataset):
 
 
 
+
+def test_generate_batch_matches_generate(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, _ = tiny_dataset
+    prompts = [messages[0]['content'] for messages in eval_data['messages']][0:8]
+
+    expected = [ft.generate(prompt, model, tokenizer, max_new_tokens=3) for prompt in prompts]
+    actual = ft.generate_batch(prompts, model, tokenizer, max_new_tokens=3, batch_size=3)
+
+    assert expected == actual, "Batched generation should return the same responses in the original order"
+
+def test_evaluate_batched(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config)
+    actual = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=5)
+
+    assert np.array_equal(actual.texts, expected.texts)
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
+    assert np.array_equal(actual.labels_true, expected.labels_true)
+    assert len(actual.prediction_times) == len(eval_data)
+
+def test_score_labels_matches_full_forward_pass(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    prompts = [messages[0]['content'] for messages in eval_data['messages']][0:4]
+
+    scores = ft.score_labels(prompts, label_names, model, tokenizer, batch_size=3)
+
+    for i, prompt in enumerate(prompts):
+        prompt_ids = tokenizer(ft._format_prompt(prompt, tokenizer), add_special_tokens=False)['input_ids']
+        for j, label in enumerate(label_names):
+            label_ids = tokenizer(label, add_special_tokens=False)['input_ids']
+            with torch.no_grad():
+                logits = model(torch.tensor([prompt_ids + label_ids])).logits[0]
+            log_probs = torch.log_softmax(logits.float(), dim=-1)
+            expected = sum(log_probs[len(prompt_ids) - 1 + k, token].item() for k, token in enumerate(label_ids))
+            assert scores[i, j] == pytest.approx(expected, rel=1e-4)
+
+def test_evaluate_score_method(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Scored", prompt=None, max_tokens=1, method="score")
+
+    result = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+
+    probabilities = np.array(result.label_probabilities)
+    assert probabilities.shape == (len(eval_data), len(label_names) + 1)
+    assert np.allclose(probabilities.sum(axis=1), 1)
+    assert np.array_equal(result.labels_pred, np.argmax(probabilities, axis=1).tolist())
+    assert all(result.label_names[pred] == response for pred, response in zip(result.labels_pred, result.llm_responses))
+
+def test_prefix_cache(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=3)
+    prefix_cache = ft.PrefixCache()
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+    actual = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, prefix_cache=prefix_cache)
+
+    assert np.array_equal(actual.llm_responses, expected.llm_responses), "Reusing the system prompt's KV cache should not change the output"
+    assert prefix_cache.misses == 1
+    assert prefix_cache.hits == len(eval_data) // 4 - 1
+
+    prompt = [{"role":"system", "content":eval_config.prompt}, {"role":"user", "content":"the band was born in a town"}]
+    assert ft.generate(prompt, model, tokenizer, max_new_tokens=3, prefix_cache=prefix_cache) == ft.generate(prompt, model, tokenizer, max_new_tokens=3)
+
+
+def _reference_get_class_id(model_response : str, label_names : list) -> int:
+    # Frozen copy of the original implementation, used to check LabelMatcher gives identical results.
+
+    # Return a direct match if possible
+    try:
+        class_id = label_names.index(model_response)
+        return class_id
+    except Exception as e:
+        pass
+    
+    model_response = model_response.lower().strip()
+    
+    # If the response is an integer, return it if it's a valid class ID
+    if model_response.isdigit():
+        try:
+            class_id = int(model_response)
+            # The integer must be within the range of class IDs
+            if class_id >= 0 and class_id < len(label_names) - 2:
+                return class_id
+            else:
+                # If it isn't, just return the last label ("I don't know").
+                return len(label_names) - 1
+        except Exception:
+            pass
+
+    # Match class labels if model_response is truncated.
+    # E.g., "mean" -> "meanoftransportation" -> 5
+    # This allows us to match labels even we don't
+    # have enough tokens to write the entire name.
+    # This allows us to optimise the evaluation
+    # procedure by using lower max tokens.
+    for i, label in enumerate(label_names):
+        
+        label = label.lower().strip()
+        response_trimmed = model_response.replace(" ", "")
+        label = label.replace(" ", "")
+        label_truncated = label[0:len(response_trimmed)]
+
+        if response_trimmed == label_truncated:
+            return i
+    
+    try:
+        # Concatenate all label names using boolean OR.
+        match = "|".join(label_names).lower().replace(" ", r"\s*")
+
+        # Find all instances of label name strings within the base string.
+        matches = re.findall(match, model_response)
+
+        # If the string contains at least one instance of a class label:
+        if len(matches) > 0:
+            # Get the last matching label from the string.
+            final_match = matches[-1]
+
+            # Remove all capitalisation, non-alphabetic characters, and whitespace
+            labels_sanitised = [re.sub("[^a-z]", "", label.lower()) for label in label_names]
+            match_sanitised = re.sub("[^a-z]", "", final_match.lower())
+            
+            # Return the matching class ID for the label.
+            class_id = labels_sanitised.index(match_sanitised)
+            return class_id
+            
+    except Exception:
+        pass
+    
+    # If no class label is found in the LLM text, return the last label ("I don't know").
+    return len(label_names) - 1
+
+OSHA_LABEL_NAMES = [
+    "Amputations", "Crushing injuries", "Cuts, lacerations", "Fractures", "Heat (thermal) burns, unspecified",
+    "Internal injuries to organs and blood vessels of the trunk", "Intracranial injuries, unspecified",
+    "Puncture wounds, except gunshot wounds", "Soreness, pain, hurt-nonspecified injury",
+    "Traumatic injuries and disorders, unspecified", "Unknown"
+]
+
+DBPEDIA_LABEL_NAMES = [
+    "Company", "EducationalInstitution", "Artist", "Athlete", "OfficeHolder", "MeanOfTransportation", "Building",
+    "NaturalPlace", "Village", "Animal", "Plant", "Album", "Film", "WrittenWork", "Unknown"
+]
+
+@pytest.mark.parametrize("label_names", [DBPEDIA_LABEL_NAMES, OSHA_LABEL_NAMES])
+def test_label_matcher_matches_reference(label_names):
+    responses = ["", " ", "0", "3", "12", "13", "99", "-1", "\u00b2", "Unknown", "unknown", "I don't know"]
+    for label in label_names:
+        responses += [label, label.upper(), " " + label.lower() + " ", label[0:3], label[0:5].lower(), label.replace(" ", "")]
+        responses += [f"Let's think step by step. This is about {label.lower()}. The answer is {label}.", f"{label} or {label_names[0]}"]
+    responses += ["The answer is heat thermal burns, unspecified", "Mean of transportation", "writtenwork?", "abc"]
+
+    matcher = ev.LabelMatcher(label_names)
+    expected = [_reference_get_class_id(response, label_names) for response in responses]
+
+    assert matcher.match_many(responses) == expected
+    assert [ev._get_class_id_from_model_response(response, label_names) for response in responses] == expected
+
+def test_label_trie(tiny_llm):
+    _, tokenizer = tiny_llm
+    label_names = ["Art", "Artist", "Athlete", "Animal"]
+    label_trie = ft.LabelTrie(label_names, tokenizer)
+    label_ids = tokenizer(label_names, add_special_tokens=False)['input_ids']
+
+    assert set(label_trie.allowed_tokens([])) == set(ids[0] for ids in label_ids)
+    assert label_trie.allowed_tokens([tokenizer.pad_token_id]) == []
+    assert label_trie.resolve([]) is None
+
+    for label_id, ids in enumerate(label_ids):
+        assert label_trie.resolve(ids + [tokenizer.eos_token_id]) == label_id
+        assert label_trie.resolve(ids, strict=False) == label_id
+
+def test_evaluate_constrained_method(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Constrained", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=1, method="constrained")
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config)
+    actual = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=5, prefix_cache=ft.PrefixCache())
+
+    assert all(response in label_names for response in actual.llm_responses), "Constrained responses must always be a class label"
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+    assert np.array_equal(actual.labels_pred, [label_names.index(response) for response in actual.llm_responses])
+
+@pytest.mark.parametrize("method", ["generate", "score"])
+def test_evaluate_templates_each_prompt_once(tiny_llm, tiny_dataset, monkeypatch, method):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2, method=method)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=1)
+
+    formatted = []
+    format_prompt = ft._format_prompt
+    def count_formatted(prompt, tokenizer):
+        if not isinstance(prompt, ft.TokenizedPrompt): formatted.append(prompt)
+        return format_prompt(prompt, tokenizer)
+    monkeypatch.setattr(ft, "_format_prompt", count_formatted)
+
+    actual = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, prefix_cache=ft.PrefixCache())
+
+    # Once per sample, plus once to find the prefix shared by every prompt.
+    assert len(formatted) == len(eval_data) + 1
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
+
+def test_evaluate_resumes_from_checkpoint(tiny_llm, tiny_dataset, tmp_path, monkeypatch):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, checkpoint_dir=tmp_path)
+
+    # Simulate a crash: keep the first 10 logged samples, then a partially written line.
+    log_files = list(tmp_path.iterdir())
+    assert len(log_files) == 1
+    lines = log_files[0].read_text(encoding="utf-8").splitlines(keepends=True)
+    assert len(lines) == len(eval_data)
+    log_files[0].write_text("".join(lines[0:10]) + lines[10][0:15], encoding="utf-8")
+
+    generated = []
+    generate_batch = ft.generate_batch
+    def count_generated(prompts, **kwargs):
+        generated.extend(prompts)
+        return generate_batch(prompts, **kwargs)
+    monkeypatch.setattr(ft, "generate_batch", count_generated)
+
+    actual = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, checkpoint_dir=tmp_path)
+
+    assert len(generated) == len(eval_data) - 10, "Samples which were already logged should be skipped"
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
+    assert np.array_equal(actual.labels_true, expected.labels_true)
+
+    # A finished evaluation should not need to generate anything
+    generated.clear()
+    ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, checkpoint_dir=tmp_path)
+    assert len(generated) == 0
+
+def test_evaluate_does_not_resume_from_another_model(tiny_llm, tiny_dataset, tmp_path, monkeypatch):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Fine-tuned", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, checkpoint_dir=tmp_path)
+
+    # E.g. a retrained adapter evaluated with the same configuration.
+    other_model = deepcopy(model)
+    with torch.no_grad():
+        other_model.lm_head.weight[0, 0] += 1.0
+
+    generated = []
+    generate_batch = ft.generate_batch
+    def count_generated(prompts, **kwargs):
+        generated.extend(prompts)
+        return generate_batch(prompts, **kwargs)
+    monkeypatch.setattr(ft, "generate_batch", count_generated)
+
+    ev.evaluate(other_model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, checkpoint_dir=tmp_path)
+    assert len(generated) == len(eval_data), "A different model should not resume from the log of another model"
+    assert len(list(tmp_path.iterdir())) == 2
+
+def test_evaluate_iter_streams_results(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+
+    # Streaming datasets have no length and can only be read in order
+    num_labels = len(label_names)
+    results = list(ev.evaluate_iter(model, tokenizer, label_names, eval_data.to_iterable_dataset(), eval_config, batch_size=4, chunk_size=7))
+    results.sort(key=lambda result : result.index)
+
+    assert len(label_names) == num_labels, "evaluate_iter() should not modify label_names"
+    assert [result.index for result in results] == list(range(len(eval_data)))
+    assert np.array_equal([result.llm_response for result in results], expected.llm_responses)
+    assert np.array_equal([result.label_pred for result in results], expected.labels_pred)
+    assert np.array_equal([result.label_true for result in results], expected.labels_true)
+
+    # Plain texts have no true label
+    texts = (text for text in expected.texts)
+    results = sorted(ev.evaluate_iter(model, tokenizer, label_names, texts, eval_config, batch_size=4), key=lambda result : result.index)
+
+    assert np.array_equal([result.llm_response for result in results], expected.llm_responses)
+    assert all(result.label_true is None for result in results)
+
+def test_evaluate_unlabelled_texts(tiny_llm, tiny_dataset, tmp_path):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    labelled = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+    unlabelled = ev.evaluate(model, tokenizer, list(label_names), list(labelled.texts), eval_config, batch_size=4)
+
+    # Samples without a true label get -1, and can never be incorrect.
+    assert np.array_equal(unlabelled.llm_responses, labelled.llm_responses)
+    assert np.all(unlabelled.labels_true == -1) and not unlabelled.has_labels.any()
+    assert unlabelled.get_answers()["True Label"].isna().all()
+    assert len(unlabelled.get_answers(incorrect_only=True)) == 0
+
+    # Missing labels survive saving, loading and merging.
+    unlabelled.to_parquet(tmp_path / "result.parquet")
+    loaded = ev.EvaluationResult.load(tmp_path / "result.parquet")
+    assert np.array_equal(loaded.labels_true, unlabelled.labels_true)
+
+    merged = ev.EvaluationResult.merge([labelled, loaded])
+    assert np.array_equal(merged.has_labels, [True] * len(labelled) + [False] * len(loaded))
+    assert np.array_equal(merged.get_answers(incorrect_only=True).index, labelled.get_answers(incorrect_only=True).index)
+
+def test_prepared_dataset(tiny_llm, tiny_dataset, tmp_path, monkeypatch):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, prefix_cache=ft.PrefixCache())
+
+    prepared = ev.prepare_eval_dataset(tokenizer, eval_data, eval_config, cache_dir=tmp_path, batch_size=5)
+    assert list(prepared['length']) == [len(ids) for ids in prepared['input_ids']]
+    assert list(prepared['input_ids']) == tokenizer(list(prepared['prompt']), add_special_tokens=False)['input_ids']
+
+    # Preparing the same dataset again should load it from disk
+    def fail(prompts, tokenizer):
+        raise AssertionError("Prepared datasets should not be tokenized again")
+    with monkeypatch.context() as m:
+        m.setattr(ft, "tokenize_prompts", fail)
+        prepared = ev.prepare_eval_dataset(tokenizer, eval_data, eval_config, cache_dir=tmp_path)
+
+    # Apart from checking the first prompt, evaluating a prepared dataset should not format any prompts
+    formatted = []
+    format_prompt = ft._format_prompt
+    def count_formatted(prompt, tokenizer):
+        if not isinstance(prompt, ft.TokenizedPrompt): formatted.append(prompt)
+        return format_prompt(prompt, tokenizer)
+    monkeypatch.setattr(ft, "_format_prompt", count_formatted)
+
+    actual = ev.evaluate(model, tokenizer, list(label_names), prepared, eval_config, batch_size=4, prefix_cache=ft.PrefixCache())
+
+    assert len(formatted) == 1
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
+
+    with pytest.raises(ValueError):
+        ev.evaluate(model, tokenizer, list(label_names), prepared, ev.EvaluationConfig(name="Fine-tuned", max_tokens=2))
+
+def test_merge_results(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Scored", max_tokens=1, method="score")
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config)
+    shards = [ev.evaluate(model, tokenizer, list(label_names), eval_data.shard(3, i, contiguous=True), eval_config) for i in range(3)]
+    actual = ev.EvaluationResult.merge(shards)
+
+    assert np.array_equal(actual.texts, expected.texts)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
+    assert np.array_equal(actual.labels_true, expected.labels_true)
+    assert np.allclose(actual.label_probabilities, expected.label_probabilities)
+    assert actual.total_time_elapsed == max(shard.total_time_elapsed for shard in shards)
+
+def test_result_parquet_round_trip(tiny_llm, tiny_dataset, tmp_path):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Scored", max_tokens=1, method="score")
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+    expected.to_parquet(tmp_path / "result.parquet")
+    actual = ev.EvaluationResult.load(tmp_path / "result.parquet")
+
+    assert actual.config == expected.config
+    assert actual.label_names == expected.label_names
+    assert actual.total_time_elapsed == expected.total_time_elapsed
+    assert np.array_equal(actual.texts, expected.texts)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+    assert np.allclose(actual.label_probabilities, expected.label_probabilities)
+    assert actual.get_answers(incorrect_only=True).equals(expected.get_answers(incorrect_only=True))
+
+def test_evaluate_truncation(tiny_llm, tiny_dataset, tmp_path):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    truncation = ft.TruncationConfig(max_tokens=10, strategy="head_tail")
+    eval_config = ev.EvaluationConfig(name="Truncated", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2, truncation=truncation)
+
+    texts = [messages[0]["content"] for messages in eval_data["messages"]]
+    truncated_texts, truncated = ft.truncate_texts(texts, tokenizer, truncation)
+    assert any(truncated) and not all(truncated)
+
+    # Only the text sample is truncated; the system prompt is kept intact.
+    prompts = ev._build_prompts(texts, eval_config, tokenizer)
+    assert all(prompt[0]["content"] == eval_config.prompt for prompt in prompts)
+    assert [prompt[-1]["content"] for prompt in prompts] == truncated_texts
+    with pytest.raises(ValueError):
+        ev._build_prompts(texts, eval_config)
+
+    result = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+    assert result.truncated.tolist() == truncated
+    assert result.num_truncated == sum(truncated)
+
+    # Truncating the texts ahead of time gives the same answers.
+    untruncated_config = ev.EvaluationConfig(name="Pre-truncated", prompt=eval_config.prompt, max_tokens=2)
+    expected = ev.evaluate(model, tokenizer, list(label_names), truncated_texts, untruncated_config, batch_size=4)
+    assert np.array_equal(result.llm_responses, expected.llm_responses)
+    assert expected.truncated is None and expected.num_truncated == 0
+
+    prepared = ev.prepare_eval_dataset(tokenizer, eval_data, eval_config)
+    prepared_result = ev.evaluate(model, tokenizer, list(label_names), prepared, eval_config, batch_size=4)
+    assert np.array_equal(prepared_result.truncated, result.truncated)
+    assert np.array_equal(prepared_result.llm_responses, result.llm_responses)
+
+    result.to_parquet(tmp_path / "result.parquet")
+    loaded = ev.EvaluationResult.load(tmp_path / "result.parquet")
+    assert loaded.config == eval_config
+    assert np.array_equal(loaded.truncated, result.truncated)
+
+def test_result_stores_text_indices(tiny_llm, tiny_dataset, tmp_path):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+    actual = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, store_texts=False)
+
+    assert actual.texts is None
+    assert np.array_equal(actual.get_texts(), expected.texts)
+    # Prediction times differ between runs
+    columns = ["Text", "Predicted Label", "LLM Response", "True Label"]
+    assert actual.get_answers(incorrect_only=True)[columns].equals(expected.get_answers(incorrect_only=True)[columns])
+
+    actual.to_parquet(tmp_path / "result.parquet")
+    loaded = ev.EvaluationResult.load(tmp_path / "result.parquet", source_dataset=eval_data)
+    assert np.array_equal(loaded.get_texts(), expected.texts)
+
+    incorrect = ev.EvaluationResult.load(tmp_path / "result.parquet").get_answers(incorrect_only=True)
+    assert np.array_equal(incorrect["Text Index"], incorrect.index)
+
+def test_evaluate_sharded(tiny_llm, tiny_dataset):
+    from conftest import build_tiny_llm
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config)
+    actual, worker_stats = ev.evaluate_sharded(build_tiny_llm, list(label_names), eval_data, eval_config, num_workers=2, threads_per_worker=1)
+
+    assert np.array_equal(actual.texts, expected.texts), "Sharded results should be merged in the original order"
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
+    assert [stats.num_samples for stats in worker_stats] == [12, 12]
+    assert all(stats.num_threads == 1 and stats.samples_per_second > 0 for stats in worker_stats)
+
+def test_evaluate_sharded_resumes_from_checkpoint(tiny_llm, tiny_dataset, tmp_path):
+    from conftest import build_tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+
+    expected, _ = ev.evaluate_sharded(build_tiny_llm, list(label_names), eval_data, eval_config, num_workers=2, threads_per_worker=1, checkpoint_dir=tmp_path)
+
+    # Each shard has its own log, holding a record for every sample in the shard.
+    log_files = sorted(tmp_path.glob("*/*.jsonl"))
+    assert len(log_files) == 2
+    for log_file in log_files:
+        records = [json.loads(line) for line in log_file.read_text(encoding="utf-8").splitlines()]
+        assert sorted(record["index"] for record in records) == list(range(12))
+        # Mark every logged response, so that results restored from the logs can be told apart from evaluated ones.
+        for record in records: record["llm_response"] = "resumed"
+        log_file.write_text("".join(json.dumps(record) + "\n" for record in records), encoding="utf-8")
+
+    actual, _ = ev.evaluate_sharded(build_tiny_llm, list(label_names), eval_data, eval_config, num_workers=2, threads_per_worker=1, checkpoint_dir=tmp_path)
+
+    assert all(response == "resumed" for response in actual.llm_responses), "Every sample should be restored from its shard's log"
+    assert np.array_equal(actual.texts, expected.texts)
+    assert np.array_equal(actual.labels_pred, expected.labels_pred)
@@ -0,0 +1,70 @@
+import pytest
+import evaluate as ev
+import model_prompts
+from few_shot import FewShotIndex
+from conftest import LABEL_NAMES
+import numpy as np
+import math, re
+
+TEXTS = [
+    "the band released a new album", "a river flows by the town", "the club was founded in the town",
+    "the species is a small bird", "a song by the band", "the town was built on the river",
+    "the company makes cars", "born in the town, the athlete played for the club"
+]
+LABELS = [1, 3, 2, 4, 5, 3, 0, 2]
+
+def _reference_bm25(query : str, texts : list[str], k1 : float = 1.5, b : float = 0.75) -> np.ndarray:
+    # Straightforward BM25, used to check the sparse matrix implementation.
+    tokenize = lambda text : re.findall(r"\b\w+\b", text.lower())
+    documents = [tokenize(text) for text in texts]
+    average_length = np.mean([len(document) for document in documents])
+    scores = np.zeros(len(documents))
+    for term in tokenize(query):
+        df = sum(term in document for document in documents)
+        idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        for i, document in enumerate(documents):
+            tf = document.count(term)
+            scores[i] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(document) / average_length))
+    return scores
+
+def test_bm25_scores():
+    index = FewShotIndex(TEXTS, LABELS, LABEL_NAMES)
+    queries = ["the band", "a town on a river", "nothing matches"]
+
+    assert np.allclose(index.score(queries), [_reference_bm25(query, TEXTS) for query in queries], atol=1e-5)
+
+def test_query_per_class(tmp_path):
+    index = FewShotIndex(TEXTS, LABELS, LABEL_NAMES)
+    rows = index.query(["a town on a river", "the band"], k=2)
+
+    assert rows.shape == (2, len(LABEL_NAMES) * 2)
+    # The 2 examples of class 3 are ranked by similarity, and classes with fewer examples are padded.
+    assert rows[0, 6:8].tolist() == [1, 5] or rows[0, 6:8].tolist() == [5, 1]
+    assert rows[0, 0:2].tolist() == [6, -1]
+    for sample_rows in rows:
+        for class_id in range(len(LABEL_NAMES)):
+            class_rows = sample_rows[class_id * 2:class_id * 2 + 2]
+            assert all(LABELS[row] == class_id for row in class_rows if row >= 0)
+
+    assert index.get_stats()["queries"] == 2
+
+    index.save(str(tmp_path))
+    loaded = FewShotIndex.load(str(tmp_path))
+    assert loaded.fingerprint == index.fingerprint
+    assert np.array_equal(loaded.query(["a town on a river", "the band"], k=2), rows)
+
+def test_evaluate_few_shot(tiny_llm, tiny_dataset, tmp_path):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    index = FewShotIndex.from_dataset(eval_data, label_names)
+    eval_config = ev.EvaluationConfig(name="1-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2, few_shot_index=index, shots=1)
+
+    text = eval_data[0]["messages"][0]["content"]
+    prompt = ev._build_prompts([text], eval_config)[0]
+    assert [turn["role"] for turn in prompt] == ["system"] + ["user", "assistant"] * len(label_names) + ["user"]
+    assert [turn["content"] for turn in prompt[2:-1:2]] == list(label_names)
+    assert prompt[-1]["content"] == text
+
+    result = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4)
+    result.to_parquet(str(tmp_path / "result.parquet"))
+    assert ev.EvaluationResult.load(str(tmp_path / "result.parquet")).config.few_shot_index is None
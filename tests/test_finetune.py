@@ -1,3 +1,9 @@
+import pytest
+import torch
+import os
+import finetune as ft
+from conftest import save_tiny_finetuned_llm
+
 # import pytest
 # import finetune as ft
 # from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
@@ -16,4 +22,116 @@
 #     model_id = "Qwen/Qwen2.5-7B-Instruct"
 #     model = AutoModelForCausalLM.from_pretrained(model_id, device_map="auto", quantization_config=bnb_config)
 #     tokenizer = AutoTokenizer.from_pretrained(model_id)
-#     return (model, tokenizer)
\ No newline at end of file
+#     return (model, tokenizer)
+
+def test_tokenize_training_dataset(tiny_llm, tiny_dataset):
+    _, tokenizer = tiny_llm
+    dataset, label_names = tiny_dataset
+    tokenized = ft.tokenize_training_dataset(dataset, tokenizer)
+
+    assert tokenized.column_names == ["input_ids", "labels", "length"]
+    for messages, sample in zip(dataset["messages"], tokenized):
+        assert tokenizer.decode(sample["input_ids"]) == tokenizer.apply_chat_template(messages, tokenize=False)
+        assert sample["length"] == len(sample["input_ids"]) == len(sample["labels"])
+
+        # Only the completion (the class label and the end of the assistant turn) is trained on.
+        completion = [label for label in sample["labels"] if label != -100]
+        assert tokenizer.decode(completion).startswith(messages[-1]["content"])
+        assert sample["labels"][-len(completion):] == sample["input_ids"][-len(completion):]
+
+    truncated = ft.tokenize_training_dataset(dataset, tokenizer, max_length=8, completion_only_loss=False)
+    assert max(truncated["length"]) == 8
+    assert truncated[0]["labels"] == truncated[0]["input_ids"]
+
+def test_pack_dataset_isolates_samples(tiny_llm, tiny_dataset):
+    model, tokenizer = tiny_llm
+    dataset, _ = tiny_dataset
+    tokenized = ft.tokenize_training_dataset(dataset, tokenizer)
+    max_length = 3 * max(tokenized["length"])
+    packed = ft.pack_dataset(tokenized, max_length)
+
+    assert len(packed) < len(tokenized)
+    assert max(packed["length"]) <= max_length
+    assert sum(packed["length"]) == sum(tokenized["length"])
+
+    collator = ft.TrainingDataCollator(tokenizer.pad_token_id, dtype=model.dtype)
+    batch = collator([packed[i] for i in range(len(packed))])
+    assert batch["attention_mask"].shape == (len(packed), 1, batch["input_ids"].shape[1], batch["input_ids"].shape[1])
+
+    # Each packed sample gives the same logits as when it is run on its own.
+    with torch.no_grad():
+        packed_logits = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"], position_ids=batch["position_ids"]).logits
+        sample = 0
+        for row in range(len(packed)):
+            start = 0
+            while start < packed[row]["length"]:
+                ids = tokenized[sample]["input_ids"]
+                logits = model(input_ids=torch.tensor([ids])).logits[0]
+                assert torch.allclose(packed_logits[row, start:start + len(ids)], logits, atol=1e-4)
+                start += len(ids)
+                sample += 1
+    assert sample == len(tokenized)
+
+def test_training_data_collator_counts_padding(tiny_llm, tiny_dataset):
+    _, tokenizer = tiny_llm
+    dataset, _ = tiny_dataset
+    tokenized = ft.tokenize_training_dataset(dataset, tokenizer)
+
+    collator = ft.TrainingDataCollator(tokenizer.pad_token_id)
+    samples = [tokenized[i] for i in range(4)]
+    batch = collator(samples)
+
+    lengths = [len(sample["input_ids"]) for sample in samples]
+    assert batch["input_ids"].shape == (4, max(lengths))
+    assert batch["attention_mask"].sum(dim=1).tolist() == lengths
+    assert (batch["labels"][batch["attention_mask"] == 0] == -100).all()
+    assert collator.num_sequences == 4
+    assert collator.num_tokens == sum(lengths)
+    assert collator.num_padded_tokens == 4 * max(lengths)
+
+def test_token_budget_batches():
+    lengths = [5, 50, 7, 48, 6, 51, 30, 8]
+    batches = ft._token_budget_batches(lengths, token_budget=100, seed=0)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 100
+    # Short samples are batched together instead of being padded to the length of long ones.
+    assert any(sorted(batch) == [0, 2, 4, 7] for batch in batches)
+
+def test_tokenize_training_dataset_truncation(tiny_llm, tiny_dataset):
+    _, tokenizer = tiny_llm
+    dataset, _ = tiny_dataset
+    truncation = ft.TruncationConfig(max_tokens=5, strategy="tail")
+    tokenized = ft.tokenize_training_dataset(dataset, tokenizer, truncation=truncation)
+
+    texts, truncated = ft.truncate_texts([messages[0]["content"] for messages in dataset["messages"]], tokenizer, truncation)
+    assert tokenized["truncated"] == truncated
+    for messages, text, sample in zip(dataset["messages"], texts, tokenized):
+        # The class label is never cut off by truncation.
+        expected = [{"role" : "user", "content" : text}, messages[-1]]
+        assert tokenizer.decode(sample["input_ids"]) == tokenizer.apply_chat_template(expected, tokenize=False)
+
+def test_export_merged_llm(tmp_path):
+    adapter_directory = save_tiny_finetuned_llm(str(tmp_path))
+
+    peft_model, tokenizer = ft.load_finetuned_llm(adapter_directory, device_map="cpu", quantized=False)
+    merged_model, merged_tokenizer = ft.load_finetuned_llm(adapter_directory, device_map="cpu", quantized=False, merged=True)
+    assert type(merged_model) is not type(peft_model)
+    assert merged_tokenizer.get_vocab() == tokenizer.get_vocab()
+
+    # The merged model gives the same output as running the adapter on top of the base model.
+    input_ids = torch.tensor([tokenizer("the band was born in the town", add_special_tokens=False)["input_ids"]])
+    with torch.no_grad():
+        assert torch.allclose(merged_model(input_ids=input_ids).logits, peft_model(input_ids=input_ids).logits, atol=1e-4)
+
+    # The merged checkpoint is cached under a fingerprint of the adapter, and reused.
+    path = ft.export_merged_llm(adapter_directory)
+    assert os.path.dirname(path) == os.path.join(adapter_directory, "merged")
+    modified_time = os.path.getmtime(os.path.join(path, "merge_info.json"))
+    assert ft.export_merged_llm(adapter_directory) == path
+    assert os.path.getmtime(os.path.join(path, "merge_info.json")) == modified_time
+
+    # A different adapter gets a different checkpoint.
+    other_directory = save_tiny_finetuned_llm(str(tmp_path / "other"), seed=1)
+    assert os.path.basename(ft.export_merged_llm(other_directory)) != os.path.basename(path)
@@ -0,0 +1,114 @@
+import pytest
+import evaluate as ev
+import finetune as ft
+import model_prompts
+from inference_cache import InferenceCache, fingerprint_model, fingerprint_tokenizer
+from copy import deepcopy
+from transformers import StoppingCriteria, StoppingCriteriaList
+import torch
+import numpy as np
+
+def test_cache_persists_to_disk(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+
+    cache = InferenceCache(path)
+    cache.put("a", "Company")
+    cache.put_many({"b" : [0.1, 0.9], "c" : "Artist"})
+    cache.close()
+
+    cache = InferenceCache(path)
+    assert cache.get("a") == "Company"
+    assert cache.get_many(["b", "c", "d"]) == {"b" : [0.1, 0.9], "c" : "Artist"}
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert len(cache) == 3
+
+def test_cache_memory_layer_is_bounded():
+    cache = InferenceCache(path=None, max_memory_items=2)
+    cache.put_many({"a" : "1", "b" : "2"})
+    cache.get("a")
+    cache.put("c", "3")
+
+    assert cache.get("b") is None, "The least recently used result should be dropped"
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+def test_cache_evicts_least_recently_used_results(tmp_path):
+    cache = InferenceCache(str(tmp_path / "cache.sqlite"), max_memory_items=0, max_disk_size=30)
+
+    cache.put("a", "x" * 10)
+    cache.put("b", "y" * 10)
+    cache.get("a")
+    cache.put("c", "z" * 10)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "x" * 10
+    assert cache.get("c") == "z" * 10
+
+def test_fingerprints_change_with_weights(tiny_llm):
+    model, tokenizer = tiny_llm
+    modified = deepcopy(model)
+    with torch.no_grad():
+        modified.lm_head.weight[0, 0] += 1
+
+    assert fingerprint_model(model) == fingerprint_model(model)
+    assert fingerprint_model(model) != fingerprint_model(modified)
+    assert fingerprint_tokenizer(tokenizer) == fingerprint_tokenizer(tokenizer)
+
+def test_evaluate_uses_cache(tiny_llm, tiny_dataset, monkeypatch):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+    cache = InferenceCache(path=None)
+
+    expected = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, cache=cache)
+    assert cache.misses == len(eval_data)
+
+    generated = []
+    generate = model.generate
+    def count_generated(*args, **kwargs):
+        output = generate(*args, **kwargs)
+        generated.append(output.shape[0])
+        return output
+    monkeypatch.setattr(model, "generate", count_generated)
+
+    actual = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, cache=cache)
+
+    assert sum(generated) == 0, "Every response should have been cached"
+    assert cache.hits == len(eval_data)
+    assert np.array_equal(actual.llm_responses, expected.llm_responses)
+
+def test_duplicate_prompts_are_generated_once(tiny_llm, monkeypatch):
+    model, tokenizer = tiny_llm
+    prompts = ["the band", "a river", "the band", "the band", "a river"]
+
+    generated = []
+    generate = model.generate
+    def count_generated(*args, **kwargs):
+        output = generate(*args, **kwargs)
+        generated.append(output.shape[0])
+        return output
+    monkeypatch.setattr(model, "generate", count_generated)
+
+    responses = ft.generate_batch(prompts, model, tokenizer, max_new_tokens=3, batch_size=8)
+
+    assert sum(generated) == 2
+    assert responses[0] == responses[2] == responses[3]
+    assert responses[1] == responses[4]
+
+class _NeverStop(StoppingCriteria):
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+def test_unserialisable_parameters_are_not_cached(tiny_llm):
+    model, tokenizer = tiny_llm
+    prompts = ["the band", "a river", "the band"]
+    cache = InferenceCache(path=None)
+
+    # Objects like stopping criteria have no stable description, so they would never hit the cache again.
+    kwargs = {"stopping_criteria" : StoppingCriteriaList([_NeverStop()])}
+    responses = ft.generate_batch(prompts, model, tokenizer, max_new_tokens=3, kwargs=kwargs, cache=cache)
+
+    assert responses == ft.generate_batch(prompts, model, tokenizer, max_new_tokens=3)
+    assert cache.hits == 0 and cache.misses == 0
+    with pytest.raises(ValueError):
+        cache.make_key(model, tokenizer, "the band", {"kwargs" : kwargs})
@@ -0,0 +1,56 @@
+import pytest
+import evaluate as ev
+import finetune as ft
+import model_prompts
+from inference_profiler import InferenceProfiler
+import numpy as np
+import json
+
+def test_profiler_records_stages_and_batches():
+    profiler = InferenceProfiler()
+
+    with profiler.stage("template"):
+        pass
+    with profiler.batch([0, 1, 2]) as batch:
+        with profiler.stage("prefill"):
+            pass
+        profiler.add_tokens(prompt_tokens=30, generated_tokens=6)
+
+    assert [(event.stage, event.batch) for event in profiler.events] == [("template", -1), ("prefill", 0)]
+    assert (batch.prompt_tokens, batch.generated_tokens) == (30, 6)
+    assert all(event.duration >= 0 for event in profiler.events)
+    assert batch.start <= profiler.events[1].start <= batch.start + batch.duration
+
+    summary = profiler.get_stage_summary()
+    assert summary.index.tolist() == ["template", "prefill"]
+    assert np.isclose(summary["Share"].sum(), 1)
+
+def test_evaluate_profile(tiny_llm, tiny_dataset, tmp_path):
+    model, tokenizer = tiny_llm
+    eval_data, label_names = tiny_dataset
+    eval_config = ev.EvaluationConfig(name="Zero-shot", prompt=model_prompts.DBPEDIA["ZERO_SHOT"], max_tokens=2)
+    profiler = InferenceProfiler()
+
+    result = ev.evaluate(model, tokenizer, list(label_names), eval_data, eval_config, batch_size=4, profiler=profiler)
+
+    assert result.profile is profiler
+    assert len(profiler.batches) == len(eval_data) // 4
+    assert sorted(i for batch in profiler.batches for i in batch.indices) == list(range(len(eval_data)))
+    assert all(batch.prompt_tokens > 0 and batch.generated_tokens <= 2 * len(batch.indices) for batch in profiler.batches)
+
+    stages = set(profiler.get_stage_summary().index)
+    assert {"template", "tokenize", "prefill", "decode", "detokenize", "parse"} <= stages
+
+    trace = profiler.to_chrome_trace(tmp_path / "trace.json")
+    assert json.loads((tmp_path / "trace.json").read_text()) == trace
+    assert sum(event["cat"] == "batch" for event in trace["traceEvents"] if "cat" in event) == len(profiler.batches)
+
+def test_score_labels_profile(tiny_llm):
+    model, tokenizer = tiny_llm
+    profiler = InferenceProfiler()
+
+    with profiler.batch([0, 1]) as batch:
+        ft.score_labels(["the band", "a river"], ["Company", "Artist"], model, tokenizer, profiler=profiler)
+
+    assert batch.prompt_tokens > 0 and batch.generated_tokens == 0
+    assert {"prefill", "score"} <= set(event.stage for event in profiler.events)
@@ -1,7 +1,9 @@
 import pytest
+import math
 import finetune as ft
-from datasets import load_dataset, ClassLabel
+from datasets import load_dataset, ClassLabel, Dataset
 import numpy as np
+import pandas as pd
 
 @pytest.fixture()
 def full_dataset():
@@ -45,6 +47,54 @@ def test_resize_dataset_has_no_side_effects(test_dataset):
 
     assert expected == actual, "There should be no side effects from resizing a dataset"
 
+def _reference_undersample_dataset(dataset, labels_column, samples_per_class, shuffle, seed):
+    # Frozen copy of the original implementation, used to check undersample_dataset gives identical results.
+    if shuffle: dataset = dataset.shuffle(seed=seed)
+
+    ds_sorted = dataset.flatten_indices().sort(labels_column)
+    _, class_indices = np.unique(ds_sorted[labels_column], return_index=True)
+    n = min(samples_per_class, np.bincount(ds_sorted[labels_column]).min())
+    class_indices = np.array([list(range(index, index + n)) for index in class_indices]).flatten()
+
+    sample = ds_sorted.select(class_indices)
+    if shuffle: sample = sample.shuffle(seed=seed)
+    return sample
+
+@pytest.mark.parametrize("shuffle", [True, False])
+@pytest.mark.parametrize("seed", [0, 42])
+def test_undersample_dataset_matches_reference(shuffle, seed):
+    rng = np.random.default_rng(123)
+    labels = rng.choice(5, size=500, p=[0.4, 0.3, 0.15, 0.1, 0.05])
+    dataset = Dataset.from_dict({"label" : labels, "row" : np.arange(labels.size)}).filter(lambda sample: sample["row"] % 7 != 0)
+
+    expected = _reference_undersample_dataset(dataset, "label", 12, shuffle, seed)
+    sample = ft.undersample_dataset(dataset, samples_per_class=12, shuffle=shuffle, seed=seed)
+
+    assert sample["row"] == expected["row"]
+    assert np.array_equal(np.bincount(sample["label"]), [12] * 5)
+
+    with pytest.warns(UserWarning):
+        sample = ft.undersample_dataset(dataset, samples_per_class=10_000, shuffle=shuffle, seed=seed)
+    assert len(sample) == 5 * np.bincount(dataset["label"]).min()
+
+def test_select_top_n_classes_class_label():
+    label_names = ["Zebra", "Apple", "Mango", "Kiwi", "Banana"]
+    labels = np.random.default_rng(0).choice(5, size=300, p=[0.35, 0.05, 0.3, 0.1, 0.2])
+    dataset = Dataset.from_dict({"label" : labels, "row" : np.arange(labels.size)}).cast_column("label", ClassLabel(names=label_names))
+    splits = dataset.train_test_split(test_size=0.2, seed=0)
+
+    sample = ft.select_top_n_classes(splits, n=3)
+
+    for subset in ["train", "test"]:
+        # Compare against filtering and re-encoding the label names, as select_top_n_classes used to.
+        expected = splits[subset].filter(lambda x : label_names[x["label"]] in ["Zebra", "Mango", "Banana"])
+        assert sample[subset].features["label"].names == ["Banana", "Mango", "Zebra"]
+        assert sample[subset]["row"] == expected["row"]
+        assert [sample[subset].features["label"].int2str(x) for x in sample[subset]["label"]] == [label_names[x] for x in expected["label"]]
+
+    strings = Dataset.from_dict({"label" : [label_names[x] for x in labels]})
+    assert sorted(set(ft.select_top_n_classes(strings, n=2)["label"])) == ["Mango", "Zebra"]
+
 def test_preprocess_datadict(full_dataset):
     subsets = ["train", "test"]
     full_dataset = ft.undersample_dataset(full_dataset, samples_per_class=10)
@@ -69,6 +119,54 @@ def test_preprocess_dataset(test_dataset):
     assert samples == [message[0]['content'] for message in processed_dataset['messages']], "The content of the pre-processed dataset should be identical"
     assert labels == [message[-1]['content'] for message in processed_dataset['messages']], "The content of the pre-processed dataset should be identical"
 
+def test_preprocess_dataset_batched():
+    label_names = ["Company ", "Artist", "Village"]
+    labels = np.random.default_rng(0).choice(3, size=50)
+    texts = [f"sample {i}" for i in range(labels.size)]
+    dataset = Dataset.from_dict({"content" : texts, "label" : labels, "title" : texts}).cast_column("label", ClassLabel(names=label_names))
+    expected = [[{"role" : "user", "content" : text}, {"role" : "assistant", "content" : label_names[label].strip()}] for text, label in zip(texts, labels)]
+
+    for batch_size, num_proc in [(1000, None), (7, 2)]:
+        processed_dataset, actual_names = ft.preprocess_dataset(dataset, "content", "label", batch_size=batch_size, num_proc=num_proc)
+        assert processed_dataset.column_names == ["messages"]
+        assert processed_dataset["messages"] == expected
+        assert actual_names == ["Company", "Artist", "Village"]
+
+@pytest.mark.parametrize("strategy", ft.TRUNCATION_STRATEGIES)
+def test_truncate_texts(tiny_llm, strategy):
+    _, tokenizer = tiny_llm
+    texts = ["the band was born in the town by the river", "a song"]
+    truncation = ft.TruncationConfig(max_tokens=4, strategy=strategy, separator=" ")
+
+    truncated_texts, truncated = ft.truncate_texts(texts, tokenizer, truncation)
+    assert truncated == [True, False]
+    assert truncated_texts[1] == texts[1]
+
+    ids = tokenizer(texts[0], add_special_tokens=False)["input_ids"]
+    head, tail = tokenizer.decode(ids[0:2]), tokenizer.decode(ids[-2:])
+    expected = {"head" : tokenizer.decode(ids[0:4]), "tail" : tokenizer.decode(ids[-4:]), "head_tail" : head + " " + tail}
+    assert truncated_texts[0] == expected[strategy]
+
+def test_truncation_config_validation():
+    with pytest.raises(ValueError):
+        ft.TruncationConfig(max_tokens=0)
+    with pytest.raises(ValueError):
+        ft.TruncationConfig(max_tokens=8, strategy="middle")
+
+def test_preprocess_dataset_truncation(tiny_llm):
+    _, tokenizer = tiny_llm
+    texts = ["the band was born in the town by the river", "a song", "the club"]
+    dataset = Dataset.from_dict({"text" : texts, "label" : ["Artist", "Album", "Company"]})
+    truncation = ft.TruncationConfig(max_tokens=3)
+
+    with pytest.raises(ValueError):
+        ft.preprocess_dataset(dataset, truncation=truncation)
+
+    processed_dataset, _ = ft.preprocess_dataset(dataset, truncation=truncation, tokenizer=tokenizer)
+    assert processed_dataset["truncated"] == [True, False, False]
+    assert [messages[0]["content"] for messages in processed_dataset["messages"]] == ft.truncate_texts(texts, tokenizer, truncation)[0]
+    assert [messages[1]["content"] for messages in processed_dataset["messages"]] == ["Artist", "Album", "Company"]
+
 def test_preprocess_dataset_no_side_effects(test_dataset):
     expected = test_dataset.column_names
 
@@ -83,4 +181,36 @@ def test_get_class_labels(test_dataset):
     expected = test_dataset.features['label'].names
     _, actual = ft.preprocess_dataset(test_dataset, "content", "label")
 
-    assert expected == actual, "A list of class label names should be returned when preprocessing a dataset."
\ No newline at end of file
+    assert expected == actual, "A list of class label names should be returned when preprocessing a dataset."
+
+def test_create_dataset_from_dataframe(tmp_path):
+    df = pd.DataFrame({
+        "Narrative" : [f"injury {i}" if i % 11 else None for i in range(100)],
+        "Nature" : [[" Burns", "Cuts ", "Fractures", None][i % 4] for i in range(100)],
+        "Other" : range(100)
+    })
+    valid = df.dropna(subset=["Narrative", "Nature"])
+    expected_texts = valid["Narrative"].to_list()
+    expected_labels = [label.strip() for label in valid["Nature"]]
+
+    csv_path, parquet_path = str(tmp_path / "data.csv"), str(tmp_path / "data.parquet")
+    df.to_csv(csv_path, index=False)
+    df.to_parquet(parquet_path, index=False)
+
+    datasets = [
+        ft.create_dataset_from_dataframe(df, "Narrative", "Nature", test_size=None, chunk_size=7),
+        ft.create_dataset_from_file(csv_path, "Narrative", "Nature", test_size=None, chunk_size=7),
+        ft.create_dataset_from_file(parquet_path, "Narrative", "Nature", test_size=None, chunk_size=7)
+    ]
+
+    for dataset in datasets:
+        assert dataset.column_names == ["text", "label"]
+        assert dataset.features["label"].names == ["Burns", "Cuts", "Fractures"]
+        assert dataset["text"] == expected_texts
+        assert [dataset.features["label"].int2str(label) for label in dataset["label"]] == expected_labels
+
+    assert df["Nature"].iloc[0] == " Burns", "There should be no side effects from creating a dataset"
+
+    splits = ft.create_dataset_from_dataframe(df, "Narrative", "Nature", test_size=0.2)
+    assert (len(splits["train"]), len(splits["test"])) == (len(valid) - math.ceil(0.2 * len(valid)), math.ceil(0.2 * len(valid)))
+